@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local key agent which holds an unlocked private key in memory and serves decryption requests over
+a Unix socket (similar to ssh-agent).
+
+Protocol is line delimited JSON. Each connection sends a single request and receives a single
+response:
+
+    -> {"method": "decrypt", "key_path": "/path/to/private_key.pem", "secrets": ["...", "..."]}
+    <- {"status": "ok", "result": ["...", "..."]}
+
+When DCSM_AGENT_SOCK environment variable is set, decrypt_secret transparently uses the agent
+and falls back to local decryption if the agent is not available or it holds a different key.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+import time
+from typing import List, Optional
+
+from dcsm import decryption
+
+__all__ = ["KeyAgent", "AgentClient", "get_agent_client", "get_default_socket_path"]
+
+# Environment variable which points to the agent socket
+AGENT_SOCKET_ENV_VARIABLE = "DCSM_AGENT_SOCK"
+
+# Default number of seconds after which agent exits and the unlocked key is discarded
+DEFAULT_TTL = 3600
+
+# Maximum size of a single request or response in bytes
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# Socket timeout (in seconds) used by the client
+CLIENT_TIMEOUT = 30
+
+METHOD_DECRYPT = "decrypt"
+METHOD_STATUS = "status"
+
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+STATUS_KEY_MISMATCH = "key_mismatch"
+STATUS_EXPIRED = "expired"
+
+
+class KeyAgent(object):
+    """
+    Agent which unlocks the private key once and serves decryption requests until the TTL expires.
+    """
+
+    def __init__(
+        self,
+        key_path: str,
+        socket_path: str,
+        password: Optional[str] = None,
+        ttl: int = DEFAULT_TTL,
+    ) -> None:
+        if ttl <= 0:
+            raise ValueError("TTL needs to be greater than 0")
+
+        self.key_path = os.path.realpath(key_path)
+        self.socket_path = socket_path
+        self.ttl = ttl
+
+        self._password = password
+        self._server: Optional[_AgentServer] = None
+        self._expires_at: Optional[float] = None
+
+    def start(self) -> None:
+        """
+        Unlock the private key and bind to the socket.
+        """
+        # Fail early if the key or password is invalid
+        decryption.load_private_key(key_path=self.key_path, password=self._password)
+
+        if os.path.exists(self.socket_path):
+            if not stat.S_ISSOCK(os.lstat(self.socket_path).st_mode):
+                raise ValueError("File %s exists and is not a socket" % (self.socket_path))
+
+            os.unlink(self.socket_path)
+
+        # Make sure socket is never accessible to other users, not even for a brief moment
+        old_umask = os.umask(0o177)
+
+        try:
+            self._server = _AgentServer(self.socket_path, _AgentRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+        try:
+            os.chmod(self.socket_path, 0o600)
+        except BaseException:
+            self._cleanup()
+            raise
+
+        self._server.agent = self
+        self._expires_at = time.monotonic() + self.ttl
+
+    def serve_forever(self) -> None:
+        """
+        Serve requests until the TTL expires or the agent is stopped.
+        """
+        if not self._server:
+            self.start()
+
+        assert self._server is not None
+
+        timer = threading.Timer(self.ttl, self.stop)
+        timer.daemon = True
+        timer.start()
+
+        try:
+            self._server.serve_forever(poll_interval=0.5)
+        finally:
+            timer.cancel()
+            self._cleanup()
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+
+    def handle_request(self, request: dict) -> dict:
+        method = request.get("method", None)
+
+        if self._expires_at is None or time.monotonic() >= self._expires_at:
+            return {"status": STATUS_EXPIRED, "error": "Agent TTL has expired"}
+
+        if method == METHOD_STATUS:
+            return {
+                "status": STATUS_OK,
+                "key_path": self.key_path,
+                "expires_in": int(self._expires_at - time.monotonic()),
+            }
+        elif method == METHOD_DECRYPT:
+            key_path = os.path.realpath(str(request.get("key_path", "")))
+
+            if key_path != self.key_path:
+                return {
+                    "status": STATUS_KEY_MISMATCH,
+                    "error": "Agent holds a different key (%s)" % (self.key_path),
+                }
+
+            secrets = request.get("secrets", [])
+
+            try:
+                result = [
+                    decryption.decrypt_secret(
+                        key_path=self.key_path,
+                        secret=secret,
+                        password=self._password,
+                        use_agent=False,
+                    )
+                    for secret in secrets
+                ]
+            except Exception as e:
+                return {"status": STATUS_ERROR, "error": str(e)}
+
+            return {"status": STATUS_OK, "result": result}
+
+        return {"status": STATUS_ERROR, "error": "Unsupported method: %s" % (method)}
+
+    def _cleanup(self) -> None:
+        if self._server:
+            self._server.server_close()
+            self._server = None
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self._password = None
+        decryption.clear_private_key_cache(self.key_path)
+
+
+class AgentClient(object):
+    """
+    Client for talking to the key agent.
+    """
+
+    def __init__(self, socket_path: str, timeout: float = CLIENT_TIMEOUT) -> None:
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def decrypt(self, key_path: str, secrets: List[str]) -> Optional[List[str]]:
+        """
+        Decrypt provided secrets using the agent.
+
+        None is returned if agent is not available, holds a different key or its TTL has expired,
+        in which case caller should fall back to local decryption.
+        """
+        try:
+            response = self.request(
+                {
+                    "method": METHOD_DECRYPT,
+                    "key_path": os.path.realpath(key_path),
+                    "secrets": secrets,
+                }
+            )
+        except (OSError, ValueError):
+            return None
+
+        if response.get("status") == STATUS_OK:
+            return response["result"]
+        elif response.get("status") in [STATUS_KEY_MISMATCH, STATUS_EXPIRED]:
+            return None
+
+        raise ValueError(response.get("error", "Unknown agent error"))
+
+    def status(self) -> dict:
+        return self.request({"method": METHOD_STATUS})
+
+    def request(self, request: dict) -> dict:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+
+            with sock.makefile("rb") as fp:
+                line = fp.readline(MAX_MESSAGE_SIZE)
+
+        if not line:
+            raise ValueError("Agent closed the connection without a response")
+
+        return json.loads(line.decode("utf-8"))
+
+
+def get_agent_client() -> Optional[AgentClient]:
+    """
+    Return agent client if agent socket environment variable is set.
+    """
+    socket_path = os.environ.get(AGENT_SOCKET_ENV_VARIABLE, None)
+
+    if not socket_path:
+        return None
+
+    return AgentClient(socket_path=socket_path)
+
+
+def get_default_socket_path() -> str:
+    """
+    Return default agent socket path which is located inside a directory only accessible to the
+    current user.
+    """
+    directory = tempfile.mkdtemp(prefix="dcsm-agent-")
+    return os.path.join(directory, "agent.sock")
+
+
+class _AgentServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    agent: KeyAgent
+
+
+class _AgentRequestHandler(socketserver.StreamRequestHandler):
+    server: _AgentServer
+
+    def handle(self) -> None:
+        if not _is_same_user(self.connection):
+            self._write_response({"status": STATUS_ERROR, "error": "Permission denied"})
+            return
+
+        line = self.rfile.readline(MAX_MESSAGE_SIZE)
+
+        try:
+            request = json.loads(line.decode("utf-8"))
+        except ValueError:
+            self._write_response({"status": STATUS_ERROR, "error": "Invalid request"})
+            return
+
+        if not isinstance(request, dict):
+            self._write_response({"status": STATUS_ERROR, "error": "Invalid request"})
+            return
+
+        self._write_response(self.server.agent.handle_request(request))
+
+    def _write_response(self, response: dict) -> None:
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def _is_same_user(connection: socket.socket) -> bool:
+    """
+    Verify that the peer runs as the same user as the agent (where supported).
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        # Socket file permissions are still enforced
+        return True
+
+    credentials = connection.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", credentials)
+
+    return uid == os.getuid()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asyncio API.
+
+CPU bound work (private key operations, template rendering) and blocking disk IO is offloaded to
+an executor and file locks are acquired without blocking the event loop.
+"""
+
+import asyncio
+import contextlib
+import functools
+import math
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import AsyncIterator, Callable, List, Optional, Set, Tuple, TypeVar
+
+from filelock import FileLock, Timeout
+
+from dcsm import decryption, file_render, secrets_writer
+from dcsm.locking import get_lock_timeout
+from dcsm.utils import get_template_file_lock_path
+
+__all__ = [
+    "decrypt_secret",
+    "decrypt_secrets",
+    "decrypt_secret_from_file",
+    "render_template_file",
+    "render_template_files",
+    "acquire_file_lock",
+]
+
+T = TypeVar("T")
+
+# How often to retry acquiring a file lock which is held by somebody else (in seconds)
+LOCK_POLL_INTERVAL = 0.05
+
+# Default maximum number of templates which are rendered concurrently
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+async def decrypt_secret(
+    key_path: str,
+    secret: str,
+    password: Optional[str] = None,
+    executor: Optional[Executor] = None,
+) -> str:
+    """
+    Decrypt the provided secret in the executor (default event loop executor if not provided).
+    """
+    return await _run_in_executor(
+        executor, decryption.decrypt_secret, key_path=key_path, secret=secret, password=password
+    )
+
+
+async def decrypt_secrets(
+    key_path: str,
+    secrets: List[str],
+    password: Optional[str] = None,
+    executor: Optional[Executor] = None,
+) -> List[str]:
+    """
+    Decrypt multiple secrets with the same private key in the executor.
+    """
+    return await _run_in_executor(
+        executor, decryption.decrypt_secrets, key_path=key_path, secrets=secrets, password=password
+    )
+
+
+async def decrypt_secret_from_file(
+    key_path: str,
+    secrets_path: str,
+    key: str,
+    key_password: Optional[str] = None,
+    executor: Optional[Executor] = None,
+) -> str:
+    return await _run_in_executor(
+        executor,
+        secrets_writer.decrypt_secret_from_file,
+        key_path=key_path,
+        secrets_path=secrets_path,
+        key=key,
+        key_password=key_password,
+    )
+
+
+async def render_template_file(
+    key_path: str,
+    secrets_path: str,
+    template_path: str,
+    destination_path: str,
+    ensure_permissions: str = "600",
+    key_password: Optional[str] = None,
+    dummy: bool = False,
+    prefetch: bool = False,
+    skip_unchanged: bool = True,
+    state_path: Optional[str] = None,
+    bytecode_cache_dir: Optional[str] = None,
+    executor: Optional[Executor] = None,
+    lock_timeout: Optional[float] = None,
+) -> str:
+    """
+    Asynchronous version of file_render.render_template_file.
+
+    Destination file lock is acquired without blocking the event loop and the render itself runs
+    in the executor.
+    """
+    result = await render_template_files(
+        key_path=key_path,
+        secrets_path=secrets_path,
+        templates=[(template_path, destination_path)],
+        ensure_permissions=ensure_permissions,
+        key_password=key_password,
+        dummy=dummy,
+        prefetch=prefetch,
+        skip_unchanged=skip_unchanged,
+        state_path=state_path,
+        bytecode_cache_dir=bytecode_cache_dir,
+        executor=executor,
+        lock_timeout=lock_timeout,
+    )
+    return result[0]
+
+
+async def render_template_files(
+    key_path: str,
+    secrets_path: str,
+    templates: List[Tuple[str, str]],
+    ensure_permissions: str = "600",
+    key_password: Optional[str] = None,
+    dummy: bool = False,
+    prefetch: bool = False,
+    skip_unchanged: bool = True,
+    state_path: Optional[str] = None,
+    bytecode_cache_dir: Optional[str] = None,
+    executor: Optional[Executor] = None,
+    lock_timeout: Optional[float] = None,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+) -> List[str]:
+    """
+    Asynchronous version of file_render.render_template_files.
+
+    Templates are rendered concurrently, but at most max_concurrency templates are rendered at the
+    same time. All the templates share the same decrypted values cache.
+
+    Secrets which are statically referenced in the templates are decrypted up front in the
+    executor (which can also be a process pool). Templates are rendered in a thread (the provided
+    executor if it's a thread pool, default event loop executor otherwise) since the shared
+    decrypted values cache can't be shared across processes.
+    """
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency needs to be greater than 0")
+
+    secrets_dict = file_render.get_secrets_dict(
+        key_path=key_path, secrets_path=secrets_path, key_password=key_password, dummy=dummy
+    )
+    render_state = file_render.RenderState(state_path) if state_path else None
+    semaphore = asyncio.Semaphore(max_concurrency)
+    render_executor = executor if isinstance(executor, ThreadPoolExecutor) else None
+
+    async def render(template_path: str, destination_path: str) -> str:
+        async with semaphore:
+            lock_path = get_template_file_lock_path(destination_path)
+
+            async with acquire_file_lock(lock_path, timeout=lock_timeout):
+                return await _run_in_executor(
+                    render_executor,
+                    file_render.render_template_file_locked,
+                    secrets_dict=secrets_dict,
+                    template_path=template_path,
+                    destination_path=destination_path,
+                    ensure_permissions=ensure_permissions,
+                    # Referenced secrets have already been decrypted (and validated if
+                    # prefetch is True) in _decrypt_referenced_secrets
+                    prefetch=False,
+                    skip_unchanged=skip_unchanged,
+                    render_state=render_state,
+                    bytecode_cache_dir=bytecode_cache_dir,
+                )
+
+    try:
+        if isinstance(secrets_dict, file_render.DecryptSecretsDict):
+            await _decrypt_referenced_secrets(
+                secrets_dict=secrets_dict,
+                key_path=key_path,
+                key_password=key_password,
+                template_paths=[template_path for template_path, _ in templates],
+                ignore_missing=not prefetch,
+                executor=executor,
+                max_chunks=max_concurrency,
+            )
+
+        return await asyncio.gather(
+            *[
+                render(template_path=template_path, destination_path=destination_path)
+                for template_path, destination_path in templates
+            ]
+        )
+    finally:
+        secrets_dict.clear()
+
+
+@contextlib.asynccontextmanager
+async def acquire_file_lock(
+    lock_path: str,
+    timeout: Optional[float] = None,
+    poll_interval: float = LOCK_POLL_INTERVAL,
+) -> AsyncIterator[FileLock]:
+    """
+    Acquire file lock without blocking the event loop.
+
+    Lock is acquired using non-blocking attempts and the coroutine sleeps between the attempts.
+    filelock.Timeout is raised if the lock can't be acquired in the provided number of seconds
+    (defaults to the DCSM_LOCK_TIMEOUT environment variable value or 10 seconds).
+    """
+    timeout = get_lock_timeout(timeout)
+    lock = FileLock(lock_path)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    while True:
+        try:
+            lock.acquire(timeout=0)
+            break
+        except Timeout:
+            if timeout >= 0 and loop.time() >= deadline:
+                raise
+
+            await asyncio.sleep(poll_interval)
+
+    try:
+        yield lock
+    finally:
+        lock.release()
+
+
+async def _decrypt_referenced_secrets(
+    secrets_dict: file_render.DecryptSecretsDict,
+    key_path: str,
+    key_password: Optional[str],
+    template_paths: List[str],
+    ignore_missing: bool,
+    executor: Optional[Executor],
+    max_chunks: int,
+) -> None:
+    """
+    Decrypt all the secrets which are statically referenced in the provided templates in the
+    executor and store them in the secrets dictionary.
+
+    Only built-in types are passed to the executor so it can also be a process pool.
+    """
+    keys: Set[str] = set()
+
+    for template_path in template_paths:
+        template_content = await _run_in_executor(None, file_render.read_template, template_path)
+        keys.update(file_render.get_referenced_secrets(template_content=template_content))
+
+    keys_ciphertexts = await _run_in_executor(
+        None, secrets_dict.get_ciphertexts, keys, ignore_missing=ignore_missing
+    )
+
+    if not keys_ciphertexts:
+        return
+
+    keys_list = list(keys_ciphertexts.keys())
+    ciphertexts = list(keys_ciphertexts.values())
+    chunk_size = int(math.ceil(len(ciphertexts) / float(max_chunks)))
+    chunks = [
+        ciphertexts[index : index + chunk_size] for index in range(0, len(ciphertexts), chunk_size)
+    ]
+
+    results = await asyncio.gather(
+        *[
+            _run_in_executor(
+                executor,
+                decryption.decrypt_secrets,
+                key_path=key_path,
+                secrets=chunk,
+                password=key_password,
+            )
+            for chunk in chunks
+        ]
+    )
+
+    plaintexts = [plaintext for result in results for plaintext in result]
+    secrets_dict.update(dict(zip(keys_list, plaintexts)))
+
+
+async def _run_in_executor(
+    executor: Optional[Executor], func: Callable[..., T], *args, **kwargs
+) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Static analysis of templates.
+
+Finds all the secrets which are referenced in templates by walking the Jinja AST (templates are
+not rendered, so no private key is needed) and compares them with the keys in the secrets file.
+"""
+
+import json
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from jinja2 import TemplateSyntaxError
+
+from dcsm import profiling
+from dcsm.file_render import (
+    PREFETCH_EXECUTORS,
+    TEMPLATE_FILE_PATTERN,
+    find_referenced_secrets,
+    find_template_files,
+    get_environment,
+    read_template,
+)
+from dcsm.secrets_writer import (
+    get_cached_file_content,
+    get_secret_keys,
+    secrets_file_exists,
+)
+
+__all__ = [
+    "TemplateAnalysis",
+    "AnalysisReport",
+    "analyze_template",
+    "analyze_templates",
+]
+
+# Valid values for the executor argument
+ANALYZE_EXECUTORS = PREFETCH_EXECUTORS
+
+
+class TemplateAnalysis(object):
+    """
+    Secrets which are referenced in a single template.
+    """
+
+    def __init__(
+        self,
+        template_path: str,
+        secrets: List[str],
+        dynamic_references: bool = False,
+        error: Optional[str] = None,
+    ) -> None:
+        self.template_path = template_path
+        self.secrets = secrets
+        # True if template also references secrets dynamically (e.g. {{ secrets[name] }})
+        self.dynamic_references = dynamic_references
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return {
+            "secrets": self.secrets,
+            "dynamic_references": self.dynamic_references,
+            "error": self.error,
+        }
+
+
+class AnalysisReport(object):
+    """
+    Result of comparing secrets referenced in templates with the secrets in the secrets file.
+    """
+
+    def __init__(
+        self, secrets_path: str, secret_keys: List[str], templates: List[TemplateAnalysis]
+    ):
+        self.secrets_path = secrets_path
+        self.secret_keys = secret_keys
+        self.templates = templates
+
+    @property
+    def referenced_secrets(self) -> List[str]:
+        return sorted(set([key for template in self.templates for key in template.secrets]))
+
+    @property
+    def missing_secrets(self) -> Dict[str, List[str]]:
+        """
+        Return a dictionary which maps secrets which are referenced in templates, but don't exist
+        in the secrets file to the paths of the templates which reference them.
+        """
+        secret_keys = set(self.secret_keys)
+        result: Dict[str, List[str]] = {}
+
+        for template in self.templates:
+            for key in template.secrets:
+                if key not in secret_keys:
+                    result.setdefault(key, []).append(template.template_path)
+
+        return dict(sorted(result.items()))
+
+    @property
+    def unused_secrets(self) -> List[str]:
+        """
+        Return secrets which exist in the secrets file, but are not referenced by any template.
+
+        Keep in mind that secrets which are only referenced dynamically are also reported as unused.
+        """
+        referenced_secrets = set(self.referenced_secrets)
+        return [key for key in self.secret_keys if key not in referenced_secrets]
+
+    @property
+    def dynamic_references(self) -> List[str]:
+        """
+        Return paths of the templates which reference secrets dynamically.
+        """
+        return [
+            template.template_path for template in self.templates if template.dynamic_references
+        ]
+
+    @property
+    def errors(self) -> Dict[str, str]:
+        return dict(
+            [
+                (template.template_path, template.error)
+                for template in self.templates
+                if template.error is not None
+            ]
+        )
+
+    @property
+    def success(self) -> bool:
+        """
+        True if all the templates have been parsed and all the referenced secrets exist.
+        """
+        return not self.missing_secrets and not self.errors
+
+    def to_dict(self) -> dict:
+        return {
+            "secrets_path": self.secrets_path,
+            "templates": dict(
+                [(template.template_path, template.to_dict()) for template in self.templates]
+            ),
+            "referenced_secrets": self.referenced_secrets,
+            "missing_secrets": self.missing_secrets,
+            "unused_secrets": self.unused_secrets,
+            "dynamic_references": self.dynamic_references,
+            "errors": self.errors,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+
+def analyze_template(template_path: str) -> TemplateAnalysis:
+    """
+    Find all the secrets which are referenced in the provided template file.
+
+    Template syntax errors are not raised, they are stored in the "error" attribute.
+    """
+    template_path, secrets, is_static, error = _analyze_template(template_path)
+
+    return TemplateAnalysis(
+        template_path=template_path,
+        secrets=secrets,
+        dynamic_references=not is_static,
+        error=error,
+    )
+
+
+def analyze_templates(
+    template_paths: List[str],
+    secrets_path: str,
+    pattern: str = TEMPLATE_FILE_PATTERN,
+    max_workers: Optional[int] = None,
+    executor: str = "process",
+) -> AnalysisReport:
+    """
+    Find secrets which are referenced in the provided templates and compare them with the secrets
+    in the provided secrets file.
+
+    If a template path is a directory, all the files matching the provided glob pattern in that
+    directory are analyzed. Templates are parsed concurrently using a process (or a thread) pool
+    unless max_workers is 1.
+    """
+    if executor not in ANALYZE_EXECUTORS:
+        raise ValueError(
+            "Invalid executor: %s. Valid values are: %s" % (executor, ", ".join(ANALYZE_EXECUTORS))
+        )
+
+    if not secrets_file_exists(secrets_path):
+        raise ValueError("File %s doesn't exist" % (secrets_path))
+
+    template_paths = find_template_files(paths=template_paths, pattern=pattern)
+
+    with profiling.phase("analyze_templates"):
+        if max_workers == 1 or len(template_paths) <= 1:
+            results = [_analyze_template(template_path) for template_path in template_paths]
+        else:
+            executor_cls = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+            pool: Executor = executor_cls(max_workers=max_workers)
+
+            with pool:
+                results = list(pool.map(_analyze_template, template_paths))
+
+    templates = [
+        TemplateAnalysis(
+            template_path=template_path,
+            secrets=secrets,
+            dynamic_references=not is_static,
+            error=error,
+        )
+        for template_path, secrets, is_static, error in results
+    ]
+
+    secret_keys = get_secret_keys(get_cached_file_content(secrets_path))
+
+    return AnalysisReport(secrets_path=secrets_path, secret_keys=secret_keys, templates=templates)
+
+
+def _analyze_template(template_path: str) -> Tuple[str, List[str], bool, Optional[str]]:
+    """
+    Return a tuple of (template path, referenced secrets, True if all the references are static,
+    error).
+
+    Only returns built-in types so it can be used with a process pool.
+    """
+    try:
+        template_content = read_template(template_path)
+        secrets, is_static = find_referenced_secrets(
+            template_content=template_content, env=get_environment()
+        )
+    except TemplateSyntaxError as e:
+        return template_path, [], True, "%s (line %s)" % (e.message, e.lineno)
+    except (OSError, UnicodeDecodeError) as e:
+        return template_path, [], True, str(e)
+
+    return template_path, sorted(secrets), is_static, None
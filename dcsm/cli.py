@@ -0,0 +1,1071 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unified "dcsm <command>" command line interface.
+
+Heavy dependencies (cryptography, jinja2, yaml, filelock) are only imported inside the commands
+which need them so the CLI starts fast.
+"""
+
+import argparse
+import datetime
+import os
+import sys
+from typing import Callable, Dict, List, Optional
+
+from dcsm.keygen import KEY_TYPE_RSA, KEY_TYPES
+from dcsm.profiling import profile_report
+from dcsm.utils import KEY_VALUE_FORMATS
+
+__all__ = ["main", "run_command"]
+
+PROFILE_HELP = (
+    "Write JSON report with per-phase durations and counters (decryptions, cache hits, etc.) to "
+    "standard error."
+)
+
+ENVELOPE_HELP = (
+    "True to use envelope format (AES-GCM encrypted value + RSA wrapped data key) which doesn't "
+    "limit the size of the secret value."
+)
+
+KEY_PATHS_HELP = (
+    "Path to the public key file to use for encryption. Can be specified multiple times in which "
+    "case secret can be decrypted with any of the corresponding private keys."
+)
+
+JOURNAL_HELP = (
+    "True to append the change to the secrets file journal instead of re-writing the whole "
+    "secrets file. Journal is compacted into the secrets file once it grows past the threshold."
+)
+
+LOCK_TIMEOUT_HELP = (
+    "Maximum number of seconds to wait for the secrets file lock (negative value means wait "
+    "forever). Defaults to the DCSM_LOCK_TIMEOUT environment variable value or 10 seconds."
+)
+
+
+class Command(object):
+    def __init__(
+        self,
+        description: str,
+        add_arguments: Callable[[argparse.ArgumentParser], None],
+        run: Callable[[argparse.ArgumentParser, argparse.Namespace], Optional[int]],
+        profile: bool = True,
+    ) -> None:
+        self.description = description
+        self.add_arguments = add_arguments
+        self.run = run
+        self.profile = profile
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Entry point for the "dcsm" command.
+    """
+    parser = argparse.ArgumentParser(prog="dcsm", description="Docker Compose secrets management")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    for name, command in COMMANDS.items():
+        subparser = subparsers.add_parser(
+            name, help=command.description, description=command.description
+        )
+        _add_arguments(subparser, command)
+
+    args = parser.parse_args(argv)
+    subparser = subparsers.choices[args.command]
+
+    return _run(subparser, COMMANDS[args.command], args)
+
+
+def run_command(name: str, argv: Optional[List[str]] = None) -> int:
+    """
+    Run a single command as a standalone script (used by the "dcsm-<command>" scripts).
+    """
+    command = COMMANDS[name]
+
+    parser = argparse.ArgumentParser(prog="dcsm-%s" % (name), description=command.description)
+    _add_arguments(parser, command)
+
+    args = parser.parse_args(argv)
+
+    return _run(parser, command, args)
+
+
+def _add_arguments(parser: argparse.ArgumentParser, command: Command) -> None:
+    command.add_arguments(parser)
+
+    if command.profile:
+        parser.add_argument("--profile", action="store_true", default=False, help=PROFILE_HELP)
+
+
+def _run(parser: argparse.ArgumentParser, command: Command, args: argparse.Namespace) -> int:
+    with profile_report(enabled=getattr(args, "profile", False)):
+        exit_code = command.run(parser, args)
+
+    return exit_code or 0
+
+
+def _add_lock_timeout_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--lock-timeout",
+        type=float,
+        default=None,
+        required=False,
+        help=LOCK_TIMEOUT_HELP,
+    )
+
+
+def _add_journal_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--journal",
+        action="store_true",
+        default=False,
+        required=False,
+        help=JOURNAL_HELP,
+    )
+
+
+def _add_encrypt_secret_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--key-path",
+        type=str,
+        action="append",
+        default=None,
+        required=True,
+        help=KEY_PATHS_HELP,
+    )
+    parser.add_argument(
+        "value",
+        type=str,
+        nargs=1,
+        help=("Secret value to encrypt with the provided key"),
+    )
+    parser.add_argument(
+        "--envelope",
+        action="store_true",
+        default=False,
+        required=False,
+        help=ENVELOPE_HELP,
+    )
+
+
+def _run_encrypt_secret(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    from dcsm.encryption import encrypt_secret
+
+    result = encrypt_secret(
+        key_path=args.key_path, value=args.value[0], envelope_format=args.envelope
+    )
+    print(result)
+
+
+def _add_decrypt_secret_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--key-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to the private key file to use for decryption"),
+    )
+    parser.add_argument(
+        "--password",
+        type=str,
+        default=None,
+        required=False,
+        help=("Optional password with which the private key is encrypted"),
+    )
+    parser.add_argument(
+        "secret",
+        type=str,
+        nargs=1,
+        help=("Encrypted and base64 encoded secret value"),
+    )
+
+
+def _run_decrypt_secret(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    from dcsm.decryption import decrypt_secret
+
+    result = decrypt_secret(key_path=args.key_path, secret=args.secret[0], password=args.password)
+    print(result)
+
+
+def _add_decrypt_secret_from_file_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--key-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to the private key file to use to decrypt the secrets"),
+    )
+    parser.add_argument(
+        "--secrets-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to YAML file with encrypted secrets"),
+    )
+    parser.add_argument(
+        "key",
+        type=str,
+        nargs=1,
+        help=("Key of the secret to decrypt"),
+    )
+    _add_lock_timeout_argument(parser)
+
+
+def _run_decrypt_secret_from_file(
+    parser: argparse.ArgumentParser, args: argparse.Namespace
+) -> None:
+    from dcsm.secrets_writer import decrypt_secret_from_file
+
+    result = decrypt_secret_from_file(
+        key_path=args.key_path,
+        secrets_path=args.secrets_path,
+        key=args.key[0],
+        lock_timeout=args.lock_timeout,
+    )
+    print(result)
+
+
+def _add_encrypt_secret_to_file_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--key-path",
+        type=str,
+        action="append",
+        default=None,
+        required=True,
+        help=KEY_PATHS_HELP,
+    )
+    parser.add_argument(
+        "--secrets-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to YAML secrets file where secret will be stored"),
+    )
+    parser.add_argument(
+        "key",
+        type=str,
+        nargs="?",
+        help=("Secret key / name"),
+    )
+    parser.add_argument(
+        "value",
+        type=str,
+        nargs="?",
+        help=("Secret value to encrypt with the provided key"),
+    )
+    parser.add_argument(
+        "--from-file",
+        type=str,
+        default=None,
+        required=False,
+        help=(
+            "Path to a file with key value pairs to encrypt and write in a single transaction "
+            '(use "-" to read from standard input). Can be used instead of key and value '
+            "arguments."
+        ),
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default=None,
+        choices=KEY_VALUE_FORMATS,
+        required=False,
+        help=(
+            "Format of the file specified using --from-file. Defaults to json for files with "
+            ".json extension and dotenv for other files."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        required=False,
+        help=("Maximum number of secrets to encrypt concurrently when --from-file is used."),
+    )
+    parser.add_argument(
+        "--envelope",
+        action="store_true",
+        default=False,
+        required=False,
+        help=ENVELOPE_HELP,
+    )
+    _add_journal_argument(parser)
+    _add_lock_timeout_argument(parser)
+
+
+def _run_encrypt_secret_to_file(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    if args.from_file and (args.key or args.value):
+        parser.error("--from-file can't be used together with key and value arguments")
+
+    if not args.from_file and (args.key is None or args.value is None):
+        parser.error("key and value arguments are required")
+
+    from dcsm.secrets_writer import (
+        encrypt_and_write_many_to_file,
+        encrypt_and_write_to_file,
+    )
+    from dcsm.utils import parse_key_value_pairs
+
+    if args.from_file:
+        if args.from_file == "-":
+            content = sys.stdin.read()
+        else:
+            with open(args.from_file, "r") as fp:
+                content = fp.read()
+
+        input_format = args.format
+
+        if not input_format:
+            input_format = "json" if args.from_file.endswith(".json") else "dotenv"
+
+        encrypt_and_write_many_to_file(
+            key_path=args.key_path,
+            secrets_path=args.secrets_path,
+            secrets=parse_key_value_pairs(content=content, input_format=input_format),
+            envelope_format=args.envelope,
+            max_workers=args.workers,
+            lock_timeout=args.lock_timeout,
+            journal=args.journal,
+        )
+    else:
+        encrypt_and_write_to_file(
+            key_path=args.key_path,
+            key=args.key,
+            value=args.value,
+            secrets_path=args.secrets_path,
+            envelope_format=args.envelope,
+            lock_timeout=args.lock_timeout,
+            journal=args.journal,
+        )
+
+
+def _add_remove_secret_from_file_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--secrets-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to YAML secrets file where secret will be stored"),
+    )
+    parser.add_argument(
+        "key",
+        type=str,
+        nargs=1,
+        help=("Secret key / name to remove"),
+    )
+    _add_journal_argument(parser)
+    _add_lock_timeout_argument(parser)
+
+
+def _run_remove_secret_from_file(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    from dcsm.secrets_writer import remove_secret_from_file
+
+    remove_secret_from_file(
+        secrets_path=args.secrets_path,
+        key=args.key[0],
+        lock_timeout=args.lock_timeout,
+        journal=args.journal,
+    )
+
+
+def _add_generate_key_pair_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Directory where the generated keys should be saved."),
+    )
+    parser.add_argument(
+        "--password",
+        type=str,
+        default=None,
+        help=("Optional password used to encrypt private key."),
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        default=False,
+        help=("True to overwrite existing key files if they already exist on disk."),
+    )
+    parser.add_argument(
+        "--key-type",
+        type=str,
+        choices=KEY_TYPES,
+        default=KEY_TYPE_RSA,
+        help=(
+            "Type of the key pair to generate. X25519 keys are much faster to generate and use "
+            "and secrets encrypted with them always use envelope format."
+        ),
+    )
+
+
+def _run_generate_key_pair(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    from dcsm.keygen import generate_key_pair
+
+    generate_key_pair(
+        path=args.path, password=args.password, overwrite=args.overwrite, key_type=args.key_type
+    )
+
+
+def _add_render_template_file_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--key-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to the private key file to use to decrypt the secrets"),
+    )
+    parser.add_argument(
+        "--secrets-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to YAML file with encrypted secrets"),
+    )
+    parser.add_argument(
+        "--template-path",
+        type=str,
+        default=None,
+        required=False,
+        help=("Path to the docker-compose.yml template file"),
+    )
+    parser.add_argument(
+        "--destination-path",
+        type=str,
+        default=None,
+        required=False,
+        help=("Path where the rendered docker compose file content should be saved"),
+    )
+    parser.add_argument(
+        "--ensure-permissions",
+        type=str,
+        default="600",
+        required=False,
+        help=("Which permissions should be used for a rendered file. Defaults to 600."),
+    )
+    parser.add_argument(
+        "--password",
+        type=str,
+        default=None,
+        required=False,
+        help=("Optional password for private key file if the file is encrypted."),
+    )
+    parser.add_argument(
+        "--dummy",
+        action="store_true",
+        default=False,
+        required=False,
+        help=("True to replace all the secrets with dummy values (useful for testing)."),
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        default=False,
+        required=False,
+        help=(
+            "True to find all the secrets referenced in the template and decrypt them "
+            "concurrently before rendering the template."
+        ),
+    )
+    parser.add_argument(
+        "--prefetch-workers",
+        type=int,
+        default=None,
+        required=False,
+        help=("Maximum number of workers used to decrypt secrets when --prefetch is used."),
+    )
+    parser.add_argument(
+        "--prefetch-executor",
+        type=str,
+        default="thread",
+        choices=["thread", "process"],
+        required=False,
+        help=("Which executor (thread or process pool) to use when --prefetch is used."),
+    )
+    parser.add_argument(
+        "--manifest-path",
+        type=str,
+        default=None,
+        required=False,
+        help=(
+            "Path to a YAML / JSON manifest file with a list of template and destination path "
+            "pairs to render in a single run. Can be used instead of --template-path and "
+            "--destination-path."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        required=False,
+        help=("Maximum number of templates to render concurrently when --manifest-path is used."),
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=False,
+        required=False,
+        help=(
+            "True to keep running and re-render templates when the private key, secrets file or "
+            "template files change."
+        ),
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=1.0,
+        required=False,
+        help=("How often to check for changes (in seconds) when --watch is used."),
+    )
+    parser.add_argument(
+        "--state-path",
+        type=str,
+        default=None,
+        required=False,
+        help=(
+            "Optional path to a file where digests of the render inputs and outputs are stored. "
+            "If specified, render is skipped if none of the inputs have changed since the last "
+            "render."
+        ),
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        required=False,
+        help=("True to always write the destination file, even if the content hasn't changed."),
+    )
+    parser.add_argument(
+        "--bytecode-cache-dir",
+        type=str,
+        default=None,
+        required=False,
+        help=(
+            "Optional path to a directory where compiled templates are cached. Compiled templates "
+            "are keyed on the template content hash and re-used across runs."
+        ),
+    )
+
+
+def _run_render_template_file(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    if args.manifest_path and (args.template_path or args.destination_path):
+        parser.error(
+            "--manifest-path can't be used together with --template-path and --destination-path"
+        )
+
+    if not args.manifest_path and (not args.template_path or not args.destination_path):
+        parser.error("--template-path and --destination-path arguments are required")
+
+    from dcsm.file_render import (
+        TemplateWatcher,
+        load_render_manifest,
+        render_template_file,
+        render_template_files,
+    )
+
+    if args.watch:
+        if args.manifest_path:
+            templates = load_render_manifest(args.manifest_path)
+        else:
+            templates = [(args.template_path, args.destination_path)]
+
+        watcher = TemplateWatcher(
+            key_path=args.key_path,
+            secrets_path=args.secrets_path,
+            templates=templates,
+            ensure_permissions=args.ensure_permissions,
+            key_password=args.password,
+            dummy=args.dummy,
+            bytecode_cache_dir=args.bytecode_cache_dir,
+        )
+
+        try:
+            watcher.run(interval=args.watch_interval)
+        except KeyboardInterrupt:
+            pass
+    elif args.manifest_path:
+        render_template_files(
+            key_path=args.key_path,
+            secrets_path=args.secrets_path,
+            templates=load_render_manifest(args.manifest_path),
+            ensure_permissions=args.ensure_permissions,
+            key_password=args.password,
+            dummy=args.dummy,
+            prefetch=args.prefetch,
+            prefetch_workers=args.prefetch_workers,
+            prefetch_executor=args.prefetch_executor,
+            max_workers=args.workers,
+            skip_unchanged=not args.force,
+            state_path=None if args.force else args.state_path,
+            bytecode_cache_dir=args.bytecode_cache_dir,
+        )
+    else:
+        render_template_file(
+            key_path=args.key_path,
+            secrets_path=args.secrets_path,
+            template_path=args.template_path,
+            destination_path=args.destination_path,
+            ensure_permissions=args.ensure_permissions,
+            key_password=args.password,
+            dummy=args.dummy,
+            prefetch=args.prefetch,
+            prefetch_workers=args.prefetch_workers,
+            prefetch_executor=args.prefetch_executor,
+            skip_unchanged=not args.force,
+            state_path=None if args.force else args.state_path,
+            bytecode_cache_dir=args.bytecode_cache_dir,
+        )
+
+
+def _add_precompile_templates_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--bytecode-cache-dir",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to a directory where compiled templates are cached"),
+    )
+    parser.add_argument(
+        "--pattern",
+        type=str,
+        default="*.j2",
+        required=False,
+        help=("Glob pattern used to find template files in directories. Defaults to *.j2."),
+    )
+    parser.add_argument(
+        "paths",
+        type=str,
+        nargs="+",
+        help=("Template files or directories with template files to compile"),
+    )
+
+
+def _run_precompile_templates(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    from dcsm.file_render import precompile_templates
+
+    result = precompile_templates(
+        paths=args.paths, bytecode_cache_dir=args.bytecode_cache_dir, pattern=args.pattern
+    )
+
+    for template_path in result:
+        print("Compiled template %s" % (template_path))
+
+
+def _add_analyze_templates_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--secrets-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to the secrets file to compare the referenced secrets with"),
+    )
+    parser.add_argument(
+        "--manifest-path",
+        type=str,
+        default=None,
+        required=False,
+        help=("Path to a YAML / JSON render manifest file with templates to analyze"),
+    )
+    parser.add_argument(
+        "--pattern",
+        type=str,
+        default="*.j2",
+        required=False,
+        help=("Glob pattern used to find template files in directories. Defaults to *.j2."),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        required=False,
+        help=("Maximum number of templates to analyze concurrently."),
+    )
+    parser.add_argument(
+        "--executor",
+        type=str,
+        default="process",
+        choices=["thread", "process"],
+        required=False,
+        help=("Which executor (thread or process pool) to use to analyze templates."),
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="text",
+        choices=["text", "json"],
+        required=False,
+        help=("Output format. Defaults to text."),
+    )
+    parser.add_argument(
+        "--fail-on-unused",
+        action="store_true",
+        default=False,
+        required=False,
+        help=("Exit with a non-zero status code if secrets file contains unused secrets."),
+    )
+    parser.add_argument(
+        "paths",
+        type=str,
+        nargs="*",
+        help=("Template files or directories with template files to analyze"),
+    )
+
+
+def _run_analyze_templates(parser: argparse.ArgumentParser, args: argparse.Namespace) -> int:
+    if not args.paths and not args.manifest_path:
+        parser.error("At least one template path or --manifest-path argument is required")
+
+    from dcsm.analyzer import analyze_templates
+    from dcsm.file_render import load_render_manifest
+
+    template_paths = list(args.paths)
+
+    if args.manifest_path:
+        template_paths += [
+            template_path for template_path, _ in load_render_manifest(args.manifest_path)
+        ]
+
+    report = analyze_templates(
+        template_paths=template_paths,
+        secrets_path=args.secrets_path,
+        pattern=args.pattern,
+        max_workers=args.workers,
+        executor=args.executor,
+    )
+
+    if args.format == "json":
+        print(report.to_json())
+    else:
+        print("Analyzed %s templates" % (len(report.templates)))
+
+        for template_path, error in report.errors.items():
+            print("Failed to parse template %s: %s" % (template_path, error))
+
+        for key, template_paths in report.missing_secrets.items():
+            print("Missing secret %s (referenced in %s)" % (key, ", ".join(template_paths)))
+
+        for key in report.unused_secrets:
+            print("Unused secret %s" % (key))
+
+        for template_path in report.dynamic_references:
+            print("Template %s references secrets dynamically" % (template_path))
+
+    if not report.success or (args.fail_on_unused and report.unused_secrets):
+        return 1
+
+    return 0
+
+
+def _add_convert_secrets_file_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--source-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to the existing secrets file to read the secrets from"),
+    )
+    parser.add_argument(
+        "--destination-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to the secrets file where the secrets will be written"),
+    )
+    _add_lock_timeout_argument(parser)
+
+
+def _run_convert_secrets_file(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    from dcsm.secrets_writer import convert_secrets_file
+
+    convert_secrets_file(
+        source_path=args.source_path,
+        destination_path=args.destination_path,
+        lock_timeout=args.lock_timeout,
+    )
+
+
+def _add_compact_secrets_file_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--secrets-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to YAML secrets file whose journal should be compacted"),
+    )
+    _add_lock_timeout_argument(parser)
+
+
+def _run_compact_secrets_file(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    from dcsm.secrets_writer import compact_secrets_file
+
+    if not compact_secrets_file(secrets_path=args.secrets_path, lock_timeout=args.lock_timeout):
+        print("Secrets file %s has no journal, nothing to compact" % (args.secrets_path))
+
+
+def _add_rotate_secrets_file_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--old-key-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to the old private key file which is used to decrypt the secrets"),
+    )
+    parser.add_argument(
+        "--old-key-password",
+        type=str,
+        default=None,
+        required=False,
+        help=("Optional password for the old private key file if the file is encrypted."),
+    )
+    parser.add_argument(
+        "--new-key-path",
+        type=str,
+        action="append",
+        default=None,
+        required=True,
+        help=(
+            "Path to the new public key file which is used to encrypt the secrets. Can be "
+            "specified multiple times to encrypt the secrets for multiple recipient keys."
+        ),
+    )
+    parser.add_argument(
+        "--secrets-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to the secrets file with secrets to re-encrypt"),
+    )
+    parser.add_argument(
+        "--updated-since",
+        type=_parse_timestamp,
+        default=None,
+        required=False,
+        help=(
+            "Only re-encrypt secrets which have been updated after this time (unix timestamp or "
+            "ISO 8601 date and time in UTC, e.g. 2020-05-01T12:00:00)."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        required=False,
+        help=("Number of worker processes used for decryption. Defaults to the number of CPUs."),
+    )
+    parser.add_argument(
+        "--envelope",
+        action="store_true",
+        default=False,
+        required=False,
+        help=ENVELOPE_HELP,
+    )
+    _add_lock_timeout_argument(parser)
+
+
+def _run_rotate_secrets_file(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    from dcsm.secrets_writer import rotate_secrets_file
+
+    rotate_secrets_file(
+        old_key_path=args.old_key_path,
+        new_key_path=args.new_key_path,
+        secrets_path=args.secrets_path,
+        old_key_password=args.old_key_password,
+        updated_since=args.updated_since,
+        envelope_format=args.envelope,
+        max_workers=args.workers,
+        lock_timeout=args.lock_timeout,
+    )
+
+
+def _parse_timestamp(value: str) -> int:
+    """
+    Parse unix timestamp or ISO 8601 date (and time) in UTC and return unix timestamp.
+    """
+    if value.isdigit():
+        return int(value)
+
+    try:
+        date = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid timestamp: %s" % (value))
+
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+
+    return int(date.timestamp())
+
+
+def _add_agent_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--key-path",
+        type=str,
+        default=None,
+        required=True,
+        help=("Path to the private key file to use for decryption"),
+    )
+    parser.add_argument(
+        "--password",
+        type=str,
+        default=None,
+        required=False,
+        help=("Optional password with which the private key is encrypted"),
+    )
+    parser.add_argument(
+        "--socket-path",
+        type=str,
+        default=None,
+        required=False,
+        help=(
+            "Path to the Unix socket agent listens on. Defaults to a socket inside a new "
+            "temporary directory which is only accessible to the current user."
+        ),
+    )
+    parser.add_argument(
+        "--ttl",
+        type=int,
+        default=None,
+        required=False,
+        help=(
+            "Number of seconds after which agent exits and discards the unlocked key. Defaults "
+            "to 1 hour."
+        ),
+    )
+
+
+def _run_agent(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    from dcsm.agent import (
+        AGENT_SOCKET_ENV_VARIABLE,
+        DEFAULT_TTL,
+        KeyAgent,
+        get_default_socket_path,
+    )
+
+    socket_path = args.socket_path or get_default_socket_path()
+
+    try:
+        agent = KeyAgent(
+            key_path=args.key_path,
+            socket_path=socket_path,
+            password=args.password,
+            ttl=args.ttl or DEFAULT_TTL,
+        )
+        agent.start()
+
+        # Same format as ssh-agent so the output can be eval'ed by the shell
+        print(
+            "%s=%s; export %s;"
+            % (AGENT_SOCKET_ENV_VARIABLE, socket_path, AGENT_SOCKET_ENV_VARIABLE)
+        )
+        sys.stdout.flush()
+
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        # serve_forever() closes the server and removes the socket on exit
+        pass
+    finally:
+        if not args.socket_path:
+            os.rmdir(os.path.dirname(socket_path))
+
+
+COMMANDS: Dict[str, Command] = {
+    "encrypt-secret": Command(
+        description="Encrypt secret with the provided key",
+        add_arguments=_add_encrypt_secret_arguments,
+        run=_run_encrypt_secret,
+    ),
+    "decrypt-secret": Command(
+        description="Decrypt secret with the provided private key",
+        add_arguments=_add_decrypt_secret_arguments,
+        run=_run_decrypt_secret,
+    ),
+    "encrypt-secret-to-file": Command(
+        description="Encrypt a secret and write it to a YAML file with secrets",
+        add_arguments=_add_encrypt_secret_to_file_arguments,
+        run=_run_encrypt_secret_to_file,
+    ),
+    "decrypt-secret-from-file": Command(
+        description="Decrypt encrypted secret in a secrets file",
+        add_arguments=_add_decrypt_secret_from_file_arguments,
+        run=_run_decrypt_secret_from_file,
+    ),
+    "remove-secret-from-file": Command(
+        description="Remove secret from the provided secrets file",
+        add_arguments=_add_remove_secret_from_file_arguments,
+        run=_run_remove_secret_from_file,
+    ),
+    "convert-secrets-file": Command(
+        description=(
+            "Convert secrets file between YAML and SQLite format (format is determined based on "
+            "the file extension - .db, .sqlite and .sqlite3 files are treated as SQLite stores)"
+        ),
+        add_arguments=_add_convert_secrets_file_arguments,
+        run=_run_convert_secrets_file,
+    ),
+    "rotate-secrets-file": Command(
+        description=(
+            "Re-encrypt all the secrets in a secrets file with a new key (e.g. during key rotation)"
+        ),
+        add_arguments=_add_rotate_secrets_file_arguments,
+        run=_run_rotate_secrets_file,
+    ),
+    "compact-secrets-file": Command(
+        description="Fold secrets file journal into the secrets file",
+        add_arguments=_add_compact_secrets_file_arguments,
+        run=_run_compact_secrets_file,
+    ),
+    "generate-key-pair": Command(
+        description="Generate a new key pair",
+        add_arguments=_add_generate_key_pair_arguments,
+        run=_run_generate_key_pair,
+        profile=False,
+    ),
+    "render-template-file": Command(
+        description="Render docker-compose.yml template file",
+        add_arguments=_add_render_template_file_arguments,
+        run=_run_render_template_file,
+    ),
+    "precompile-templates": Command(
+        description="Compile template files ahead of time and store them in the bytecode cache",
+        add_arguments=_add_precompile_templates_arguments,
+        run=_run_precompile_templates,
+        profile=False,
+    ),
+    "analyze-templates": Command(
+        description=(
+            "Find secrets which are referenced in templates without rendering them and report "
+            "secrets which are missing from (or unused in) the secrets file"
+        ),
+        add_arguments=_add_analyze_templates_arguments,
+        run=_run_analyze_templates,
+    ),
+    "agent": Command(
+        description=(
+            "Start key agent which unlocks the private key once and serves decryption requests "
+            "over a Unix socket"
+        ),
+        add_arguments=_add_agent_arguments,
+        run=_run_agent,
+        profile=False,
+    ),
+}
+
+
+if __name__ == "__main__":
+    sys.exit(main())
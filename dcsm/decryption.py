@@ -14,47 +14,305 @@
 # limitations under the License.
 
 import base64
+import collections
+import hashlib
 import os
-from typing import Optional, cast
+import threading
+from typing import List, Optional, Tuple
 
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 
-__all__ = ["decrypt_secret"]
+from dcsm import envelope, profiling
 
+__all__ = [
+    "decrypt_secret",
+    "decrypt_secrets",
+    "decrypt_secrets_with_agent",
+    "load_private_key",
+    "clear_private_key_cache",
+]
 
-def decrypt_secret(key_path: str, secret: str, password: Optional[str] = None) -> str:
+PrivateKeyCacheKey = Tuple[str, int, int, str]
+
+# Maximum number of loaded private keys which are cached in memory
+PRIVATE_KEY_CACHE_MAX_SIZE = 16
+
+
+class _CachedPrivateKey(object):
     """
-    Decrypt provided RSA encrypted and base64 encoded secret value.
+    Loaded private key and its (lazily computed) fingerprint which is used to find the matching
+    data key in the multi-recipient secrets.
+    """
+
+    def __init__(self, private_key: envelope.PrivateKey) -> None:
+        self.private_key = private_key
+        self.fingerprint: Optional[str] = None
+
+
+# Maps (path, mtime, inode, password digest) to a loaded private key object. Loading a password
+# protected key requires running a KDF which is expensive so we only want to do that once per
+# process.
+_PRIVATE_KEY_CACHE: "collections.OrderedDict[PrivateKeyCacheKey, _CachedPrivateKey]" = (
+    collections.OrderedDict()
+)
+_PRIVATE_KEY_CACHE_LOCK = threading.Lock()
+
+# Maximum number of unwrapped envelope data keys which are cached in memory
+DATA_KEY_CACHE_MAX_SIZE = 256
+
+# Maps (private key cache key, wrapped data key) to an unwrapped data key. Secrets which share the
+# same wrapped data key only need a single private key operation.
+_DATA_KEY_CACHE: "collections.OrderedDict[Tuple[PrivateKeyCacheKey, bytes], bytes]" = (
+    collections.OrderedDict()
+)
+
+
+def load_private_key(key_path: str, password: Optional[str] = None) -> envelope.PrivateKey:
+    """
+    Load private key (RSA or X25519) from the provided file.
+
+    Loaded keys are cached in memory and cache is automatically invalidated when the key file on
+    disk changes.
     """
+    _, private_key = _load_private_key(key_path=key_path, password=password)
+    return private_key
+
+
+def _load_private_key(
+    key_path: str, password: Optional[str] = None
+) -> Tuple[PrivateKeyCacheKey, envelope.PrivateKey]:
+    if not os.path.isfile(key_path):
+        raise ValueError("Key file %s doesn't exist" % (key_path))
 
     if password:
         password_bytes: Optional[bytes] = password.encode("utf-8")
     else:
         password_bytes = None
 
-    if not os.path.isfile(key_path):
-        raise ValueError("Key file %s doesn't exist")
+    key_path = os.path.abspath(key_path)
+    stat = os.stat(key_path)
+    password_digest = hashlib.sha256(password_bytes or b"").hexdigest()
+    cache_key = (key_path, stat.st_mtime_ns, stat.st_ino, password_digest)
+
+    with _PRIVATE_KEY_CACHE_LOCK:
+        cached_key = _PRIVATE_KEY_CACHE.get(cache_key, None)
+
+        if cached_key is not None:
+            _PRIVATE_KEY_CACHE.move_to_end(cache_key)
+            profiling.increment("private_key_cache_hits")
+            return cache_key, cached_key.private_key
+
+    profiling.increment("private_key_cache_misses")
+
+    with profiling.phase("load_private_key"):
+        with open(key_path, "rb") as fp:
+            serialized_private_key = fp.read()
 
-    with open(key_path, "rb") as fp:
-        serialized_private_key = fp.read()
+        loaded_key = serialization.load_pem_private_key(
+            serialized_private_key,
+            password=password_bytes,
+            backend=None,
+        )
 
-    private_key = serialization.load_pem_private_key(
-        serialized_private_key,
-        password=password_bytes,
-        backend=None,
-    )
-    private_key = cast(RSAPrivateKey, private_key)
+    if not isinstance(loaded_key, (RSAPrivateKey, X25519PrivateKey)):
+        raise ValueError("Unsupported key type: %s" % (type(loaded_key).__name__))
+
+    private_key = loaded_key
+
+    with _PRIVATE_KEY_CACHE_LOCK:
+        # Remove stale entries for the same file (e.g. key file has been replaced)
+        for existing_key in list(_PRIVATE_KEY_CACHE.keys()):
+            if existing_key[0] == key_path and existing_key[1:3] != cache_key[1:3]:
+                del _PRIVATE_KEY_CACHE[existing_key]
+
+        _PRIVATE_KEY_CACHE[cache_key] = _CachedPrivateKey(private_key)
+
+        while len(_PRIVATE_KEY_CACHE) > PRIVATE_KEY_CACHE_MAX_SIZE:
+            _PRIVATE_KEY_CACHE.popitem(last=False)
+
+    return cache_key, private_key
+
+
+def clear_private_key_cache(key_path: Optional[str] = None) -> None:
+    """
+    Remove cached private keys from memory.
+
+    If key_path is provided, only entries for that file are removed.
+    """
+    with _PRIVATE_KEY_CACHE_LOCK:
+        if not key_path:
+            _PRIVATE_KEY_CACHE.clear()
+            _DATA_KEY_CACHE.clear()
+            return
+
+        key_path = os.path.abspath(key_path)
+
+        for existing_key in list(_PRIVATE_KEY_CACHE.keys()):
+            if existing_key[0] == key_path:
+                del _PRIVATE_KEY_CACHE[existing_key]
+
+        for existing_data_key in list(_DATA_KEY_CACHE.keys()):
+            if existing_data_key[0][0] == key_path:
+                del _DATA_KEY_CACHE[existing_data_key]
+
+
+def decrypt_secret(
+    key_path: str, secret: str, password: Optional[str] = None, use_agent: bool = True
+) -> str:
+    """
+    Decrypt provided RSA encrypted and base64 encoded secret value.
+
+    Both, legacy (RSA encrypted value) and envelope (RSA or X25519 wrapped data key + AES-GCM
+    encrypted value) secret formats are supported. Legacy format is only supported with RSA keys.
+
+    If use_agent is True and key agent socket environment variable is set, secret is decrypted by
+    the agent (if it holds the same key).
+    """
+    return decrypt_secrets(
+        key_path=key_path, secrets=[secret], password=password, use_agent=use_agent
+    )[0]
+
+
+def decrypt_secrets(
+    key_path: str, secrets: List[str], password: Optional[str] = None, use_agent: bool = True
+) -> List[str]:
+    """
+    Decrypt multiple secrets with the same private key.
+
+    When key agent is used, all the secrets are decrypted using a single agent request.
+    """
+    profiling.increment("decryptions", len(secrets))
+
+    with profiling.phase("decrypt"):
+        if use_agent and secrets:
+            result = decrypt_secrets_with_agent(key_path=key_path, secrets=secrets)
+
+            if result is not None:
+                return result
+
+        return [
+            _decrypt_secret(key_path=key_path, secret=secret, password=password)
+            for secret in secrets
+        ]
+
+
+def decrypt_secrets_with_agent(key_path: str, secrets: List[str]) -> Optional[List[str]]:
+    """
+    Decrypt provided secrets using the key agent (single request).
+
+    None is returned if agent is not configured or it can't serve the request (it's not running,
+    its TTL has expired or it holds a different key), in which case caller should fall back to
+    local decryption.
+    """
+    # Imported lazily since agent module depends on this module
+    from dcsm import agent
+
+    client = agent.get_agent_client()
+
+    if not client:
+        return None
+
+    result = client.decrypt(key_path=key_path, secrets=secrets)
+
+    if result is None:
+        profiling.increment("agent_fallbacks")
+    else:
+        profiling.increment("agent_requests")
+
+    return result
+
+
+def _decrypt_secret(key_path: str, secret: str, password: Optional[str] = None) -> str:
+    cache_key, private_key = _load_private_key(key_path=key_path, password=password)
+
+    if envelope.is_envelope_secret(secret):
+        envelope_secret = envelope.parse_envelope_secret(secret)
+
+        if isinstance(envelope_secret, envelope.MultiRecipientEnvelopeSecret):
+            fingerprint = _get_private_key_fingerprint(cache_key, private_key)
+            recipient = envelope_secret.get_recipient(fingerprint)
+
+            if recipient is None:
+                raise ValueError(
+                    "Decryption failed: secret is not encrypted for key %s (fingerprint %s)"
+                    % (key_path, fingerprint)
+                )
+
+            algorithm, wrapped_key = recipient.algorithm, recipient.wrapped_key
+        else:
+            algorithm, wrapped_key = envelope_secret.algorithm, envelope_secret.wrapped_key
+
+        data_key = _unwrap_data_key(
+            cache_key=cache_key,
+            private_key=private_key,
+            algorithm=algorithm,
+            wrapped_key=wrapped_key,
+        )
+        return envelope.decrypt_payload(data_key=data_key, secret=envelope_secret)
+
+    if not isinstance(private_key, RSAPrivateKey):
+        raise ValueError("Decryption failed: legacy secret format is only supported with RSA keys")
 
     b64decoded = base64.b64decode(secret)
 
-    plaintext = private_key.decrypt(
-        b64decoded,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None
-        ),
-    )
+    plaintext = _rsa_decrypt(private_key=private_key, value=b64decoded)
     result = plaintext.decode("utf-8")
 
     return result
+
+
+def _get_private_key_fingerprint(
+    cache_key: PrivateKeyCacheKey, private_key: envelope.PrivateKey
+) -> str:
+    with _PRIVATE_KEY_CACHE_LOCK:
+        cached_key = _PRIVATE_KEY_CACHE.get(cache_key, None)
+
+        if cached_key is not None and cached_key.fingerprint is not None:
+            return cached_key.fingerprint
+
+    fingerprint = envelope.get_key_fingerprint(private_key)
+
+    # Fingerprint is stored together with the cached key so it's evicted together with it
+    if cached_key is not None:
+        with _PRIVATE_KEY_CACHE_LOCK:
+            cached_key.fingerprint = fingerprint
+
+    return fingerprint
+
+
+def _unwrap_data_key(
+    cache_key: PrivateKeyCacheKey,
+    private_key: envelope.PrivateKey,
+    algorithm: str,
+    wrapped_key: bytes,
+) -> bytes:
+    data_key_cache_key = (cache_key, wrapped_key)
+
+    with _PRIVATE_KEY_CACHE_LOCK:
+        data_key = _DATA_KEY_CACHE.get(data_key_cache_key, None)
+
+        if data_key is not None:
+            _DATA_KEY_CACHE.move_to_end(data_key_cache_key)
+            profiling.increment("data_key_cache_hits")
+            return data_key
+
+    profiling.increment("data_key_cache_misses")
+
+    with profiling.phase("unwrap_data_key"):
+        data_key = envelope.unwrap_data_key(
+            private_key=private_key, algorithm=algorithm, wrapped_key=wrapped_key
+        )
+
+    with _PRIVATE_KEY_CACHE_LOCK:
+        _DATA_KEY_CACHE[data_key_cache_key] = data_key
+
+        while len(_DATA_KEY_CACHE) > DATA_KEY_CACHE_MAX_SIZE:
+            _DATA_KEY_CACHE.popitem(last=False)
+
+    return data_key
+
+
+def _rsa_decrypt(private_key: RSAPrivateKey, value: bytes) -> bytes:
+    return private_key.decrypt(value, envelope.get_rsa_oaep_padding())
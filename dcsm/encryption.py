@@ -14,39 +14,229 @@
 # limitations under the License.
 
 import base64
+import functools
 import os
-from typing import cast
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Union
 
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PublicKey
 
-__all__ = ["encrypt_secret"]
+from dcsm import envelope, profiling
 
+__all__ = [
+    "encrypt_secret",
+    "encrypt_secrets",
+    "load_public_key",
+    "generate_data_key",
+    "get_legacy_secret_max_size",
+    "DataKey",
+    "KeyPaths",
+]
 
-def encrypt_secret(key_path: str, value: str) -> str:
+# Path to a single public key or a list of paths to the public keys of all the recipients
+KeyPaths = Union[str, List[str]]
+
+
+class DataKey(object):
     """
-    Encrypt the provided secret plain text and return base64 encoded ciphertext.
+    Symmetric data key which is used to encrypt secrets in the envelope format together with the
+    same data key wrapped (encrypted) with the public key.
+
+    The same data key can be used to encrypt multiple secrets (e.g. all the secrets in a secrets
+    file) which means only a single private key operation is needed to decrypt all of them.
+
+    For multi-recipient data keys, recipients contain the data key wrapped for each of the
+    recipient public keys.
     """
 
+    def __init__(
+        self,
+        key: bytes,
+        wrapped_key: bytes = b"",
+        algorithm: str = "",
+        recipients: Optional[List[envelope.Recipient]] = None,
+    ) -> None:
+        self.key = key
+        self.wrapped_key = wrapped_key
+        self.algorithm = algorithm
+        self.recipients = recipients
+
+
+def load_public_key(key_path: str) -> envelope.PublicKey:
+    """
+    Load public key (RSA or X25519) from the provided file.
+    """
     if not os.path.isfile(key_path):
         raise ValueError("Key file %s doesn't exist" % (key_path))
 
-    with open(key_path, "rb") as fp:
-        serialized_public_key = fp.read()
+    with profiling.phase("load_public_key"):
+        with open(key_path, "rb") as fp:
+            serialized_public_key = fp.read()
 
-    public_key = serialization.load_pem_public_key(
-        serialized_public_key,
-        backend=None,
-    )
-    public_key = cast(RSAPublicKey, public_key)
+        public_key = serialization.load_pem_public_key(
+            serialized_public_key,
+            backend=None,
+        )
+
+    if not isinstance(public_key, (RSAPublicKey, X25519PublicKey)):
+        raise ValueError("Unsupported key type: %s" % (type(public_key).__name__))
+
+    return public_key
+
+
+def generate_data_key(key_path: KeyPaths) -> DataKey:
+    """
+    Generate a new random data key and wrap it with the provided public key(s).
+    """
+    key_paths = _get_key_paths(key_path)
+
+    if len(key_paths) > 1:
+        public_keys = [load_public_key(key_path=path) for path in key_paths]
+        key, recipients = envelope.wrap_data_key_for_recipients(public_keys=public_keys)
+        return DataKey(key=key, recipients=recipients)
+
+    public_key = load_public_key(key_path=key_paths[0])
+
+    algorithm, key, wrapped_key = envelope.wrap_data_key(public_key=public_key)
+
+    return DataKey(key=key, wrapped_key=wrapped_key, algorithm=algorithm)
+
+
+def encrypt_secret(
+    key_path: KeyPaths,
+    value: str,
+    envelope_format: bool = False,
+    data_key: Optional[DataKey] = None,
+) -> str:
+    """
+    Encrypt the provided secret plain text and return base64 encoded ciphertext.
+
+    If envelope_format is True or data_key is provided, value is encrypted using envelope format
+    (AES-GCM encrypted value + RSA wrapped data key) which doesn't limit the size of the secret.
+
+    Secrets for X25519 keys are always encrypted using envelope format. If multiple key paths are
+    provided, value is encrypted once and can be decrypted with any of the corresponding private
+    keys (multi-recipient envelope format).
+    """
+    profiling.increment("encryptions")
+
+    with profiling.phase("encrypt"):
+        key_paths = _get_key_paths(key_path)
+
+        if data_key is None and len(key_paths) > 1:
+            data_key = generate_data_key(key_path=key_paths)
+
+        if data_key is None:
+            public_key = load_public_key(key_path=key_paths[0])
+
+            if not envelope_format and isinstance(public_key, RSAPublicKey):
+                return _encrypt_legacy_secret(public_key=public_key, value=value)
+
+            algorithm, key, wrapped_key = envelope.wrap_data_key(public_key=public_key)
+            data_key = DataKey(key=key, wrapped_key=wrapped_key, algorithm=algorithm)
+
+        return _encrypt_envelope_secret(data_key=data_key, value=value)
 
-    ciphertext = public_key.encrypt(
-        value.encode("utf-8"),
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None
-        ),
+
+def encrypt_secrets(
+    key_path: KeyPaths,
+    values: List[str],
+    envelope_format: bool = False,
+    max_workers: Optional[int] = None,
+) -> List[str]:
+    """
+    Encrypt multiple secret values with the same public key.
+
+    Public key is only loaded once and when envelope_format is True, all the values share the same
+    data key which means only a single RSA operation is needed. If max_workers is greater than 1,
+    values are encrypted concurrently using a thread pool. Secrets for X25519 keys and secrets for
+    multiple recipient keys are always encrypted using envelope format.
+    """
+    profiling.increment("encryptions", len(values))
+
+    with profiling.phase("encrypt"):
+        key_paths = _get_key_paths(key_path)
+
+        func: Callable[[str], str]
+        if len(key_paths) > 1:
+            data_key = generate_data_key(key_path=key_paths)
+            func = functools.partial(_encrypt_envelope_secret, data_key)
+            return _map(func, values, max_workers)
+
+        public_key = load_public_key(key_path=key_paths[0])
+
+        if envelope_format or not isinstance(public_key, RSAPublicKey):
+            algorithm, key, wrapped_key = envelope.wrap_data_key(public_key=public_key)
+            data_key = DataKey(key=key, wrapped_key=wrapped_key, algorithm=algorithm)
+            func = functools.partial(_encrypt_envelope_secret, data_key)
+        else:
+            func = functools.partial(_encrypt_legacy_secret, public_key)
+
+        return _map(func, values, max_workers)
+
+
+def get_legacy_secret_max_size(key_path: KeyPaths) -> Optional[int]:
+    """
+    Return maximum size (in bytes) of a secret which can be encrypted using legacy format with the
+    provided public key (None if legacy format can't be used with that key).
+    """
+    key_paths = _get_key_paths(key_path)
+
+    if len(key_paths) > 1:
+        return None
+
+    public_key = load_public_key(key_path=key_paths[0])
+
+    if not isinstance(public_key, RSAPublicKey):
+        return None
+
+    return envelope.get_rsa_oaep_max_size(public_key)
+
+
+def _map(func: Callable[[str], str], values: List[str], max_workers: Optional[int]) -> List[str]:
+    if not max_workers or max_workers <= 1:
+        return [func(value) for value in values]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(func, values))
+
+
+def _get_key_paths(key_path: KeyPaths) -> List[str]:
+    """
+    Return a list of unique public key paths.
+    """
+    if isinstance(key_path, str):
+        return [key_path]
+
+    if not key_path:
+        raise ValueError("At least one key path needs to be provided")
+
+    return list(dict.fromkeys(key_path))
+
+
+def _encrypt_envelope_secret(data_key: DataKey, value: str) -> str:
+    if data_key.recipients:
+        return envelope.encrypt_multi_recipient_payload(
+            data_key=data_key.key, recipients=data_key.recipients, value=value
+        ).serialize()
+
+    secret = envelope.encrypt_payload(
+        data_key=data_key.key,
+        algorithm=data_key.algorithm,
+        wrapped_key=data_key.wrapped_key,
+        value=value,
     )
+    return secret.serialize()
+
+
+def _encrypt_legacy_secret(public_key: RSAPublicKey, value: str) -> str:
+    ciphertext = _rsa_encrypt(public_key=public_key, value=value.encode("utf-8"))
     b64encoded = base64.b64encode(ciphertext)
     result = b64encoded.decode("utf-8")
     return result
+
+
+def _rsa_encrypt(public_key: RSAPublicKey, value: bytes) -> bytes:
+    return public_key.encrypt(value, envelope.get_rsa_oaep_padding())
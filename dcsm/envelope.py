@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Envelope (hybrid) secret format.
+
+Secret value is encrypted with a random symmetric data key using AES-GCM and the data key itself
+is encrypted ("wrapped") with the asymmetric key. Serialized secret looks like this:
+
+    dcsm:v2:<wrap algorithm>:<base64 wrapped data key>:<base64 nonce + AES-GCM ciphertext>
+
+For RSA keys, data key is a random key which is encrypted using RSA-OAEP. For X25519 keys, data
+key is derived from an X25519 key agreement between an ephemeral key pair and the recipient key
+using HKDF (ECIES) and "wrapped data key" is the ephemeral public key.
+
+Multiple secrets can share the same wrapped data key which means only a single asymmetric
+operation is needed to decrypt all of them.
+
+Multi-recipient secrets (readable by any of the recipient keys) use version 3 of the format where
+the same data key is wrapped for each of the recipient public keys:
+
+    dcsm:v3:<recipient>,<recipient>,...:<base64 nonce + AES-GCM ciphertext>
+
+Each recipient is serialized as <key fingerprint>.<wrap algorithm>.<base64 wrapped data key> and
+the private key fingerprint is used to find the matching wrapped data key on decryption. Since
+X25519 key agreement can't be used to wrap an existing data key, X25519 recipients use the key
+derived from the key agreement to wrap the data key using AES key wrap.
+"""
+
+import base64
+import hashlib
+import os
+from typing import List, Optional, Tuple, Union
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey, RSAPublicKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import (
+    X25519PrivateKey,
+    X25519PublicKey,
+)
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.keywrap import (
+    InvalidUnwrap,
+    aes_key_unwrap,
+    aes_key_wrap,
+)
+
+__all__ = [
+    "EnvelopeSecret",
+    "MultiRecipientEnvelopeSecret",
+    "Recipient",
+    "PrivateKey",
+    "PublicKey",
+    "is_envelope_secret",
+    "parse_envelope_secret",
+    "wrap_data_key",
+    "wrap_data_key_for_recipients",
+    "unwrap_data_key",
+    "get_key_fingerprint",
+]
+
+PrivateKey = Union[RSAPrivateKey, X25519PrivateKey]
+PublicKey = Union[RSAPublicKey, X25519PublicKey]
+
+ENVELOPE_PREFIX = "dcsm:"
+ENVELOPE_VERSION = "v2"
+MULTI_RECIPIENT_ENVELOPE_VERSION = "v3"
+
+WRAP_ALGORITHM_RSA_OAEP_SHA256 = "rsa-oaep-sha256"
+WRAP_ALGORITHM_X25519_HKDF_SHA256 = "x25519-hkdf-sha256"
+WRAP_ALGORITHM_X25519_HKDF_SHA256_AESKW = "x25519-hkdf-sha256-aeskw"
+WRAP_ALGORITHMS = [WRAP_ALGORITHM_RSA_OAEP_SHA256, WRAP_ALGORITHM_X25519_HKDF_SHA256]
+
+# Wrap algorithms which are supported for multi-recipient secrets
+MULTI_RECIPIENT_WRAP_ALGORITHMS = [
+    WRAP_ALGORITHM_RSA_OAEP_SHA256,
+    WRAP_ALGORITHM_X25519_HKDF_SHA256_AESKW,
+]
+
+# Separators used in the serialized multi-recipient secret header (neither of them is a valid
+# base64 or hex character)
+RECIPIENT_SEPARATOR = ","
+RECIPIENT_FIELD_SEPARATOR = "."
+
+# Number of bytes of the SHA256 public key digest which are used as a key fingerprint
+KEY_FINGERPRINT_SIZE = 16
+
+# HKDF info which is used when deriving data key from the X25519 shared secret
+X25519_HKDF_INFO = b"dcsm x25519 data key"
+
+# HKDF info which is used when deriving key wrapping key for the multi-recipient secrets
+X25519_AESKW_HKDF_INFO = b"dcsm x25519 key wrapping key"
+
+# Size of the X25519 public key in bytes
+X25519_PUBLIC_KEY_SIZE = 32
+
+# Size of the symmetric data key in bits
+DATA_KEY_SIZE = 256
+
+# Size of the AES-GCM nonce in bytes
+NONCE_SIZE = 12
+
+
+class EnvelopeSecret(object):
+    def __init__(self, algorithm: str, wrapped_key: bytes, nonce: bytes, ciphertext: bytes):
+        self.algorithm = algorithm
+        self.wrapped_key = wrapped_key
+        self.nonce = nonce
+        self.ciphertext = ciphertext
+
+    @property
+    def header(self) -> str:
+        """
+        Serialized header which is also used as associated data for the AES-GCM payload. This way
+        payload can't be combined with a different wrapped data key.
+        """
+        return "%s%s:%s:%s" % (
+            ENVELOPE_PREFIX,
+            ENVELOPE_VERSION,
+            self.algorithm,
+            base64.b64encode(self.wrapped_key).decode("utf-8"),
+        )
+
+    def serialize(self) -> str:
+        payload = base64.b64encode(self.nonce + self.ciphertext).decode("utf-8")
+        return "%s:%s" % (self.header, payload)
+
+
+class Recipient(object):
+    """
+    Data key wrapped for a single recipient of a multi-recipient secret.
+    """
+
+    def __init__(self, fingerprint: str, algorithm: str, wrapped_key: bytes) -> None:
+        self.fingerprint = fingerprint
+        self.algorithm = algorithm
+        self.wrapped_key = wrapped_key
+
+    def serialize(self) -> str:
+        return RECIPIENT_FIELD_SEPARATOR.join(
+            [self.fingerprint, self.algorithm, base64.b64encode(self.wrapped_key).decode("utf-8")]
+        )
+
+
+class MultiRecipientEnvelopeSecret(object):
+    def __init__(self, recipients: List[Recipient], nonce: bytes, ciphertext: bytes):
+        self.recipients = recipients
+        self.nonce = nonce
+        self.ciphertext = ciphertext
+
+    @property
+    def header(self) -> str:
+        """
+        Serialized header which is also used as associated data for the AES-GCM payload.
+        """
+        return "%s%s:%s" % (
+            ENVELOPE_PREFIX,
+            MULTI_RECIPIENT_ENVELOPE_VERSION,
+            RECIPIENT_SEPARATOR.join([recipient.serialize() for recipient in self.recipients]),
+        )
+
+    def serialize(self) -> str:
+        payload = base64.b64encode(self.nonce + self.ciphertext).decode("utf-8")
+        return "%s:%s" % (self.header, payload)
+
+    def get_recipient(self, fingerprint: str) -> Optional[Recipient]:
+        """
+        Return recipient entry for the key with the provided fingerprint.
+        """
+        for recipient in self.recipients:
+            if recipient.fingerprint == fingerprint:
+                return recipient
+
+        return None
+
+
+def is_envelope_secret(secret: str) -> bool:
+    """
+    Return True if the provided serialized secret uses envelope format.
+
+    Legacy secrets are plain base64 strings which never contain ":" character.
+    """
+    return secret.startswith(ENVELOPE_PREFIX)
+
+
+def parse_envelope_secret(secret: str) -> Union[EnvelopeSecret, MultiRecipientEnvelopeSecret]:
+    split = secret[len(ENVELOPE_PREFIX) :].split(":")
+
+    if len(split) == 3 and split[0] == MULTI_RECIPIENT_ENVELOPE_VERSION:
+        return _parse_multi_recipient_envelope_secret(recipients=split[1], payload=split[2])
+
+    if len(split) != 4:
+        raise ValueError("Invalid envelope secret format")
+
+    version, algorithm, wrapped_key, payload = split
+
+    if version != ENVELOPE_VERSION:
+        raise ValueError("Unsupported envelope secret version: %s" % (version))
+
+    if algorithm not in WRAP_ALGORITHMS:
+        raise ValueError("Unsupported envelope secret key wrap algorithm: %s" % (algorithm))
+
+    payload_bytes = base64.b64decode(payload)
+
+    return EnvelopeSecret(
+        algorithm=algorithm,
+        wrapped_key=base64.b64decode(wrapped_key),
+        nonce=payload_bytes[:NONCE_SIZE],
+        ciphertext=payload_bytes[NONCE_SIZE:],
+    )
+
+
+def generate_data_key() -> bytes:
+    return AESGCM.generate_key(DATA_KEY_SIZE)
+
+
+def encrypt_payload(
+    data_key: bytes, algorithm: str, wrapped_key: bytes, value: str
+) -> EnvelopeSecret:
+    secret = EnvelopeSecret(
+        algorithm=algorithm, wrapped_key=wrapped_key, nonce=os.urandom(NONCE_SIZE), ciphertext=b""
+    )
+    secret.ciphertext = AESGCM(data_key).encrypt(
+        secret.nonce, value.encode("utf-8"), secret.header.encode("utf-8")
+    )
+    return secret
+
+
+def encrypt_multi_recipient_payload(
+    data_key: bytes, recipients: List[Recipient], value: str
+) -> MultiRecipientEnvelopeSecret:
+    secret = MultiRecipientEnvelopeSecret(
+        recipients=recipients, nonce=os.urandom(NONCE_SIZE), ciphertext=b""
+    )
+    secret.ciphertext = AESGCM(data_key).encrypt(
+        secret.nonce, value.encode("utf-8"), secret.header.encode("utf-8")
+    )
+    return secret
+
+
+def decrypt_payload(
+    data_key: bytes, secret: Union[EnvelopeSecret, MultiRecipientEnvelopeSecret]
+) -> str:
+    try:
+        plaintext = AESGCM(data_key).decrypt(
+            secret.nonce, secret.ciphertext, secret.header.encode("utf-8")
+        )
+    except InvalidTag:
+        raise ValueError("Decryption failed")
+
+    return plaintext.decode("utf-8")
+
+
+def get_rsa_oaep_padding() -> padding.OAEP:
+    return padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None
+    )
+
+
+def get_rsa_oaep_max_size(public_key: RSAPublicKey) -> int:
+    """
+    Return maximum size (in bytes) of a value which can be encrypted directly with RSA-OAEP.
+    """
+    return public_key.key_size // 8 - 2 * hashes.SHA256.digest_size - 2
+
+
+def wrap_data_key(public_key: PublicKey) -> Tuple[str, bytes, bytes]:
+    """
+    Generate a new data key for the provided public key.
+
+    Returns a tuple of (wrap algorithm, data key, wrapped data key).
+    """
+    if isinstance(public_key, X25519PublicKey):
+        ephemeral_private_key = X25519PrivateKey.generate()
+        ephemeral_public_key = _get_x25519_public_bytes(ephemeral_private_key.public_key())
+
+        data_key = _derive_x25519_data_key(
+            shared_key=ephemeral_private_key.exchange(public_key),
+            ephemeral_public_key=ephemeral_public_key,
+            recipient_public_key=_get_x25519_public_bytes(public_key),
+        )
+        return WRAP_ALGORITHM_X25519_HKDF_SHA256, data_key, ephemeral_public_key
+    elif isinstance(public_key, RSAPublicKey):
+        data_key = generate_data_key()
+        wrapped_key = public_key.encrypt(data_key, get_rsa_oaep_padding())
+        return WRAP_ALGORITHM_RSA_OAEP_SHA256, data_key, wrapped_key
+
+    raise ValueError("Unsupported key type: %s" % (type(public_key).__name__))
+
+
+def wrap_data_key_for_recipients(public_keys: List[PublicKey]) -> Tuple[bytes, List[Recipient]]:
+    """
+    Generate a new data key and wrap it for each of the provided public keys.
+
+    Returns a tuple of (data key, recipients).
+    """
+    data_key = generate_data_key()
+    recipients = []
+
+    for public_key in public_keys:
+        if isinstance(public_key, X25519PublicKey):
+            ephemeral_private_key = X25519PrivateKey.generate()
+            ephemeral_public_key = _get_x25519_public_bytes(ephemeral_private_key.public_key())
+
+            wrapping_key = _derive_x25519_data_key(
+                shared_key=ephemeral_private_key.exchange(public_key),
+                ephemeral_public_key=ephemeral_public_key,
+                recipient_public_key=_get_x25519_public_bytes(public_key),
+                info=X25519_AESKW_HKDF_INFO,
+            )
+            algorithm = WRAP_ALGORITHM_X25519_HKDF_SHA256_AESKW
+            wrapped_key = ephemeral_public_key + aes_key_wrap(wrapping_key, data_key)
+        elif isinstance(public_key, RSAPublicKey):
+            algorithm = WRAP_ALGORITHM_RSA_OAEP_SHA256
+            wrapped_key = public_key.encrypt(data_key, get_rsa_oaep_padding())
+        else:
+            raise ValueError("Unsupported key type: %s" % (type(public_key).__name__))
+
+        recipients.append(
+            Recipient(
+                fingerprint=get_key_fingerprint(public_key),
+                algorithm=algorithm,
+                wrapped_key=wrapped_key,
+            )
+        )
+
+    return data_key, recipients
+
+
+def unwrap_data_key(private_key: PrivateKey, algorithm: str, wrapped_key: bytes) -> bytes:
+    """
+    Return data key for the provided wrapped data key.
+    """
+    if algorithm == WRAP_ALGORITHM_X25519_HKDF_SHA256_AESKW and isinstance(
+        private_key, X25519PrivateKey
+    ):
+        if len(wrapped_key) <= X25519_PUBLIC_KEY_SIZE:
+            raise ValueError("Decryption failed")
+
+        ephemeral_public_bytes = wrapped_key[:X25519_PUBLIC_KEY_SIZE]
+
+        wrapping_key = _derive_x25519_data_key(
+            shared_key=private_key.exchange(
+                X25519PublicKey.from_public_bytes(ephemeral_public_bytes)
+            ),
+            ephemeral_public_key=ephemeral_public_bytes,
+            recipient_public_key=_get_x25519_public_bytes(private_key.public_key()),
+            info=X25519_AESKW_HKDF_INFO,
+        )
+
+        try:
+            return aes_key_unwrap(wrapping_key, wrapped_key[X25519_PUBLIC_KEY_SIZE:])
+        except InvalidUnwrap:
+            raise ValueError("Decryption failed")
+    elif algorithm == WRAP_ALGORITHM_X25519_HKDF_SHA256 and isinstance(
+        private_key, X25519PrivateKey
+    ):
+        if len(wrapped_key) != X25519_PUBLIC_KEY_SIZE:
+            raise ValueError("Decryption failed")
+
+        ephemeral_public_key = X25519PublicKey.from_public_bytes(wrapped_key)
+
+        return _derive_x25519_data_key(
+            shared_key=private_key.exchange(ephemeral_public_key),
+            ephemeral_public_key=wrapped_key,
+            recipient_public_key=_get_x25519_public_bytes(private_key.public_key()),
+        )
+    elif algorithm == WRAP_ALGORITHM_RSA_OAEP_SHA256 and isinstance(private_key, RSAPrivateKey):
+        return private_key.decrypt(wrapped_key, get_rsa_oaep_padding())
+
+    raise ValueError(
+        "Decryption failed: secret was encrypted using %s which is not supported by %s key"
+        % (algorithm, type(private_key).__name__)
+    )
+
+
+def get_key_fingerprint(key: Union[PublicKey, PrivateKey]) -> str:
+    """
+    Return fingerprint of the provided key (hex encoded truncated SHA256 digest of the DER encoded
+    public key).
+
+    Fingerprint for the private key is the same as the fingerprint for the corresponding public
+    key.
+    """
+    if isinstance(key, (RSAPrivateKey, X25519PrivateKey)):
+        public_key: PublicKey = key.public_key()
+    else:
+        public_key = key
+
+    public_key_bytes = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+    return hashlib.sha256(public_key_bytes).hexdigest()[: KEY_FINGERPRINT_SIZE * 2]
+
+
+def _parse_multi_recipient_envelope_secret(
+    recipients: str, payload: str
+) -> MultiRecipientEnvelopeSecret:
+    parsed_recipients = []
+
+    for recipient in recipients.split(RECIPIENT_SEPARATOR):
+        split = recipient.split(RECIPIENT_FIELD_SEPARATOR)
+
+        if len(split) != 3:
+            raise ValueError("Invalid envelope secret format")
+
+        fingerprint, algorithm, wrapped_key = split
+
+        if algorithm not in MULTI_RECIPIENT_WRAP_ALGORITHMS:
+            raise ValueError("Unsupported envelope secret key wrap algorithm: %s" % (algorithm))
+
+        parsed_recipients.append(
+            Recipient(
+                fingerprint=fingerprint,
+                algorithm=algorithm,
+                wrapped_key=base64.b64decode(wrapped_key),
+            )
+        )
+
+    payload_bytes = base64.b64decode(payload)
+
+    return MultiRecipientEnvelopeSecret(
+        recipients=parsed_recipients,
+        nonce=payload_bytes[:NONCE_SIZE],
+        ciphertext=payload_bytes[NONCE_SIZE:],
+    )
+
+
+def _derive_x25519_data_key(
+    shared_key: bytes,
+    ephemeral_public_key: bytes,
+    recipient_public_key: bytes,
+    info: bytes = X25519_HKDF_INFO,
+) -> bytes:
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=DATA_KEY_SIZE // 8,
+        salt=None,
+        info=info + ephemeral_public_key + recipient_public_key,
+    )
+    return hkdf.derive(shared_key)
+
+
+def _get_x25519_public_bytes(public_key: X25519PublicKey) -> bytes:
+    return public_key.public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
+    )
@@ -13,24 +13,104 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fnmatch
+import functools
+import hashlib
+import json
 import os
-import shutil
-import tempfile
-from typing import Optional
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from types import TracebackType
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
+import yaml
 from filelock import FileLock
-from jinja2 import Environment, StrictUndefined
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FunctionLoader,
+    StrictUndefined,
+    nodes,
+)
+from jinja2.bccache import Bucket
 
-from dcsm.secrets_writer import decrypt_secret_from_file
-from dcsm.utils import get_template_file_lock_path
+from dcsm import profiling
+from dcsm.decryption import decrypt_secret, decrypt_secrets_with_agent
+from dcsm.journal import get_journal_path
+from dcsm.locking import get_lock_timeout
+from dcsm.secrets_writer import get_cached_file_content, secrets_file_exists
+from dcsm.utils import AtomicFileWriter, get_template_file_lock_path, write_to_file
 
-__all__ = ["render_template_file"]
+__all__ = [
+    "render_template_file",
+    "render_template_files",
+    "load_render_manifest",
+    "TemplateWatcher",
+    "RenderState",
+    "get_environment",
+    "precompile_templates",
+    "find_template_files",
+    "get_referenced_secrets",
+    "find_referenced_secrets",
+    "read_template",
+    "get_secrets_dict",
+    "render_template_file_locked",
+]
+
+# Name of the template context variable which holds the secrets
+SECRETS_VARIABLE_NAME = "secrets"
+
+# Valid values for the prefetch_executor argument
+PREFETCH_EXECUTORS = ["thread", "process"]
+
+# Default glob pattern used when precompiling all the templates in a directory
+TEMPLATE_FILE_PATTERN = "*.j2"
+
+# Size of the write buffer which is used when streaming rendered template to the destination file
+RENDER_WRITE_BUFFER_SIZE = 64 * 1024
+
+# Maps bytecode cache directory to a shared Jinja environment. Environment keeps compiled
+# templates in memory so the same template is only parsed and compiled once per process.
+_ENVIRONMENTS: Dict[Optional[str], Environment] = {}
+_ENVIRONMENTS_LOCK = threading.Lock()
+
+
+class ContentHashBytecodeCache(FileSystemBytecodeCache):
+    """
+    Jinja bytecode cache which stores compiled templates on disk keyed on the template content
+    hash instead of the template path.
+
+    This way cache entries can be re-used if the same template is located in a different directory
+    (e.g. fresh checkout of a repository on each deploy).
+    """
+
+    def get_bucket(self, environment, name, filename, source):
+        key = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        checksum = self.get_source_checksum(source)
+        bucket = Bucket(environment, key, checksum)
+        self.load_bytecode(bucket)
+        return bucket
 
 
 class DecryptSecretsDict(object):
     """
     Custom dictionary implementation which decrypts requested secret on access and provides
     user-friendly error messages.
+
+    Decrypted values are memoized for the lifetime of a single render so the same secret which is
+    referenced multiple times in a template is only decrypted once. Call clear() once the render
+    has finished to drop plaintext values from memory.
     """
 
     def __init__(
@@ -39,15 +119,133 @@ class DecryptSecretsDict(object):
         self._key_path = key_path
         self._secrets_path = secrets_path
         self._key_password = key_password
+        self._content: Optional[dict] = None
+        self._decrypted: Dict[str, str] = {}
 
     def __getattr__(self, key):
-        return decrypt_secret_from_file(
-            key_path=self._key_path,
-            secrets_path=self._secrets_path,
-            key=key,
-            key_password=self._key_password,
+        # Private attributes are never secrets (this also prevents infinite recursion when the
+        # object is unpickled and attributes haven't been set yet)
+        if key.startswith("_"):
+            raise AttributeError(key)
+
+        if key in self._decrypted:
+            profiling.increment("decrypted_secret_cache_hits")
+            return self._decrypted[key]
+
+        content = self._get_content()
+
+        if key not in content:
+            raise ValueError(
+                'File path %s doesn\'t contain assignment for secret "%s"'
+                % (self._secrets_path, key)
+            )
+
+        plaintext = decrypt_secret(
+            key_path=self._key_path, secret=content[key], password=self._key_password
+        )
+        self._decrypted[key] = plaintext
+
+        return plaintext
+
+    def prefetch(
+        self, keys: Iterable[str], max_workers: Optional[int] = None, executor: str = "thread"
+    ) -> None:
+        """
+        Decrypt all the provided secrets concurrently and store them in the memoized values.
+
+        All the keys are validated before any decryption is performed so errors for all the
+        missing secrets are reported at once.
+        """
+        if executor not in PREFETCH_EXECUTORS:
+            raise ValueError(
+                "Invalid executor: %s. Valid values are: %s"
+                % (executor, ", ".join(PREFETCH_EXECUTORS))
+            )
+
+        keys_ciphertexts = self.get_ciphertexts(keys)
+
+        if not keys_ciphertexts:
+            return
+
+        keys = list(keys_ciphertexts.keys())
+        ciphertexts = list(keys_ciphertexts.values())
+
+        if len(keys) == 1:
+            self._decrypted[keys[0]] = decrypt_secret(
+                key_path=self._key_path, secret=ciphertexts[0], password=self._key_password
+            )
+            return
+
+        # Key agent decrypts all the secrets using a single request. Secrets are only decrypted
+        # locally (using the pool) if the agent can't serve the request.
+        plaintexts = decrypt_secrets_with_agent(key_path=self._key_path, secrets=ciphertexts)
+
+        if plaintexts is not None:
+            profiling.increment("decryptions", len(plaintexts))
+            self._decrypted.update(zip(keys, plaintexts))
+            return
+
+        # Agent has already been tried so there is no need to try it again for each secret
+        func = functools.partial(
+            decrypt_secret, self._key_path, password=self._key_password, use_agent=False
         )
 
+        executor_cls = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+        pool: Executor = executor_cls(max_workers=max_workers)
+
+        with profiling.phase("prefetch"), pool:
+            plaintexts = list(pool.map(func, ciphertexts))
+
+        self._decrypted.update(zip(keys, plaintexts))
+
+    def get_ciphertexts(self, keys: Iterable[str], ignore_missing: bool = False) -> Dict[str, str]:
+        """
+        Return a dictionary with encrypted values of the provided secrets which haven't been
+        decrypted yet.
+
+        Unless ignore_missing is True, error for all the missing secrets is raised at once.
+        """
+        content = self._get_content()
+
+        keys = sorted(set(keys))
+        missing_keys = [key for key in keys if key not in content]
+
+        if missing_keys and not ignore_missing:
+            raise ValueError(
+                "File path %s doesn't contain assignment for secrets: %s"
+                % (self._secrets_path, ", ".join(['"%s"' % (key) for key in missing_keys]))
+            )
+
+        return dict(
+            [(key, content[key]) for key in keys if key in content and key not in self._decrypted]
+        )
+
+    def update(self, plaintexts: Dict[str, str]) -> None:
+        """
+        Store secrets which have been decrypted elsewhere (e.g. in a process pool) in the memoized
+        values.
+        """
+        self._decrypted.update(plaintexts)
+
+    def clear(self) -> None:
+        """
+        Remove memoized decrypted values and parsed secrets file content.
+        """
+        self._decrypted.clear()
+        self._content = None
+
+    def _get_content(self) -> dict:
+        """
+        Load and parse secrets file on first access and re-use it for all the subsequent lookups.
+        """
+        if self._content is None:
+            if not secrets_file_exists(self._secrets_path):
+                raise ValueError("File %s doesn't exist" % (self._secrets_path))
+
+            self._content = get_cached_file_content(self._secrets_path)
+
+        return self._content
+
 
 class DummySecretsDict(object):
     """
@@ -60,8 +258,14 @@ class DummySecretsDict(object):
         self._key_value = key_value
 
     def __getattr__(self, key):
+        if key.startswith("_"):
+            raise AttributeError(key)
+
         return self._key_value
 
+    def clear(self) -> None:
+        pass
+
 
 def render_template_file(
     key_path: str,
@@ -71,56 +275,770 @@ def render_template_file(
     ensure_permissions: str = "600",
     key_password: Optional[str] = None,
     dummy: bool = False,
+    prefetch: bool = False,
+    prefetch_workers: Optional[int] = None,
+    prefetch_executor: str = "thread",
+    skip_unchanged: bool = True,
+    state_path: Optional[str] = None,
+    bytecode_cache_dir: Optional[str] = None,
 ) -> str:
     """
     Render the provided docker compose template file, and replace secrets with decrypted secrets
     from the provided secrets file.
+
+    If prefetch is True, all the secrets which are referenced in the template are found in advance
+    and decrypted concurrently using a thread or a process pool (prefetch_executor) before
+    rendering the template.
+
+    If skip_unchanged is True and the rendered content is the same as the content of the existing
+    destination file, destination file is not re-written. If state_path is provided, digests of
+    the render inputs and output are persisted in that file and the whole render is skipped if
+    none of the inputs have changed since the last render.
+
+    Compiled templates are cached in memory and if bytecode_cache_dir is provided, also on disk.
     """
-    lock_path = get_template_file_lock_path(destination_path)
-    lock = FileLock(lock_path, timeout=10)
+    secrets_dict = get_secrets_dict(
+        key_path=key_path, secrets_path=secrets_path, key_password=key_password, dummy=dummy
+    )
 
-    if template_path == destination_path:
-        raise ValueError("Template and destination paths cannot be the same")
+    try:
+        return _render_template_file(
+            secrets_dict=secrets_dict,
+            template_path=template_path,
+            destination_path=destination_path,
+            ensure_permissions=ensure_permissions,
+            prefetch=prefetch and not dummy,
+            prefetch_workers=prefetch_workers,
+            prefetch_executor=prefetch_executor,
+            skip_unchanged=skip_unchanged,
+            render_state=RenderState(state_path) if state_path else None,
+            bytecode_cache_dir=bytecode_cache_dir,
+        )
+    finally:
+        secrets_dict.clear()
 
-    with lock:
-        # 1. Load compose template file
-        with open(template_path, "rb") as fp:
-            template_content = fp.read().decode("utf-8")
 
-        # 2. Render the template with secrets
+def render_template_files(
+    key_path: str,
+    secrets_path: str,
+    templates: List[Tuple[str, str]],
+    ensure_permissions: str = "600",
+    key_password: Optional[str] = None,
+    dummy: bool = False,
+    prefetch: bool = False,
+    prefetch_workers: Optional[int] = None,
+    prefetch_executor: str = "thread",
+    max_workers: Optional[int] = None,
+    skip_unchanged: bool = True,
+    state_path: Optional[str] = None,
+    bytecode_cache_dir: Optional[str] = None,
+) -> List[str]:
+    """
+    Render multiple template files using the same secrets file.
 
-        if dummy:
-            secrets_dict = DummySecretsDict(key_value="dummy")
-        else:
-            secrets_dict = DecryptSecretsDict(  # type: ignore
-                key_path=key_path, secrets_path=secrets_path, key_password=key_password
+    templates is a list of (template path, destination path) tuples. All the templates share a
+    single private key load, a single secrets file parse and a single decrypted values cache.
+
+    If max_workers is greater than 1, templates are rendered concurrently using a thread pool.
+    """
+    secrets_dict = get_secrets_dict(
+        key_path=key_path, secrets_path=secrets_path, key_password=key_password, dummy=dummy
+    )
+    render_state = RenderState(state_path) if state_path else None
+
+    try:
+        if prefetch and not dummy:
+            keys: Set[str] = set([])
+
+            for template_path, destination_path in templates:
+                template_content = read_template(template_path)
+
+                if render_state and render_state.is_up_to_date(
+                    destination_path=destination_path,
+                    inputs_digest=_get_render_inputs_digest(
+                        secrets_dict, template_content, ensure_permissions
+                    ),
+                ):
+                    continue
+
+                keys.update(get_referenced_secrets(template_content=template_content))
+
+            secrets_dict.prefetch(
+                keys=keys, max_workers=prefetch_workers, executor=prefetch_executor
             )
 
-        template_context = {"secrets": secrets_dict}
+        func = functools.partial(
+            _render_template_file,
+            secrets_dict,
+            ensure_permissions=ensure_permissions,
+            skip_unchanged=skip_unchanged,
+            render_state=render_state,
+            bytecode_cache_dir=bytecode_cache_dir,
+        )
 
-        env = Environment(undefined=StrictUndefined)
-        template = env.from_string(template_content)
-        rendered_template = template.render(**template_context)
+        if not max_workers or max_workers <= 1:
+            return [
+                func(template_path=template_path, destination_path=destination_path)
+                for template_path, destination_path in templates
+            ]
 
-        # 3. Write rendered file to the destination path
-        # For security reasons we first write it to a temporary file, chmod it and then move it to a
-        # final location
-        fd, tmp_path = tempfile.mkstemp()
-        os.chmod(tmp_path, int(ensure_permissions, 8))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(func, template_path=template_path, destination_path=destination_path)
+                for template_path, destination_path in templates
+            ]
+            return [future.result() for future in futures]
+    finally:
+        secrets_dict.clear()
 
+
+def load_render_manifest(manifest_path: str) -> List[Tuple[str, str]]:
+    """
+    Load a YAML (or JSON) manifest file with template and destination path pairs.
+
+    Manifest needs to contain a list of items in the following format:
+
+        - template: docker-compose.yml.j2
+          destination: docker-compose.yml
+
+    Relative paths are resolved relative to the directory where the manifest file is located.
+    """
+    with open(manifest_path, "rb") as fp:
+        content = yaml.safe_load(fp) or []
+
+    if not isinstance(content, list):
+        raise ValueError("Manifest file %s needs to contain a list of items" % (manifest_path))
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    result = []
+    for item in content:
+        if not isinstance(item, dict) or "template" not in item or "destination" not in item:
+            raise ValueError(
+                'Manifest item %s needs to contain "template" and "destination" attribute' % (item)
+            )
+
+        template_path = os.path.join(base_dir, os.path.expanduser(item["template"]))
+        destination_path = os.path.join(base_dir, os.path.expanduser(item["destination"]))
+        result.append((template_path, destination_path))
+
+    return result
+
+
+class RenderState(object):
+    """
+    Persisted state of the previous renders which is stored in a JSON file.
+
+    For each destination path, digest of the render inputs (template, secrets file, private key
+    and permissions) and digest of the rendered output is stored. This allows us to skip the whole
+    render when none of the inputs have changed.
+    """
+
+    def __init__(self, state_path: str) -> None:
+        self._state_path = os.path.abspath(os.path.expanduser(state_path))
+        self._lock = threading.Lock()
+
+    def is_up_to_date(self, destination_path: str, inputs_digest: str) -> bool:
+        item = self._read().get(os.path.abspath(destination_path), None)
+
+        if not item or item.get("inputs", None) != inputs_digest:
+            return False
+
+        if _get_file_digest(destination_path) != item.get("output", None):
+            return False
+
+        return True
+
+    def update(self, destination_path: str, inputs_digest: str, output_digest: str) -> None:
+        lock = FileLock(get_template_file_lock_path(self._state_path), timeout=get_lock_timeout())
+
+        with self._lock, lock:
+            state = self._read()
+            state[os.path.abspath(destination_path)] = {
+                "inputs": inputs_digest,
+                "output": output_digest,
+            }
+            content = json.dumps(state, indent=2, sort_keys=True)
+            write_to_file(
+                file_path=self._state_path, permissions=0o600, content=content.encode("utf-8")
+            )
+
+    def _read(self) -> dict:
         try:
-            try:
-                os.write(fd, rendered_template.encode("utf-8"))
-            finally:
-                os.close(fd)
+            with open(self._state_path, "rb") as fp:
+                return json.loads(fp.read().decode("utf-8"))
+        except (FileNotFoundError, ValueError):
+            return {}
+
+
+class TemplateWatcher(object):
+    """
+    Watch the private key, secrets file and the template files and re-render templates when their
+    inputs change.
+
+    Only templates whose inputs have actually changed are re-rendered. Template is considered
+    changed when the template file itself, the private key or the values of the secrets it
+    references change. Loaded private key and parsed secrets file content are kept in memory
+    between renders.
+    """
+
+    def __init__(
+        self,
+        key_path: str,
+        secrets_path: str,
+        templates: List[Tuple[str, str]],
+        ensure_permissions: str = "600",
+        key_password: Optional[str] = None,
+        dummy: bool = False,
+        bytecode_cache_dir: Optional[str] = None,
+    ) -> None:
+        self._key_path = key_path
+        self._secrets_path = secrets_path
+        self._templates = templates
+        self._ensure_permissions = ensure_permissions
+        self._dummy = dummy
+        self._bytecode_cache_dir = bytecode_cache_dir
+
+        self._secrets_dict = get_secrets_dict(
+            key_path=key_path, secrets_path=secrets_path, key_password=key_password, dummy=dummy
+        )
+
+        # Maps template path to (template fingerprint, referenced secrets, all references static)
+        self._template_references: Dict[str, Tuple[Optional[tuple], Set[str], bool]] = {}
+
+        # Maps destination path to the inputs signature of the last successful render
+        self._rendered_signatures: Dict[str, tuple] = {}
+
+    def poll(self) -> List[str]:
+        """
+        Check all the inputs and re-render templates whose inputs have changed.
+
+        Returns a list of destination paths which have been re-rendered.
+        """
+        result = []
+
+        try:
+            for template_path, destination_path in self._templates:
+                signature = self._get_signature(template_path=template_path)
+
+                if self._rendered_signatures.get(
+                    destination_path, None
+                ) == signature and os.path.isfile(destination_path):
+                    continue
+
+                try:
+                    _render_template_file(
+                        secrets_dict=self._secrets_dict,
+                        template_path=template_path,
+                        destination_path=destination_path,
+                        ensure_permissions=self._ensure_permissions,
+                        bytecode_cache_dir=self._bytecode_cache_dir,
+                    )
+                except Exception as e:
+                    # Failed render will be retried on the next poll
+                    print("Failed to render template %s: %s" % (template_path, str(e)))
+                    continue
 
-            shutil.move(tmp_path, destination_path)
+                self._rendered_signatures[destination_path] = signature
+                result.append(destination_path)
         finally:
-            if os.path.isfile(tmp_path):
-                os.unlink(tmp_path)
+            self._secrets_dict.clear()
+
+        return result
+
+    def run(self, interval: float = 1.0, stop_event: Optional[threading.Event] = None) -> None:
+        """
+        Poll for changes every interval seconds until stop_event is set.
+        """
+        stop_event = stop_event or threading.Event()
+
+        while not stop_event.is_set():
+            self.poll()
+            stop_event.wait(interval)
+
+    def _get_signature(self, template_path: str) -> tuple:
+        template_fingerprint = _get_file_fingerprint(template_path)
+
+        if self._dummy:
+            return (template_fingerprint,)
+
+        item = self._template_references.get(template_path, None)
+
+        if not item or item[0] != template_fingerprint:
+            try:
+                keys, is_static = find_referenced_secrets(read_template(template_path))
+            except Exception:
+                # Errors are reported by the actual render
+                keys, is_static = set([]), False
+
+            item = (template_fingerprint, keys, is_static)
+            self._template_references[template_path] = item
+
+        _, keys, is_static = item
+
+        if is_static:
+            # Template only needs to be re-rendered when values of the referenced secrets change
+            content = get_cached_file_content(self._secrets_path)
+            secrets_signature: tuple = tuple(
+                [(key, content.get(key, None)) for key in sorted(keys)]
+            )
+        else:
+            secrets_signature = (
+                _get_file_fingerprint(self._secrets_path),
+                _get_file_fingerprint(get_journal_path(self._secrets_path)),
+            )
+
+        return (template_fingerprint, _get_file_fingerprint(self._key_path), secrets_signature)
+
+
+def get_environment(bytecode_cache_dir: Optional[str] = None) -> Environment:
+    """
+    Return Jinja environment which is used to load and render template files.
+
+    Environment is shared and caches compiled templates in memory. If bytecode_cache_dir is
+    provided, compiled templates are also persisted in that directory so they can be re-used
+    across process invocations.
+    """
+    if bytecode_cache_dir:
+        bytecode_cache_dir = os.path.abspath(os.path.expanduser(bytecode_cache_dir))
+
+    with _ENVIRONMENTS_LOCK:
+        env = _ENVIRONMENTS.get(bytecode_cache_dir, None)
+
+        if env:
+            return env
+
+        bytecode_cache = None
 
-        os.chmod(destination_path, int(ensure_permissions, 8))
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, mode=0o700, exist_ok=True)
+            bytecode_cache = ContentHashBytecodeCache(directory=bytecode_cache_dir)
+
+        env = Environment(
+            undefined=StrictUndefined,
+            loader=FunctionLoader(_load_template),
+            bytecode_cache=bytecode_cache,
+            auto_reload=True,
+        )
+        _ENVIRONMENTS[bytecode_cache_dir] = env
+
+    return env
+
+
+def precompile_templates(
+    paths: List[str], bytecode_cache_dir: str, pattern: str = TEMPLATE_FILE_PATTERN
+) -> List[str]:
+    """
+    Compile the provided template files and store compiled templates in the bytecode cache.
+
+    If a path is a directory, all the files matching the provided glob pattern in that directory
+    (and all its subdirectories) are compiled.
+
+    Returns a list of compiled template paths.
+    """
+    env = get_environment(bytecode_cache_dir=bytecode_cache_dir)
+
+    result = []
+    for template_path in find_template_files(paths=paths, pattern=pattern):
+        env.get_template(os.path.abspath(template_path))
+        result.append(template_path)
+
+    return result
+
+
+def find_template_files(paths: List[str], pattern: str = TEMPLATE_FILE_PATTERN) -> List[str]:
+    """
+    Return a list of template file paths.
+
+    If a path is a directory, all the files matching the provided glob pattern in that directory
+    (and all its subdirectories) are returned.
+    """
+    result = []
+    for path in paths:
+        if not os.path.isdir(path):
+            result.append(path)
+            continue
+
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+
+            for file_name in sorted(fnmatch.filter(file_names, pattern)):
+                result.append(os.path.join(dir_path, file_name))
+
+    return result
+
+
+def _load_template(template_path: str) -> Tuple[str, str, Callable[[], bool]]:
+    """
+    Template loader function which is used by the Jinja environment.
+    """
+    fingerprint = _get_file_fingerprint(template_path)
+    template_content = read_template(template_path)
+
+    def uptodate() -> bool:
+        return _get_file_fingerprint(template_path) == fingerprint
+
+    return template_content, template_path, uptodate
+
+
+def get_secrets_dict(
+    key_path: str, secrets_path: str, key_password: Optional[str] = None, dummy: bool = False
+) -> Union[DecryptSecretsDict, DummySecretsDict]:
+    """
+    Return secrets dictionary which is passed to the templates.
+
+    The same dictionary can be shared by multiple renders so each secret is only decrypted once.
+    """
+    if dummy:
+        return DummySecretsDict(key_value="dummy")
+
+    return DecryptSecretsDict(
+        key_path=key_path, secrets_path=secrets_path, key_password=key_password
+    )
+
+
+def _get_file_digest(file_path: str) -> Optional[str]:
+    """
+    Return SHA256 digest of the provided file (or None if it doesn't exist).
+
+    File is read in fixed size chunks so memory usage doesn't depend on the file size.
+    """
+    file_hash = hashlib.sha256()
+
+    try:
+        with open(file_path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(RENDER_WRITE_BUFFER_SIZE), b""):
+                file_hash.update(chunk)
+    except FileNotFoundError:
+        return None
+
+    return file_hash.hexdigest()
+
+
+def _get_render_inputs_digest(
+    secrets_dict: Union[DecryptSecretsDict, DummySecretsDict],
+    template_content: str,
+    ensure_permissions: str,
+) -> str:
+    """
+    Return digest of all the inputs which affect the rendered output.
+    """
+    if isinstance(secrets_dict, DecryptSecretsDict):
+        secrets_inputs = [
+            "key:%s" % (_get_file_digest(secrets_dict._key_path)),
+            "secrets:%s" % (_get_file_digest(secrets_dict._secrets_path)),
+        ]
+
+        journal_digest = _get_file_digest(get_journal_path(secrets_dict._secrets_path))
+
+        if journal_digest:
+            secrets_inputs.append("secrets_journal:%s" % (journal_digest))
+    else:
+        secrets_inputs = ["dummy:%s" % (secrets_dict._key_value)]
+
+    inputs = [
+        "template:%s" % (hashlib.sha256(template_content.encode("utf-8")).hexdigest()),
+        "permissions:%s" % (ensure_permissions),
+    ] + secrets_inputs
+
+    return hashlib.sha256("\n".join(inputs).encode("utf-8")).hexdigest()
+
+
+def _get_file_fingerprint(file_path: str) -> Optional[tuple]:
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+
+def read_template(template_path: str) -> str:
+    """
+    Return content of the provided template file.
+    """
+    with open(template_path, "rb") as fp:
+        return fp.read().decode("utf-8")
+
+
+def _render_template_file(
+    secrets_dict: Union[DecryptSecretsDict, DummySecretsDict],
+    template_path: str,
+    destination_path: str,
+    ensure_permissions: str = "600",
+    prefetch: bool = False,
+    prefetch_workers: Optional[int] = None,
+    prefetch_executor: str = "thread",
+    skip_unchanged: bool = True,
+    render_state: Optional[RenderState] = None,
+    bytecode_cache_dir: Optional[str] = None,
+) -> str:
+    lock_path = get_template_file_lock_path(destination_path)
+    lock = FileLock(lock_path, timeout=get_lock_timeout())
+
+    with lock:
+        return render_template_file_locked(
+            secrets_dict=secrets_dict,
+            template_path=template_path,
+            destination_path=destination_path,
+            ensure_permissions=ensure_permissions,
+            prefetch=prefetch,
+            prefetch_workers=prefetch_workers,
+            prefetch_executor=prefetch_executor,
+            skip_unchanged=skip_unchanged,
+            render_state=render_state,
+            bytecode_cache_dir=bytecode_cache_dir,
+        )
+
+
+def render_template_file_locked(
+    secrets_dict: Union[DecryptSecretsDict, DummySecretsDict],
+    template_path: str,
+    destination_path: str,
+    ensure_permissions: str = "600",
+    prefetch: bool = False,
+    prefetch_workers: Optional[int] = None,
+    prefetch_executor: str = "thread",
+    skip_unchanged: bool = True,
+    render_state: Optional[RenderState] = None,
+    bytecode_cache_dir: Optional[str] = None,
+) -> str:
+    """
+    Render the provided template file using the provided secrets dictionary (see
+    get_secrets_dict).
+
+    Caller needs to hold the destination file lock (see utils.get_template_file_lock_path). This
+    allows callers to acquire the lock in a different way (e.g. without blocking the event loop).
+    """
+    if template_path == destination_path:
+        raise ValueError("Template and destination paths cannot be the same")
+
+    permissions = int(ensure_permissions, 8)
+
+    # 1. Load compose template file
+    with profiling.phase("read_template"):
+        template_content = read_template(template_path)
+
+    inputs_digest = None
+    if render_state:
+        inputs_digest = _get_render_inputs_digest(
+            secrets_dict, template_content, ensure_permissions
+        )
+
+        if render_state.is_up_to_date(
+            destination_path=destination_path, inputs_digest=inputs_digest
+        ):
+            _ensure_permissions(destination_path, permissions)
+            profiling.increment("skipped_renders")
+            print("Inputs for %s haven't changed, skipping render" % (destination_path))
+            return destination_path
+
+    # 2. Render the template with secrets
+    template_context = {SECRETS_VARIABLE_NAME: secrets_dict}
+
+    env = get_environment(bytecode_cache_dir=bytecode_cache_dir)
+
+    with profiling.phase("compile_template"):
+        template = env.get_template(os.path.abspath(template_path))
+
+    if prefetch and isinstance(secrets_dict, DecryptSecretsDict):
+        keys = get_referenced_secrets(template_content=template_content, env=env)
+        secrets_dict.prefetch(keys=keys, max_workers=prefetch_workers, executor=prefetch_executor)
+
+    # 3. Stream rendered template to the destination file. Output is compared with the existing
+    # destination file as it's being rendered and a temporary file is only created once they
+    # differ, so the whole rendered output never needs to be held in memory and unchanged renders
+    # don't touch the destination directory at all.
+    output_hash = hashlib.sha256()
+
+    with _DestinationFileWriter(
+        file_path=destination_path, permissions=permissions, compare=skip_unchanged
+    ) as writer:
+        with profiling.phase("render_template"):
+            for chunk in template.generate(**template_context):
+                data = chunk.encode("utf-8")
+                output_hash.update(data)
+                writer.write(data)
+
+        profiling.increment("rendered_templates")
+        output_digest = output_hash.hexdigest()
+
+        with profiling.phase("write_destination_file"):
+            changed = writer.finish()
+
+    if not changed:
+        _ensure_permissions(destination_path, permissions)
+
+        if render_state and inputs_digest:
+            render_state.update(destination_path, inputs_digest, output_digest)
+
+        profiling.increment("skipped_writes")
+        print("Rendered template %s hasn't changed, skipping write" % (destination_path))
+        return destination_path
+
+    if render_state and inputs_digest:
+        render_state.update(destination_path, inputs_digest, output_digest)
 
     print("Rendered template saved to %s" % (destination_path))
 
     return destination_path
+
+
+class _DestinationFileWriter(object):
+    """
+    Write streamed content to the destination file, but only if it differs from the existing
+    destination file content.
+
+    Written data is compared with the existing file as it's being streamed. Temporary file (see
+    AtomicFileWriter) is only created on the first difference - the matching prefix is then copied
+    over from the existing file. This means memory usage doesn't depend on the output size and
+    unchanged output doesn't create any files in the destination directory.
+    """
+
+    def __init__(self, file_path: str, permissions: int, compare: bool = True) -> None:
+        self.file_path = file_path
+        self.permissions = permissions
+        self.compare = compare
+
+        self._existing_file: Optional[BinaryIO] = None
+        self._matched_size = 0
+        self._writer: Optional[AtomicFileWriter] = None
+
+    def __enter__(self) -> "_DestinationFileWriter":
+        if self.compare:
+            try:
+                self._existing_file = open(self.file_path, "rb")
+            except FileNotFoundError:
+                pass
+
+        return self
+
+    def write(self, data: bytes) -> None:
+        if self._writer is None and self._existing_file is not None:
+            if self._existing_file.read(len(data)) == data:
+                self._matched_size += len(data)
+                return
+
+        if self._writer is None:
+            self._open_writer()
+
+        assert self._writer is not None
+        self._writer.write(data)
+
+    def finish(self) -> bool:
+        """
+        Move written data to the final location (if it differs from the existing content) and
+        return True if the destination file has been written.
+        """
+        if self._writer is None and self._existing_file is not None:
+            if self._existing_file.read(1) == b"":
+                self._close_existing_file()
+                return False
+
+        if self._writer is None:
+            self._open_writer()
+
+        assert self._writer is not None
+        self._writer.commit()
+        self._writer = None
+
+        return True
+
+    def _open_writer(self) -> None:
+        self._writer = AtomicFileWriter(
+            file_path=self.file_path,
+            permissions=self.permissions,
+            buffer_size=RENDER_WRITE_BUFFER_SIZE,
+        ).__enter__()
+
+        if self._existing_file is not None:
+            self._existing_file.seek(0)
+            remaining = self._matched_size
+
+            while remaining > 0:
+                chunk = self._existing_file.read(min(remaining, RENDER_WRITE_BUFFER_SIZE))
+
+                if not chunk:
+                    raise IOError("Destination file %s changed during render" % (self.file_path))
+
+                self._writer.write(chunk)
+                remaining -= len(chunk)
+
+        self._close_existing_file()
+
+    def _close_existing_file(self) -> None:
+        if self._existing_file is not None:
+            self._existing_file.close()
+            self._existing_file = None
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self._close_existing_file()
+
+        if self._writer is not None:
+            self._writer.discard()
+            self._writer = None
+
+
+def _ensure_permissions(file_path: str, permissions: int) -> None:
+    """
+    Change file permissions, but only if they differ to avoid needlessly touching the file.
+    """
+    if os.stat(file_path).st_mode & 0o7777 != permissions:
+        os.chmod(file_path, permissions)
+
+
+def get_referenced_secrets(template_content: str, env: Optional[Environment] = None) -> Set[str]:
+    """
+    Statically find names of all the secrets which are referenced in the provided template content
+    (e.g. {{ secrets.KEY }} or {{ secrets["KEY"] }}).
+
+    Keep in mind that secrets which are referenced dynamically (e.g. {{ secrets[name] }}) can't be
+    found this way.
+    """
+    result, _ = find_referenced_secrets(template_content=template_content, env=env)
+    return result
+
+
+def find_referenced_secrets(
+    template_content: str, env: Optional[Environment] = None
+) -> Tuple[Set[str], bool]:
+    """
+    Same as get_referenced_secrets, but return a tuple of (referenced secret names, True if all
+    the references are static).
+
+    If the flag is False, template also references secrets dynamically (e.g. {{ secrets[name] }})
+    and the returned names are incomplete.
+    """
+    env = env or Environment()
+    ast = env.parse(template_content)
+
+    result = set([])
+    static_references_count = 0
+
+    for getattr_node in ast.find_all(nodes.Getattr):
+        if _is_secrets_variable(getattr_node.node):
+            result.add(getattr_node.attr)
+            static_references_count += 1
+
+    for getitem_node in ast.find_all(nodes.Getitem):
+        if _is_secrets_variable(getitem_node.node):
+            arg = getitem_node.arg
+
+            if isinstance(arg, nodes.Const) and isinstance(arg.value, str):
+                result.add(arg.value)
+                static_references_count += 1
+
+    references_count = len(
+        [node for node in ast.find_all(nodes.Name) if _is_secrets_variable(node)]
+    )
+
+    return result, references_count == static_references_count
+
+
+def _is_secrets_variable(node: nodes.Node) -> bool:
+    return isinstance(node, nodes.Name) and node.name == SECRETS_VARIABLE_NAME
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Append-only journal for YAML secrets files.
+
+Each mutation (secrets set / removed) is appended to a journal file next to the secrets file as a
+single JSON record. Readers replay the journal on top of the base secrets file (snapshot) and
+the journal is folded back into the snapshot (compacted) once it grows past a threshold.
+"""
+
+import json
+import os
+from typing import Dict, List, Optional
+
+from dcsm import profiling
+from dcsm.utils import (
+    FSYNC_POLICY_FULL,
+    FSYNC_POLICY_NONE,
+    fsync_directory,
+    get_fsync_policy,
+)
+
+__all__ = [
+    "get_journal_path",
+    "get_journal_size",
+    "append_record",
+    "replay",
+    "remove_journal",
+]
+
+# Suffix which is added to the secrets file path to get the journal file path
+JOURNAL_SUFFIX = ".journal"
+
+# Journal is compacted into the snapshot once it grows past this size (in bytes)
+DEFAULT_COMPACTION_THRESHOLD = 256 * 1024
+
+
+def get_journal_path(secrets_path: str) -> str:
+    return secrets_path + JOURNAL_SUFFIX
+
+
+def get_journal_size(journal_path: str) -> int:
+    """
+    Return journal size in bytes (0 if journal doesn't exist).
+    """
+    try:
+        return os.stat(journal_path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def append_record(
+    journal_path: str,
+    updates: Dict[str, object],
+    removed_keys: Optional[List[str]] = None,
+    fsync_policy: Optional[str] = None,
+) -> int:
+    """
+    Append a single mutation record to the journal and return the journal size after the append
+    (caller needs to hold the secrets file lock).
+    """
+    fsync_policy = get_fsync_policy(fsync_policy)
+
+    record = {"set": updates, "remove": removed_keys or []}
+    data = (json.dumps(record, sort_keys=True) + "\n").encode("utf-8")
+
+    with profiling.phase("append_secrets_journal"):
+        created = not os.path.exists(journal_path)
+        fd = os.open(journal_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+
+        try:
+            _truncate_partial_record(fd)
+            os.write(fd, data)
+
+            if fsync_policy != FSYNC_POLICY_NONE:
+                os.fsync(fd)
+
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+        if created and fsync_policy == FSYNC_POLICY_FULL:
+            fsync_directory(os.path.dirname(os.path.abspath(journal_path)))
+
+    return size
+
+
+def replay(journal_path: str, content: dict) -> dict:
+    """
+    Apply all the journal records to the provided secrets file content (in place).
+
+    Incomplete last record (e.g. process crashed in the middle of the append) is ignored.
+    """
+    try:
+        with open(journal_path, "rb") as fp:
+            data = fp.read()
+    except FileNotFoundError:
+        return content
+
+    with profiling.phase("replay_secrets_journal"):
+        lines = data.split(b"\n")
+
+        # Last item is either empty (journal ends with a new line) or an incomplete record
+        for line_number, line in enumerate(lines[:-1], 1):
+            if not line.strip():
+                continue
+
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                raise ValueError("Journal %s is corrupted (line %s)" % (journal_path, line_number))
+
+            content.update(record.get("set", {}))
+
+            for key in record.get("remove", []):
+                content.pop(key, None)
+
+    return content
+
+
+def remove_journal(journal_path: str) -> None:
+    """
+    Remove journal once it has been folded into the snapshot.
+    """
+    try:
+        os.unlink(journal_path)
+    except FileNotFoundError:
+        pass
+
+
+def _truncate_partial_record(fd: int) -> None:
+    """
+    Remove incomplete trailing record (if any) so the next record starts on a new line.
+    """
+    size = os.fstat(fd).st_size
+
+    if size == 0 or os.pread(fd, 1, size - 1) == b"\n":
+        return
+
+    data = os.pread(fd, size, 0)
+    os.ftruncate(fd, data.rfind(b"\n") + 1)
@@ -14,11 +14,7 @@
 # limitations under the License.
 
 import os
-from typing import Optional, Tuple
-
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from typing import Optional, Tuple, Union
 
 from dcsm.utils import write_to_file
 
@@ -26,15 +22,29 @@ __all__ = ["generate_key_pair"]
 
 KEY_SIZE = 8192
 
+KEY_TYPE_RSA = "rsa"
+KEY_TYPE_X25519 = "x25519"
+KEY_TYPES = [KEY_TYPE_RSA, KEY_TYPE_X25519]
+
 
 def generate_key_pair(
-    path: str, password: Optional[str] = None, overwrite: bool = False
+    path: str, password: Optional[str] = None, overwrite: bool = False, key_type: str = KEY_TYPE_RSA
 ) -> Tuple[str, str]:
     """
     Generate a new public and private key pair and write result to a file.
+
+    X25519 key pairs are much faster to generate and use than RSA ones. Secrets encrypted with
+    X25519 keys always use envelope format.
     """
-    assert KEY_SIZE >= 4096
-    print("Generating 8192 bit key pair, this may take a while...")
+    # NOTE: cryptography is imported lazily so key type constants can be imported without it
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa, x25519
+
+    if key_type not in KEY_TYPES:
+        raise ValueError(
+            "Unsupported key type: %s. Valid types are: %s" % (key_type, ", ".join(KEY_TYPES))
+        )
 
     private_key_path = os.path.expanduser(os.path.join(path, "private_key.pem"))
     public_key_path = os.path.expanduser(os.path.join(path, "public_key.pem"))
@@ -49,9 +59,21 @@ def generate_key_pair(
             "File %s exists and --overwrite flag was not used, aborting." % (public_key_path)
         )
 
-    private_key = rsa.generate_private_key(
-        public_exponent=65537, key_size=KEY_SIZE, backend=default_backend()
-    )
+    private_key: Union[rsa.RSAPrivateKey, x25519.X25519PrivateKey]
+
+    if key_type == KEY_TYPE_X25519:
+        print("Generating X25519 key pair...")
+        private_key = x25519.X25519PrivateKey.generate()
+        # X25519 keys can't be serialized using traditional OpenSSL format
+        unencrypted_format = serialization.PrivateFormat.PKCS8
+    else:
+        assert KEY_SIZE >= 4096
+        print("Generating 8192 bit key pair, this may take a while...")
+        private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=KEY_SIZE, backend=default_backend()
+        )
+        unencrypted_format = serialization.PrivateFormat.TraditionalOpenSSL
+
     public_key = private_key.public_key()
 
     if password:
@@ -63,7 +85,7 @@ def generate_key_pair(
     else:
         private_key_pem = private_key.private_bytes(
             encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            format=unencrypted_format,
             encryption_algorithm=serialization.NoEncryption(),
         )
 
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shared / exclusive (reader / writer) file locks based on fcntl.flock.
+
+Readers (e.g. renders which parse the secrets file) acquire a shared lock so they can run in
+parallel and writers acquire an exclusive lock. Lock wait times are recorded by the profiler.
+"""
+
+import contextlib
+import fcntl
+import os
+import time
+from typing import Iterator, Optional
+
+from filelock import Timeout
+
+from dcsm import profiling
+from dcsm.utils import get_secrets_lock_file_path
+
+__all__ = [
+    "ReadWriteFileLock",
+    "LockTimeout",
+    "get_lock_timeout",
+    "get_secrets_file_lock",
+]
+
+# Environment variable which can be used to override the default lock timeout (in seconds)
+LOCK_TIMEOUT_ENV_VARIABLE = "DCSM_LOCK_TIMEOUT"
+
+# Default number of seconds to wait for a lock
+DEFAULT_LOCK_TIMEOUT = 10.0
+
+# Initial and maximum delay between lock acquire attempts (in seconds)
+LOCK_POLL_INTERVAL = 0.005
+LOCK_MAX_POLL_INTERVAL = 0.1
+
+LOCK_MODE_SHARED = "shared"
+LOCK_MODE_EXCLUSIVE = "exclusive"
+
+
+class LockTimeout(Timeout):
+    """
+    Raised when a lock can't be acquired in time.
+
+    Extends filelock.Timeout so existing code which catches that exception keeps working.
+    """
+
+    def __init__(self, lock_file: str, mode: str, timeout: float) -> None:
+        super(LockTimeout, self).__init__(lock_file)
+        self.mode = mode
+        self.timeout = timeout
+
+    def __str__(self) -> str:
+        return "Timed out after %.2f seconds waiting for %s lock on %s" % (
+            self.timeout,
+            self.mode,
+            self.lock_file,
+        )
+
+
+class ReadWriteFileLock(object):
+    """
+    File lock which can be acquired in a shared (read) or an exclusive (write) mode.
+
+    Each acquisition uses a new file descriptor which means the lock can be used concurrently from
+    multiple threads, but it's not re-entrant (acquiring a shared lock while holding an exclusive
+    lock for the same file will block).
+    """
+
+    def __init__(self, lock_path: str, timeout: Optional[float] = None) -> None:
+        self.lock_path = lock_path
+        self.timeout = timeout
+
+        # Number of seconds it took to acquire the lock the last time it was acquired
+        self.last_wait_time: Optional[float] = None
+
+    def shared(self, timeout: Optional[float] = None) -> "contextlib._GeneratorContextManager":
+        return self._acquire(mode=LOCK_MODE_SHARED, timeout=timeout)
+
+    def exclusive(self, timeout: Optional[float] = None) -> "contextlib._GeneratorContextManager":
+        return self._acquire(mode=LOCK_MODE_EXCLUSIVE, timeout=timeout)
+
+    @contextlib.contextmanager
+    def _acquire(self, mode: str, timeout: Optional[float] = None) -> Iterator[None]:
+        timeout = get_lock_timeout(timeout if timeout is not None else self.timeout)
+        operation = fcntl.LOCK_SH if mode == LOCK_MODE_SHARED else fcntl.LOCK_EX
+
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            with profiling.phase("%s_lock_wait" % (mode)):
+                self.last_wait_time = _flock(
+                    fd=fd,
+                    operation=operation,
+                    timeout=timeout,
+                    lock_path=self.lock_path,
+                    mode=mode,
+                )
+
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+def get_lock_timeout(timeout: Optional[float] = None) -> float:
+    """
+    Return lock timeout which should be used.
+
+    Explicitly provided value has precedence over the value from the environment variable. Negative
+    value means wait forever.
+    """
+    if timeout is not None:
+        return timeout
+
+    value = os.environ.get(LOCK_TIMEOUT_ENV_VARIABLE, None)
+
+    if value:
+        return float(value)
+
+    return DEFAULT_LOCK_TIMEOUT
+
+
+def get_secrets_file_lock(secrets_path: str, timeout: Optional[float] = None) -> ReadWriteFileLock:
+    """
+    Return reader / writer lock for the provided secrets file.
+    """
+    return ReadWriteFileLock(lock_path=get_secrets_lock_file_path(secrets_path), timeout=timeout)
+
+
+def _flock(fd: int, operation: int, timeout: float, lock_path: str, mode: str) -> float:
+    """
+    Acquire lock on the provided file descriptor and return number of seconds it took.
+    """
+    start_time = time.monotonic()
+    poll_interval = LOCK_POLL_INTERVAL
+
+    while True:
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            pass
+
+        wait_time = time.monotonic() - start_time
+
+        if poll_interval == LOCK_POLL_INTERVAL:
+            profiling.increment("%s_lock_contentions" % (mode))
+
+        if timeout >= 0 and wait_time >= timeout:
+            raise LockTimeout(lock_file=lock_path, mode=mode, timeout=timeout)
+
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, LOCK_MAX_POLL_INTERVAL)
+
+    return time.monotonic() - start_time
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Metadata keys which are stored next to the secrets in the secrets file content.
+
+Shared by the YAML and SQLite secrets file formats.
+"""
+
+import datetime
+from typing import List
+
+__all__ = [
+    "get_secret_keys",
+    "format_updated_at",
+]
+
+# Suffixes of the per secret metadata keys (old secrets files use "_updated" instead of
+# "_updated_at")
+UPDATED_AT_SUFFIX = "_updated_at"
+UPDATED_BY_SUFFIX = "_updated_by"
+LEGACY_UPDATED_AT_SUFFIX = "_updated"
+
+METADATA_KEY_SUFFIXES = [UPDATED_AT_SUFFIX, UPDATED_BY_SUFFIX, LEGACY_UPDATED_AT_SUFFIX]
+
+# Top level (file) metadata keys
+METADATA_KEYS = ["updated_at"]
+
+
+def get_secret_keys(content: dict) -> List[str]:
+    """
+    Return sorted keys of all the secrets in the provided secrets file content (metadata keys such
+    as "updated_at" and "<key>_updated_at" are excluded).
+    """
+    result = []
+
+    for key in content.keys():
+        if key in METADATA_KEYS:
+            continue
+
+        if any(
+            key.endswith(suffix) and key[: -len(suffix)] in content
+            for suffix in METADATA_KEY_SUFFIXES
+        ):
+            continue
+
+        result.append(key)
+
+    return sorted(result)
+
+
+def format_updated_at(timestamp: int) -> str:
+    """
+    Return "<key>_updated_at" value for the provided unix timestamp.
+
+    Format: "<date> UTC # <timestamp>"
+    """
+    date_dt = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+    return "%s # %s" % (date_dt.strftime("%Y-%m-%d %H:%M:%S UTC"), timestamp)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Optional per-phase instrumentation.
+
+When profiling is enabled, instrumented functions record how much time was spent in each phase
+(e.g. key loading, secrets file parsing, decryption, template compilation, rendering and file
+writes) and increment counters (e.g. number of decryptions and cache hits). When no profiler is
+active, instrumentation has close to zero overhead.
+
+Example usage:
+
+    with profiling.profile() as profiler:
+        render_template_file(...)
+
+    print(profiler.to_json())
+
+Profilers are process wide which means operations which run in other threads (e.g. prefetch
+thread pool) are also recorded. Operations which run in other processes are not.
+"""
+
+import contextlib
+import json
+import sys
+import threading
+import time
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, TextIO
+
+__all__ = [
+    "Profiler",
+    "ProfileCallback",
+    "profile",
+    "profile_report",
+    "start_profiling",
+    "stop_profiling",
+    "phase",
+    "increment",
+]
+
+EVENT_TYPE_PHASE = "phase"
+EVENT_TYPE_COUNTER = "counter"
+
+# Callback which is called with (event type, name, value) for each recorded event. For phases,
+# value is duration in seconds and for counters, value is the increment.
+ProfileCallback = Callable[[str, str, float], None]
+
+_ACTIVE_PROFILERS: List["Profiler"] = []
+_ACTIVE_PROFILERS_LOCK = threading.Lock()
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Profiler(object):
+    """
+    Class which records per-phase durations and counters.
+
+    Phases can be nested (e.g. "decrypt" phase includes "load_private_key" phase on a cache miss)
+    so durations of different phases shouldn't be summed.
+    """
+
+    def __init__(self, callback: Optional[ProfileCallback] = None):
+        self.callback = callback
+
+        self._phases: Dict[str, Dict[str, float]] = {}
+        self._counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._start_time = time.perf_counter()
+        self._end_time: Optional[float] = None
+
+    def record_phase(self, name: str, duration: float) -> None:
+        with self._lock:
+            stats = self._phases.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["total"] += duration
+            stats["max"] = max(stats["max"], duration)
+
+        if self.callback:
+            self.callback(EVENT_TYPE_PHASE, name, duration)
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+        if self.callback:
+            self.callback(EVENT_TYPE_COUNTER, name, value)
+
+    def stop(self) -> None:
+        self._end_time = time.perf_counter()
+
+    def to_dict(self) -> Dict[str, Any]:
+        end_time = self._end_time or time.perf_counter()
+
+        with self._lock:
+            phases = {
+                name: {
+                    "count": int(stats["count"]),
+                    "total_seconds": round(stats["total"], 6),
+                    "max_seconds": round(stats["max"], 6),
+                }
+                for name, stats in sorted(self._phases.items())
+            }
+            counters = dict(sorted(self._counters.items()))
+
+        return {
+            "total_seconds": round(end_time - self._start_time, 6),
+            "phases": phases,
+            "counters": counters,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+
+def start_profiling(callback: Optional[ProfileCallback] = None) -> Profiler:
+    """
+    Create a new profiler and start recording events to it.
+    """
+    profiler = Profiler(callback=callback)
+
+    with _ACTIVE_PROFILERS_LOCK:
+        _ACTIVE_PROFILERS.append(profiler)
+
+    return profiler
+
+
+def stop_profiling(profiler: Profiler) -> None:
+    """
+    Stop recording events to the provided profiler.
+    """
+    profiler.stop()
+
+    with _ACTIVE_PROFILERS_LOCK:
+        if profiler in _ACTIVE_PROFILERS:
+            _ACTIVE_PROFILERS.remove(profiler)
+
+
+@contextlib.contextmanager
+def profile(callback: Optional[ProfileCallback] = None) -> Iterator[Profiler]:
+    """
+    Context manager which records all the events inside the block to a new profiler.
+    """
+    profiler = start_profiling(callback=callback)
+
+    try:
+        yield profiler
+    finally:
+        stop_profiling(profiler)
+
+
+@contextlib.contextmanager
+def profile_report(
+    enabled: bool = True, stream: Optional[TextIO] = None
+) -> Iterator[Optional[Profiler]]:
+    """
+    Context manager which writes JSON report for all the events inside the block to the provided
+    stream (standard error by default) if enabled is True.
+    """
+    if not enabled:
+        yield None
+        return
+
+    with profile() as profiler:
+        try:
+            yield profiler
+        finally:
+            stop_profiling(profiler)
+            print(profiler.to_json(), file=stream or sys.stderr)
+
+
+def phase(name: str) -> ContextManager[Any]:
+    """
+    Return context manager which records duration of the block under the provided phase name.
+    """
+    if not _ACTIVE_PROFILERS:
+        return _NULL_CONTEXT
+
+    return _record_phase(name)
+
+
+def increment(name: str, value: int = 1) -> None:
+    """
+    Increment the provided counter for all the active profilers.
+    """
+    if not _ACTIVE_PROFILERS:
+        return
+
+    for profiler in list(_ACTIVE_PROFILERS):
+        profiler.increment(name, value)
+
+
+@contextlib.contextmanager
+def _record_phase(name: str) -> Iterator[None]:
+    start_time = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start_time
+
+        for profiler in list(_ACTIVE_PROFILERS):
+            profiler.record_phase(name, duration)
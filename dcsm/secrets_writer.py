@@ -13,82 +13,176 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import datetime
+import collections
+import contextlib
+import functools
 import getpass
+import math
 import os
-import shutil
 import socket
-import tempfile
+import threading
 import time
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, ContextManager, Dict, List, Optional, Tuple, Union
 
 import yaml
-from filelock import FileLock
 
-from dcsm.decryption import decrypt_secret
-from dcsm.encryption import encrypt_secret
-from dcsm.utils import get_secrets_lock_file_path, write_to_file
+try:
+    # Use libyaml backed loader and dumper if available, they are an order of magnitude faster
+    from yaml import CSafeDumper as YAMLDumper
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeDumper as YAMLDumper  # type: ignore
+    from yaml import SafeLoader as YAMLLoader  # type: ignore
+
+from dcsm import profiling, sqlite_store
+from dcsm.journal import (
+    DEFAULT_COMPACTION_THRESHOLD,
+    append_record,
+    get_journal_path,
+    remove_journal,
+    replay,
+)
+from dcsm.locking import get_secrets_file_lock
+from dcsm.metadata import (
+    LEGACY_UPDATED_AT_SUFFIX,
+    UPDATED_AT_SUFFIX,
+    format_updated_at,
+    get_secret_keys,
+)
+from dcsm.utils import write_to_file
+
+__all__ = [
+    "encrypt_and_write_to_file",
+    "encrypt_and_write_many_to_file",
+    "remove_secret_from_file",
+    "decrypt_secret_from_file",
+    "convert_secrets_file",
+    "compact_secrets_file",
+    "rotate_secrets_file",
+    "get_secret_keys",
+    "secrets_file_exists",
+    "get_file_content",
+    "get_cached_file_content",
+    "clear_file_content_cache",
+]
+
+# Maximum number of parsed secrets files which are cached in memory
+FILE_CONTENT_CACHE_MAX_SIZE = 32
+
+# Maps absolute file path to a tuple of (secrets file and journal stat fingerprint, parsed file
+# content)
+_FILE_CONTENT_CACHE: "collections.OrderedDict[str, Tuple[tuple, dict]]" = collections.OrderedDict()
+_FILE_CONTENT_CACHE_LOCK = threading.Lock()
+
+
+def encrypt_and_write_to_file(
+    key_path: Union[str, List[str]],
+    secrets_path: str,
+    key: str,
+    value: str,
+    envelope_format: bool = False,
+    lock_timeout: Optional[float] = None,
+    journal: bool = False,
+    compaction_threshold: Optional[int] = None,
+) -> None:
+    """
+    Encrypt secret value and write it to the provided YAML file with secrets.
 
-__all__ = ["encrypt_and_write_to_file", "remove_secret_from_file"]
+    If multiple public key paths are provided, the secret can be decrypted with any of the
+    corresponding private keys.
 
+    If journal is True, the change is appended to the secrets file journal instead of re-writing
+    the whole file. Journal is compacted into the file once it grows past compaction_threshold
+    bytes.
+    """
+    # NOTE: cryptography related modules are imported lazily so commands which don't need them
+    # (e.g. removing a secret) start faster
+    from dcsm.encryption import encrypt_secret
 
-class BackupFile(object):
-    def __init__(self, file_path):
-        self.file_path = file_path
-        _, self.tmp_path = tempfile.mkstemp(suffix=".bak")
-        os.chmod(self.tmp_path, 0o600)
+    lock = get_secrets_file_lock(secrets_path, timeout=lock_timeout)
 
-    def __enter__(self):
-        if os.path.isfile(self.file_path):
-            shutil.copyfile(self.file_path, self.tmp_path)
+    with lock.exclusive():
+        # 1. Encrypt the secret
+        ciphertext = encrypt_secret(key_path=key_path, value=value, envelope_format=envelope_format)
+
+        # 2. Merge the new value in and save updated file content on disk
+        _store_secrets(
+            secrets_path=secrets_path,
+            ciphertexts={key: ciphertext},
+            journal=journal,
+            compaction_threshold=compaction_threshold,
+        )
 
-    def __exit__(self, type, value, traceback):
-        os.unlink(self.tmp_path)
+        print('Encrypted secret "%s" written to %s' % (key, secrets_path))
 
 
-def encrypt_and_write_to_file(key_path: str, secrets_path: str, key: str, value: str) -> None:
+def encrypt_and_write_many_to_file(
+    key_path: Union[str, List[str]],
+    secrets_path: str,
+    secrets: Dict[str, str],
+    envelope_format: bool = False,
+    max_workers: Optional[int] = None,
+    lock_timeout: Optional[float] = None,
+    journal: bool = False,
+    compaction_threshold: Optional[int] = None,
+) -> None:
     """
-    Encrypt secret value and write it to the provided YAML file with secrets.
+    Encrypt multiple secret values and write all of them to the provided YAML file with secrets
+    in a single transaction.
+
+    File lock is acquired once, existing file is parsed once and updated file is written once. If
+    envelope_format is True, all the secrets share the same data key.
     """
-    lock_path = get_secrets_lock_file_path(secrets_path)
-    lock = FileLock(lock_path, timeout=10)
+    from dcsm.encryption import encrypt_secrets
 
-    with lock:
-        # 1. Encrypt the secret
-        ciphertext = encrypt_secret(key_path=key_path, value=value)
+    lock = get_secrets_file_lock(secrets_path, timeout=lock_timeout)
 
-        # 2. Read existing file content
-        content = get_file_content(secrets_path)
+    keys = list(secrets.keys())
 
-        now_dt = datetime.datetime.utcnow()
-        now_ts = int(time.time())
-        now_string = now_dt.strftime("%Y-%m-%d %H:%M:%S UTC")
-
-        updated_at = "%s # %s" % (now_string, now_ts)
+    with lock.exclusive():
+        # 1. Encrypt the secrets
+        ciphertexts = encrypt_secrets(
+            key_path=key_path,
+            values=[secrets[key] for key in keys],
+            envelope_format=envelope_format,
+            max_workers=max_workers,
+        )
 
-        # 3. Merge the new value in
-        updated_by = "%s@%s" % (getpass.getuser(), socket.gethostname())
-        content["%s_updated_at" % (key)] = updated_at
-        content["%s_updated_by" % (key)] = updated_by
-        content[key] = ciphertext
-        content["updated_at"] = now_ts
-        content = dict(sorted(content.items()))
+        # 2. Merge the new values in and save updated file content on disk
+        _store_secrets(
+            secrets_path=secrets_path,
+            ciphertexts=dict(zip(keys, ciphertexts)),
+            journal=journal,
+            compaction_threshold=compaction_threshold,
+        )
 
-        # 4. Save updated file content on dsik
-        result = yaml.safe_dump(content, default_flow_style=False, explicit_start=True)
+        print("%s encrypted secrets written to %s" % (len(keys), secrets_path))
 
-        with BackupFile(secrets_path):
-            write_to_file(file_path=secrets_path, permissions=0o600, content=result.encode("utf-8"))
 
-        print('Encrypted secret "%s" written to %s' % (key, secrets_path))
+def remove_secret_from_file(
+    secrets_path: str,
+    key: str,
+    lock_timeout: Optional[float] = None,
+    journal: bool = False,
+    compaction_threshold: Optional[int] = None,
+) -> bool:
+    lock = get_secrets_file_lock(secrets_path, timeout=lock_timeout)
 
+    with lock.exclusive():
+        if sqlite_store.is_sqlite_path(secrets_path):
+            if not sqlite_store.remove_secret(secrets_path, key, now_ts=int(time.time())):
+                raise ValueError('File %s doesn\'t contain secret "%s"' % (secrets_path, key))
 
-def remove_secret_from_file(secrets_path: str, key: str) -> bool:
-    lock_path = get_secrets_lock_file_path(secrets_path)
-    lock = FileLock(lock_path, timeout=10)
+            clear_file_content_cache(secrets_path)
+            print('Secret "%s" removed from file %s' % (key, secrets_path))
+            return True
 
-    with lock:
-        content = get_file_content(secrets_path)
+        if journal:
+            # Content is only used to check if the secret exists so cached content can be used
+            content = _get_cached_file_content(secrets_path, lock=contextlib.nullcontext())
+        else:
+            content = get_file_content(secrets_path)
 
         if key not in content:
             raise ValueError('File %s doesn\'t contain secret "%s"' % (secrets_path, key))
@@ -99,47 +193,496 @@ def remove_secret_from_file(secrets_path: str, key: str) -> bool:
             "%s_updated_by" % (key),
         ]
 
-        for key_name in keys_to_remove:
-            if key_name in content:
-                del content[key_name]
-
         now_ts = int(time.time())
 
-        content["updated_at"] = now_ts
-        content = dict(sorted(content.items()))
-        result = yaml.safe_dump(content, default_flow_style=False, explicit_start=True)
-
-        with BackupFile(secrets_path):
-            write_to_file(file_path=secrets_path, permissions=0o600, content=result.encode("utf-8"))
+        if journal:
+            journal_size = append_record(
+                get_journal_path(secrets_path),
+                updates={"updated_at": now_ts},
+                removed_keys=keys_to_remove,
+            )
+            clear_file_content_cache(secrets_path)
+            _compact_if_needed(secrets_path, journal_size, compaction_threshold)
+        else:
+            for key_name in keys_to_remove:
+                if key_name in content:
+                    del content[key_name]
+
+            content["updated_at"] = now_ts
+            _write_file_content(secrets_path=secrets_path, content=content)
 
     print('Secret "%s" removed from file %s' % (key, secrets_path))
 
     return True
 
 
+def convert_secrets_file(
+    source_path: str, destination_path: str, lock_timeout: Optional[float] = None
+) -> None:
+    """
+    Convert secrets file from one format to another (e.g. import YAML secrets file into a SQLite
+    store or export SQLite store to a YAML file).
+
+    Format is determined based on the file extension.
+    """
+    if not secrets_file_exists(source_path):
+        raise ValueError("File %s doesn't exist" % (source_path))
+
+    if os.path.abspath(source_path) == os.path.abspath(destination_path):
+        raise ValueError("Source and destination paths cannot be the same")
+
+    # NOTE: Source file is read and its lock released before the destination lock is acquired so
+    # two conversions in the opposite directions can't deadlock
+    with get_secrets_file_lock(source_path, timeout=lock_timeout).shared():
+        content = get_file_content(source_path)
+
+    with get_secrets_file_lock(destination_path, timeout=lock_timeout).exclusive():
+        if sqlite_store.is_sqlite_path(destination_path):
+            sqlite_store.set_content(destination_path, content)
+            clear_file_content_cache(destination_path)
+        else:
+            _write_file_content(secrets_path=destination_path, content=content)
+
+    print("Secrets from %s written to %s" % (source_path, destination_path))
+
+
+def compact_secrets_file(secrets_path: str, lock_timeout: Optional[float] = None) -> bool:
+    """
+    Fold secrets file journal (if any) into the secrets file.
+
+    Returns True if the journal has been compacted and False if there was nothing to compact.
+    """
+    if sqlite_store.is_sqlite_path(secrets_path):
+        raise ValueError("SQLite secrets stores don't use a journal")
+
+    with get_secrets_file_lock(secrets_path, timeout=lock_timeout).exclusive():
+        if not os.path.isfile(get_journal_path(secrets_path)):
+            return False
+
+        _compact_secrets_file(secrets_path)
+
+    print("Journal compacted into %s" % (secrets_path))
+
+    return True
+
+
+def rotate_secrets_file(
+    old_key_path: str,
+    new_key_path: Union[str, List[str]],
+    secrets_path: str,
+    old_key_password: Optional[str] = None,
+    updated_since: Optional[int] = None,
+    envelope_format: bool = False,
+    max_workers: Optional[int] = None,
+    lock_timeout: Optional[float] = None,
+) -> List[str]:
+    """
+    Re-encrypt secrets in the provided secrets file with a new public key (key rotation).
+
+    Old private key and new public key are only loaded once, secrets are decrypted concurrently
+    using a process pool (max_workers, defaults to the number of CPUs) and the updated file is
+    written once. If updated_since (unix timestamp) is provided, only secrets which have been
+    updated after that time are re-encrypted.
+
+    Secrets keep their existing format unless envelope_format is True (in which case all the
+    secrets use envelope format). Legacy secrets which are too large for the new key are
+    re-encrypted using envelope format.
+
+    Returns a list of re-encrypted secret keys.
+    """
+    from dcsm.encryption import encrypt_secrets, get_legacy_secret_max_size
+    from dcsm.envelope import is_envelope_secret
+
+    if not secrets_file_exists(secrets_path):
+        raise ValueError("File %s doesn't exist" % (secrets_path))
+
+    with get_secrets_file_lock(secrets_path, timeout=lock_timeout).exclusive():
+        content = get_file_content(secrets_path)
+        keys = get_secret_keys(content)
+
+        if updated_since is not None:
+            keys = [
+                key for key in keys if (_get_secret_updated_at(content, key) or 0) > updated_since
+            ]
+
+        if keys:
+            plaintexts = _decrypt_secrets_concurrently(
+                key_path=old_key_path,
+                secrets=[content[key] for key in keys],
+                password=old_key_password,
+                max_workers=max_workers,
+            )
+            # Secrets keep their existing format (envelope secrets are never downgraded to legacy
+            # format) and legacy secrets which don't fit the new key are upgraded to envelope
+            legacy_max_size = None if envelope_format else get_legacy_secret_max_size(new_key_path)
+            use_envelope = [
+                legacy_max_size is None
+                or is_envelope_secret(content[key])
+                or len(plaintext.encode("utf-8")) > legacy_max_size
+                for key, plaintext in zip(keys, plaintexts)
+            ]
+
+            for envelope_group in [True, False]:
+                group = [
+                    (key, plaintext)
+                    for key, plaintext, is_envelope in zip(keys, plaintexts, use_envelope)
+                    if is_envelope == envelope_group
+                ]
+
+                if not group:
+                    continue
+
+                ciphertexts = encrypt_secrets(
+                    key_path=new_key_path,
+                    values=[plaintext for _, plaintext in group],
+                    envelope_format=envelope_group,
+                )
+
+                # NOTE: Per secret metadata is left as is since secret values haven't changed
+                content.update(zip([key for key, _ in group], ciphertexts))
+
+            content["updated_at"] = int(time.time())
+
+            if sqlite_store.is_sqlite_path(secrets_path):
+                with profiling.phase("write_secrets_file"):
+                    sqlite_store.set_content(secrets_path, content)
+
+                clear_file_content_cache(secrets_path)
+            else:
+                _write_file_content(secrets_path=secrets_path, content=content)
+
+    print("%s secrets in %s re-encrypted" % (len(keys), secrets_path))
+
+    return keys
+
+
+def secrets_file_exists(secrets_path: str) -> bool:
+    """
+    Return True if the secrets file (or its journal) exists.
+    """
+    if os.path.isfile(secrets_path):
+        return True
+
+    if sqlite_store.is_sqlite_path(secrets_path):
+        return False
+
+    return os.path.isfile(get_journal_path(secrets_path))
+
+
+def _store_secrets(
+    secrets_path: str,
+    ciphertexts: Dict[str, str],
+    journal: bool = False,
+    compaction_threshold: Optional[int] = None,
+) -> None:
+    """
+    Store provided encrypted secrets in the secrets file (caller needs to hold the file lock).
+    """
+    if sqlite_store.is_sqlite_path(secrets_path):
+        updated_at, updated_by, now_ts = _get_update_metadata()
+
+        with profiling.phase("write_secrets_file"):
+            sqlite_store.set_secrets(
+                secrets_path,
+                ciphertexts=ciphertexts,
+                updated_at=updated_at,
+                updated_by=updated_by,
+                now_ts=now_ts,
+            )
+
+        clear_file_content_cache(secrets_path)
+        return
+
+    if journal:
+        journal_size = append_record(
+            get_journal_path(secrets_path), updates=_get_secrets_updates(ciphertexts)
+        )
+        clear_file_content_cache(secrets_path)
+        _compact_if_needed(secrets_path, journal_size, compaction_threshold)
+        return
+
+    content = get_file_content(secrets_path)
+    content.update(_get_secrets_updates(ciphertexts))
+    _write_file_content(secrets_path=secrets_path, content=content)
+
+
+def _decrypt_secrets_concurrently(
+    key_path: str,
+    secrets: List[str],
+    password: Optional[str] = None,
+    max_workers: Optional[int] = None,
+) -> List[str]:
+    """
+    Decrypt provided secrets using a process pool.
+
+    Secrets are split into one chunk per worker so each worker only needs to load the private key
+    once. Key is also loaded before the pool is started so forked workers inherit the loaded key.
+    """
+    from dcsm.decryption import decrypt_secrets, load_private_key
+
+    load_private_key(key_path=key_path, password=password)
+
+    max_workers = min(max_workers or os.cpu_count() or 1, len(secrets))
+
+    if max_workers <= 1:
+        return decrypt_secrets(key_path=key_path, secrets=secrets, password=password)
+
+    chunk_size = int(math.ceil(len(secrets) / float(max_workers)))
+    chunks = [secrets[index : index + chunk_size] for index in range(0, len(secrets), chunk_size)]
+    func = functools.partial(decrypt_secrets, key_path, password=password)
+
+    with profiling.phase("decrypt_concurrently"), ProcessPoolExecutor(max_workers) as pool:
+        return [plaintext for result in pool.map(func, chunks) for plaintext in result]
+
+
+def _get_secret_updated_at(content: dict, key: str) -> Optional[int]:
+    """
+    Return unix timestamp of when the provided secret has been updated (if available).
+    """
+    for suffix in [UPDATED_AT_SUFFIX, LEGACY_UPDATED_AT_SUFFIX]:
+        value = content.get(key + suffix, None)
+
+        if value is None:
+            continue
+
+        if isinstance(value, int):
+            return value
+
+        # Format: "<date> UTC # <timestamp>"
+        try:
+            return int(str(value).rsplit("#", 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+    return None
+
+
+def _compact_if_needed(
+    secrets_path: str, journal_size: int, compaction_threshold: Optional[int] = None
+) -> None:
+    if compaction_threshold is None:
+        compaction_threshold = DEFAULT_COMPACTION_THRESHOLD
+
+    if journal_size >= compaction_threshold:
+        _compact_secrets_file(secrets_path)
+
+
+def _compact_secrets_file(secrets_path: str) -> None:
+    """
+    Write secrets file snapshot with the journal replayed and remove the journal (caller needs to
+    hold the file lock).
+    """
+    profiling.increment("secrets_journal_compactions")
+
+    with profiling.phase("compact_secrets_file"):
+        _write_file_content(secrets_path=secrets_path, content=get_file_content(secrets_path))
+
+
+def _get_update_metadata() -> Tuple[str, str, int]:
+    """
+    Return a tuple of (updated at, updated by, current timestamp) for updated secrets.
+    """
+    now_ts = int(time.time())
+
+    updated_at = format_updated_at(now_ts)
+    updated_by = "%s@%s" % (getpass.getuser(), socket.gethostname())
+
+    return updated_at, updated_by, now_ts
+
+
+def _get_secrets_updates(ciphertexts: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Return file content updates for the provided encrypted secrets and the corresponding metadata.
+    """
+    updated_at, updated_by, now_ts = _get_update_metadata()
+
+    updates: Dict[str, Any] = {}
+
+    for key, ciphertext in ciphertexts.items():
+        updates["%s_updated_at" % (key)] = updated_at
+        updates["%s_updated_by" % (key)] = updated_by
+        updates[key] = ciphertext
+
+    updates["updated_at"] = now_ts
+
+    return updates
+
+
+def _write_file_content(secrets_path: str, content: dict) -> None:
+    """
+    Serialize and write secrets file content to disk (caller needs to hold the file lock).
+    """
+    with profiling.phase("serialize_secrets_file"):
+        content = dict(sorted(content.items()))
+        result = dump_yaml(content)
+
+    with profiling.phase("write_secrets_file"):
+        write_to_file(file_path=secrets_path, permissions=0o600, content=result.encode("utf-8"))
+
+    # Journal (if any) has been folded into the written content
+    remove_journal(get_journal_path(secrets_path))
+    clear_file_content_cache(secrets_path)
+
+
 def decrypt_secret_from_file(
-    key_path: str, secrets_path: str, key: str, key_password: Optional[str] = None
+    key_path: str,
+    secrets_path: str,
+    key: str,
+    key_password: Optional[str] = None,
+    lock_timeout: Optional[float] = None,
 ) -> str:
-    if not os.path.isfile(secrets_path):
+    from dcsm.decryption import decrypt_secret
+
+    if not secrets_file_exists(secrets_path):
         raise ValueError("File %s doesn't exist" % (secrets_path))
 
-    content = get_file_content(secrets_path)
+    if sqlite_store.is_sqlite_path(secrets_path):
+        # Indexed lookup, no need to load the whole store
+        with get_secrets_file_lock(secrets_path, timeout=lock_timeout).shared():
+            ciphertext = sqlite_store.get_secret(secrets_path, key)
+    else:
+        ciphertext = get_cached_file_content(secrets_path, lock_timeout=lock_timeout).get(key, None)
 
-    if key not in content:
+    if ciphertext is None:
         raise ValueError(
             'File path %s doesn\'t contain assignment for secret "%s"' % (secrets_path, key)
         )
 
-    plaintext = decrypt_secret(key_path=key_path, secret=content[key], password=key_password)
+    plaintext = decrypt_secret(key_path=key_path, secret=ciphertext, password=key_password)
 
     return plaintext
 
 
 def get_file_content(file_path: str) -> dict:
-    if not os.path.isfile(file_path):
+    """
+    Parse and return secrets file content (with the journal, if any, replayed on top of it).
+    """
+    if sqlite_store.is_sqlite_path(file_path):
+        if not os.path.isfile(file_path):
+            return {}
+
+        with profiling.phase("parse_secrets_file"):
+            return sqlite_store.get_content(file_path)
+
+    content: dict = {}
+
+    if os.path.isfile(file_path):
+        with profiling.phase("parse_secrets_file"):
+            with open(file_path, "rb") as fp:
+                content = yaml.load(fp, Loader=YAMLLoader) or {}
+
+    return replay(get_journal_path(file_path), content)
+
+
+def dump_yaml(content: dict, dumper: Any = None) -> str:
+    """
+    Serialize secrets file content to YAML.
+
+    libyaml dumper is only used when content doesn't contain any non-ASCII strings. libyaml and
+    pure Python dumper fold long escaped non-ASCII strings at different points, so this way the
+    output is the same regardless of whether libyaml is available.
+    """
+    if dumper is None:
+        dumper = YAMLDumper if _is_ascii_content(content) else yaml.SafeDumper
+
+    return yaml.dump(content, Dumper=dumper, default_flow_style=False, explicit_start=True)
+
+
+def _is_ascii_content(content: dict) -> bool:
+    for key, value in content.items():
+        if isinstance(key, str) and not key.isascii():
+            return False
+
+        if isinstance(value, str) and not value.isascii():
+            return False
+
+    return True
+
+
+def get_cached_file_content(file_path: str, lock_timeout: Optional[float] = None) -> dict:
+    """
+    Return parsed content of the provided secrets file.
+
+    Parsed content is cached in memory and only re-parsed when the file (or journal) stat
+    fingerprint (mtime, inode, size) changes. Returned dictionary is shared between callers and
+    should be treated as read-only.
+
+    File is parsed while holding a shared lock so concurrent readers don't block each other, but
+    they never observe a file which is being written. It should not be called while holding an
+    exclusive lock for the same file.
+    """
+    lock = get_secrets_file_lock(file_path, timeout=lock_timeout)
+
+    return _get_cached_file_content(file_path, lock=lock.shared())
+
+
+def _get_cached_file_content(file_path: str, lock: ContextManager) -> dict:
+    """
+    Return parsed content of the provided secrets file, lock is acquired if content is not cached.
+    """
+    file_path = os.path.abspath(file_path)
+    fingerprint = _get_content_fingerprint(file_path)
+
+    if fingerprint is None:
         return {}
 
-    with open(file_path, "rb") as fp:
-        result = yaml.safe_load(fp)
+    with _FILE_CONTENT_CACHE_LOCK:
+        item = _FILE_CONTENT_CACHE.get(file_path, None)
+
+        if item and item[0] == fingerprint:
+            _FILE_CONTENT_CACHE.move_to_end(file_path)
+            profiling.increment("secrets_file_cache_hits")
+            return item[1]
+
+    profiling.increment("secrets_file_cache_misses")
+
+    with lock:
+        fingerprint = _get_content_fingerprint(file_path)
+
+        if fingerprint is None:
+            return {}
+
+        content = get_file_content(file_path)
+
+    with _FILE_CONTENT_CACHE_LOCK:
+        _FILE_CONTENT_CACHE[file_path] = (fingerprint, content)
+        _FILE_CONTENT_CACHE.move_to_end(file_path)
+
+        while len(_FILE_CONTENT_CACHE) > FILE_CONTENT_CACHE_MAX_SIZE:
+            _FILE_CONTENT_CACHE.popitem(last=False)
+
+    return content
+
+
+def clear_file_content_cache(file_path: Optional[str] = None) -> None:
+    """
+    Remove cached parsed secrets file content from memory.
+
+    If file_path is provided, only entry for that file is removed.
+    """
+    with _FILE_CONTENT_CACHE_LOCK:
+        if not file_path:
+            _FILE_CONTENT_CACHE.clear()
+            return
+
+        _FILE_CONTENT_CACHE.pop(os.path.abspath(file_path), None)
+
+
+def _get_content_fingerprint(file_path: str) -> Optional[tuple]:
+    """
+    Return stat fingerprint of the secrets file and its journal (None if neither exists).
+    """
+    fingerprints: List[Optional[Tuple[int, int, int]]] = []
+
+    for path in [file_path, get_journal_path(file_path)]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            fingerprints.append(None)
+        else:
+            fingerprints.append((stat.st_mtime_ns, stat.st_ino, stat.st_size))
+
+    if fingerprints == [None, None]:
+        return None
 
-    return result or {}
+    return tuple(fingerprints)
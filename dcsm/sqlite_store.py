@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SQLite backed secrets store.
+
+Secrets are stored in an indexed table which means looking up, updating and removing a single
+secret doesn't require parsing and re-writing the whole file. Per secret metadata (updated at,
+updated by) is stored in separate columns instead of in "<key>_updated_at" and
+"<key>_updated_by" sibling keys which are used by the YAML format.
+"""
+
+import contextlib
+import os
+import sqlite3
+from typing import Dict, Iterator, Optional
+
+from dcsm.metadata import (
+    LEGACY_UPDATED_AT_SUFFIX,
+    UPDATED_AT_SUFFIX,
+    UPDATED_BY_SUFFIX,
+    format_updated_at,
+    get_secret_keys,
+)
+
+__all__ = [
+    "is_sqlite_path",
+    "get_secret",
+    "get_content",
+    "set_content",
+    "set_secrets",
+    "remove_secret",
+]
+
+# Secrets files with one of those extensions are treated as SQLite databases
+SQLITE_FILE_EXTENSIONS = [".db", ".sqlite", ".sqlite3"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS secrets (
+    key TEXT PRIMARY KEY NOT NULL,
+    value TEXT NOT NULL,
+    updated_at TEXT,
+    updated_by TEXT
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    name TEXT PRIMARY KEY NOT NULL,
+    value TEXT NOT NULL
+);
+"""
+
+
+def is_sqlite_path(secrets_path: str) -> bool:
+    return os.path.splitext(secrets_path)[1].lower() in SQLITE_FILE_EXTENSIONS
+
+
+def get_secret(secrets_path: str, key: str) -> Optional[str]:
+    """
+    Return encrypted value for the provided secret or None if the secret doesn't exist.
+    """
+    if not os.path.isfile(secrets_path):
+        return None
+
+    with _connect(secrets_path) as connection:
+        row = connection.execute("SELECT value FROM secrets WHERE key = ?", (key,)).fetchone()
+
+    return row[0] if row else None
+
+
+def get_content(secrets_path: str) -> dict:
+    """
+    Return content of the whole store in the same format as the one used by the YAML secrets files.
+    """
+    if not os.path.isfile(secrets_path):
+        return {}
+
+    result: dict = {}
+
+    with _connect(secrets_path) as connection:
+        rows = connection.execute("SELECT key, value, updated_at, updated_by FROM secrets")
+
+        for key, value, updated_at, updated_by in rows:
+            result[key] = value
+
+            if updated_at is not None:
+                result[key + UPDATED_AT_SUFFIX] = updated_at
+
+            if updated_by is not None:
+                result[key + UPDATED_BY_SUFFIX] = updated_by
+
+        row = connection.execute("SELECT value FROM metadata WHERE name = 'updated_at'").fetchone()
+
+    if row:
+        result["updated_at"] = int(row[0])
+
+    return result
+
+
+def set_content(secrets_path: str, content: dict) -> None:
+    """
+    Replace content of the whole store with the provided content which is in the same format as
+    the one used by the YAML secrets files.
+    """
+    rows = []
+    for key in get_secret_keys(content):
+        updated_at = content.get(key + UPDATED_AT_SUFFIX, None)
+
+        # Old secrets files store a unix timestamp under "<key>_updated"
+        legacy_updated_at = content.get(key + LEGACY_UPDATED_AT_SUFFIX, None)
+        if updated_at is None and isinstance(legacy_updated_at, int):
+            updated_at = format_updated_at(legacy_updated_at)
+
+        rows.append(
+            (
+                key,
+                str(content[key]),
+                updated_at,
+                content.get(key + UPDATED_BY_SUFFIX, None),
+            )
+        )
+
+    with _connect(secrets_path) as connection:
+        with connection:
+            connection.execute("DELETE FROM secrets")
+            connection.executemany(
+                "INSERT INTO secrets (key, value, updated_at, updated_by) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+            if "updated_at" in content:
+                _set_updated_at(connection, int(content["updated_at"]))
+            else:
+                connection.execute("DELETE FROM metadata WHERE name = 'updated_at'")
+
+
+def set_secrets(
+    secrets_path: str, ciphertexts: Dict[str, str], updated_at: str, updated_by: str, now_ts: int
+) -> None:
+    """
+    Insert or update provided encrypted secrets in a single transaction.
+    """
+    rows = [(key, value, updated_at, updated_by) for key, value in ciphertexts.items()]
+
+    with _connect(secrets_path) as connection:
+        with connection:
+            connection.executemany(
+                "INSERT INTO secrets (key, value, updated_at, updated_by) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, "
+                "updated_at = excluded.updated_at, updated_by = excluded.updated_by",
+                rows,
+            )
+            _set_updated_at(connection, now_ts)
+
+
+def remove_secret(secrets_path: str, key: str, now_ts: int) -> bool:
+    """
+    Remove provided secret from the store and return True if the secret existed.
+    """
+    if not os.path.isfile(secrets_path):
+        return False
+
+    with _connect(secrets_path) as connection:
+        with connection:
+            cursor = connection.execute("DELETE FROM secrets WHERE key = ?", (key,))
+
+            if cursor.rowcount == 0:
+                return False
+
+            _set_updated_at(connection, now_ts)
+
+    return True
+
+
+def _set_updated_at(connection: sqlite3.Connection, now_ts: int) -> None:
+    connection.execute(
+        "INSERT INTO metadata (name, value) VALUES ('updated_at', ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+        (str(now_ts),),
+    )
+
+
+@contextlib.contextmanager
+def _connect(secrets_path: str) -> Iterator[sqlite3.Connection]:
+    if not os.path.isfile(secrets_path):
+        # Make sure the file is created with safe permissions
+        fd = os.open(secrets_path, os.O_CREAT | os.O_WRONLY, 0o600)
+        os.close(fd)
+
+    connection = sqlite3.connect(secrets_path)
+
+    try:
+        connection.executescript(SCHEMA)
+        yield connection
+    finally:
+        connection.close()
@@ -14,31 +14,180 @@
 # limitations under the License.
 
 import hashlib
+import io
+import json
 import os
-import shutil
+import re
 import tempfile
+from types import TracebackType
+from typing import BinaryIO, Dict, Optional, Type
 
-__all__ = ["write_to_file", "get_secrets_lock_file_path", "get_template_file_lock_path"]
+__all__ = [
+    "AtomicFileWriter",
+    "write_to_file",
+    "get_fsync_policy",
+    "fsync_directory",
+    "get_secrets_lock_file_path",
+    "get_template_file_lock_path",
+    "parse_key_value_pairs",
+]
 
+# Supported formats for parse_key_value_pairs
+KEY_VALUE_FORMATS = ["dotenv", "json"]
 
-def write_to_file(file_path: str, permissions: int, content: bytes) -> None:
-    # For security reasons we first write it to a temporary file, chmod it and then move it to a
-    # final location
-    fd, tmp_path = tempfile.mkstemp()
-    os.chmod(tmp_path, permissions)
+# Escape sequences which are supported inside double quoted dotenv values
+DOTENV_ESCAPES = {"n": "\n", '"': '"', "\\": "\\"}
+DOTENV_ESCAPE_RE = re.compile(r"\\(.)")
+
+# Durability policies for atomic file writes:
+# - none - don't fsync anything, OS flushes the data eventually
+# - file - fsync file data before it's renamed to the final location so the file is either the old
+#   or the new complete version after a crash
+# - full - same as file + fsync parent directory after the rename so the rename itself is durable
+FSYNC_POLICY_NONE = "none"
+FSYNC_POLICY_FILE = "file"
+FSYNC_POLICY_FULL = "full"
+
+FSYNC_POLICIES = [FSYNC_POLICY_NONE, FSYNC_POLICY_FILE, FSYNC_POLICY_FULL]
+
+# Environment variable which can be used to override the default fsync policy
+FSYNC_POLICY_ENV_VARIABLE = "DCSM_FSYNC_POLICY"
+
+DEFAULT_FSYNC_POLICY = FSYNC_POLICY_FILE
+
+
+class AtomicFileWriter(object):
+    """
+    Context manager which atomically replaces file content.
+
+    Data is written to a temporary file in the same directory as the destination file (so the
+    final rename never turns into a cross-device copy), permissions are set on the file descriptor
+    before any data is written and the temporary file is renamed to the final location on
+    successful exit. On error, the temporary file is removed and the destination is left untouched.
+
+    Writes are buffered so data can be written in many small chunks. commit() and discard() can be
+    used to explicitly finish the write before the context manager exits.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        permissions: int,
+        fsync_policy: Optional[str] = None,
+        buffer_size: int = io.DEFAULT_BUFFER_SIZE,
+    ) -> None:
+        self.file_path = file_path
+        self.permissions = permissions
+        self.fsync_policy = get_fsync_policy(fsync_policy)
+        self.buffer_size = buffer_size
+
+        self._file: Optional[BinaryIO] = None
+        self._tmp_path: Optional[str] = None
+
+    def __enter__(self) -> "AtomicFileWriter":
+        directory, file_name = os.path.split(os.path.abspath(self.file_path))
+        fd, self._tmp_path = tempfile.mkstemp(
+            prefix=".%s." % (file_name), suffix=".tmp", dir=directory
+        )
 
-    try:
         try:
-            os.write(fd, content)
-        finally:
+            os.fchmod(fd, self.permissions)
+            self._file = os.fdopen(fd, "wb", buffering=self.buffer_size)
+        except BaseException:
             os.close(fd)
+            self.discard()
+            raise
+
+        return self
+
+    def write(self, data: bytes) -> None:
+        assert self._file is not None, "writer is not open"
+        self._file.write(data)
+
+    def commit(self) -> None:
+        """
+        Flush the written data and atomically move it to the final location.
+        """
+        assert self._file is not None and self._tmp_path is not None, "writer is not open"
+
+        try:
+            self._file.flush()
+
+            if self.fsync_policy != FSYNC_POLICY_NONE:
+                os.fsync(self._file.fileno())
+
+            self._file.close()
+            self._file = None
+
+            os.replace(self._tmp_path, self.file_path)
+        except BaseException:
+            self.discard()
+            raise
+
+        self._tmp_path = None
+
+        if self.fsync_policy == FSYNC_POLICY_FULL:
+            fsync_directory(os.path.dirname(os.path.abspath(self.file_path)))
+
+    def discard(self) -> None:
+        """
+        Remove the temporary file and leave the destination file untouched.
+        """
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+
+            self._file = None
+
+        if self._tmp_path is not None:
+            try:
+                os.unlink(self._tmp_path)
+            except FileNotFoundError:
+                pass
+
+            self._tmp_path = None
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if exc_type is not None:
+            self.discard()
+        elif self._tmp_path is not None:
+            self.commit()
 
-        shutil.move(tmp_path, file_path)
-    finally:
-        if os.path.isfile(tmp_path):
-            os.unlink(tmp_path)
 
-    os.chmod(file_path, permissions)
+def write_to_file(
+    file_path: str, permissions: int, content: bytes, fsync_policy: Optional[str] = None
+) -> None:
+    # For security reasons we first write it to a temporary file with correct permissions and then
+    # atomically rename it to a final location
+    with AtomicFileWriter(
+        file_path=file_path, permissions=permissions, fsync_policy=fsync_policy
+    ) as writer:
+        writer.write(content)
+
+
+def get_fsync_policy(fsync_policy: Optional[str] = None) -> str:
+    """
+    Return fsync policy which should be used for file writes.
+
+    Explicitly provided value has precedence over the value from the environment variable.
+    """
+    if not fsync_policy:
+        fsync_policy = os.environ.get(FSYNC_POLICY_ENV_VARIABLE, None) or DEFAULT_FSYNC_POLICY
+
+    if fsync_policy not in FSYNC_POLICIES:
+        raise ValueError(
+            "Invalid fsync policy: %s. Valid values are: %s"
+            % (fsync_policy, ", ".join(FSYNC_POLICIES))
+        )
+
+    return fsync_policy
 
 
 def get_secrets_lock_file_path(secrets_path: str) -> str:
@@ -55,3 +204,69 @@ def get_template_file_lock_path(template_path: str) -> str:
     lock_path = "/tmp/compose-template-%s.lock" % (path_hash)
 
     return lock_path
+
+
+def parse_key_value_pairs(content: str, input_format: str = "dotenv") -> Dict[str, str]:
+    """
+    Parse key value pairs (e.g. secrets which should be encrypted) in a dotenv or JSON format.
+    """
+    if input_format not in KEY_VALUE_FORMATS:
+        raise ValueError(
+            "Invalid format: %s. Valid values are: %s"
+            % (input_format, ", ".join(KEY_VALUE_FORMATS))
+        )
+
+    if input_format == "json":
+        result = json.loads(content)
+
+        if not isinstance(result, dict):
+            raise ValueError("JSON input needs to be an object")
+
+        for key, value in result.items():
+            if not isinstance(value, str):
+                raise ValueError('Value for key "%s" needs to be a string' % (key))
+
+        return result
+
+    result = {}
+
+    for line_number, line in enumerate(content.splitlines(), 1):
+        line = line.strip()
+
+        if not line or line.startswith("#"):
+            continue
+
+        if line.startswith("export "):
+            line = line[len("export ") :].lstrip()
+
+        if "=" not in line:
+            raise ValueError("Line %s is not in KEY=VALUE format" % (line_number))
+
+        key, value = line.split("=", 1)
+        key = key.strip()
+        value = value.strip()
+
+        if not key:
+            raise ValueError("Line %s is missing a key" % (line_number))
+
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in ["'", '"']:
+            quote = value[0]
+            value = value[1:-1]
+
+            if quote == '"':
+                value = DOTENV_ESCAPE_RE.sub(
+                    lambda match: DOTENV_ESCAPES.get(match.group(1), match.group(0)), value
+                )
+
+        result[key] = value
+
+    return result
+
+
+def fsync_directory(directory: str) -> None:
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
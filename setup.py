@@ -56,7 +56,18 @@ setup(
         "bin/dcsm-remove-secret-from-file",
         "bin/dcsm-generate-key-pair",
         "bin/dcsm-render-template-file",
+        "bin/dcsm-precompile-templates",
+        "bin/dcsm-convert-secrets-file",
+        "bin/dcsm-compact-secrets-file",
+        "bin/dcsm-rotate-secrets-file",
+        "bin/dcsm-agent",
+        "bin/dcsm-analyze-templates",
     ],
+    entry_points={
+        "console_scripts": [
+            "dcsm=dcsm.cli:main",
+        ],
+    },
     test_suite="tests",
     classifiers=[
         "Development Status :: 3 - Alpha" "Environment :: Console",
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+from typing import Callable, Dict, Tuple
+
+import pytest
+
+from dcsm.decryption import clear_private_key_cache
+from dcsm.secrets_writer import clear_file_content_cache
+from tests.benchmarks.fixtures import (
+    KEY_PAIRS,
+    generate_secrets_file,
+    generate_template_file,
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    clear_private_key_cache()
+    clear_file_content_cache()
+    yield
+    clear_private_key_cache()
+    clear_file_content_cache()
+
+
+@pytest.fixture(scope="session")
+def secrets_file_factory(tmp_path_factory) -> Callable[..., str]:
+    """
+    Return function which returns path to a generated secrets file. Generated files are cached
+    for the whole session and should be treated as read-only.
+    """
+    cache: Dict[Tuple[str, int, str, bool], str] = {}
+    base_dir = tmp_path_factory.mktemp("secrets")
+
+    def factory(
+        key_type: str, count: int, extension: str = ".yaml", envelope_format: bool = False
+    ) -> str:
+        cache_key = (key_type, count, extension, envelope_format)
+
+        if cache_key not in cache:
+            secrets_path = os.path.join(
+                base_dir,
+                "secrets_%s_%s_%s%s" % (key_type, count, int(envelope_format), extension),
+            )
+            cache[cache_key] = generate_secrets_file(
+                key_path=KEY_PAIRS[key_type][1],
+                secrets_path=secrets_path,
+                count=count,
+                envelope_format=envelope_format,
+            )
+
+        return cache[cache_key]
+
+    return factory
+
+
+@pytest.fixture(scope="session")
+def template_file_factory(tmp_path_factory) -> Callable[[int], str]:
+    cache: Dict[int, str] = {}
+    base_dir = tmp_path_factory.mktemp("templates")
+
+    def factory(count: int) -> str:
+        if count not in cache:
+            template_path = os.path.join(base_dir, "template_%s.yml.j2" % (count))
+            cache[count] = generate_template_file(template_path=template_path, count=count)
+
+        return cache[count]
+
+    return factory
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Synthetic fixture generator for benchmarks.
+
+Can also be used as a standalone script for generating secrets files and templates with a large
+number of secrets:
+
+    python -m tests.benchmarks.fixtures --key-path public_key.pem --output-dir /tmp/fixtures
+"""
+
+import argparse
+import os
+from typing import Dict, List
+
+from dcsm.secrets_writer import encrypt_and_write_many_to_file
+
+__all__ = [
+    "get_benchmark_sizes",
+    "get_rounds",
+    "generate_secrets",
+    "generate_secrets_file",
+    "generate_template_file",
+]
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.abspath(os.path.join(BASE_DIR, "../fixtures"))
+
+# Key pairs which are used by the benchmarks
+KEY_PAIRS = {
+    "rsa": (
+        os.path.join(FIXTURES_DIR, "keys/private_key_1_no_password.pem"),
+        os.path.join(FIXTURES_DIR, "keys/public_key_1_no_password.pem"),
+    ),
+    "x25519": (
+        os.path.join(FIXTURES_DIR, "keys/private_key_3_x25519_no_password.pem"),
+        os.path.join(FIXTURES_DIR, "keys/public_key_3_x25519_no_password.pem"),
+    ),
+}
+
+# Number of secrets in the generated secrets files and templates
+DEFAULT_BENCHMARK_SIZES = [10, 100, 1000, 10000]
+
+# Environment variable which can be used to override benchmark sizes (e.g. "10,100")
+BENCHMARK_SIZES_ENV_VARIABLE = "DCSM_BENCHMARK_SIZES"
+
+SECRET_VALUE = "secret value %s"
+
+
+def get_benchmark_sizes() -> List[int]:
+    value = os.environ.get(BENCHMARK_SIZES_ENV_VARIABLE, None)
+
+    if not value:
+        return DEFAULT_BENCHMARK_SIZES
+
+    return [int(size) for size in value.split(",") if size.strip()]
+
+
+def get_rounds(count: int) -> int:
+    """
+    Return number of benchmark rounds for operations which scale with the number of secrets so
+    the large sizes don't take forever to run.
+    """
+    return max(1, min(10, 1000 // count))
+
+
+def get_secret_key(index: int) -> str:
+    return "SECRET_%05d" % (index)
+
+
+def generate_secrets(count: int) -> Dict[str, str]:
+    """
+    Return dictionary with the provided number of plain text secrets.
+    """
+    return {get_secret_key(index): SECRET_VALUE % (index) for index in range(count)}
+
+
+def generate_secrets_file(
+    key_path: str, secrets_path: str, count: int, envelope_format: bool = False
+) -> str:
+    """
+    Generate secrets file with the provided number of secrets which are encrypted using the
+    provided public key.
+    """
+    encrypt_and_write_many_to_file(
+        key_path=key_path,
+        secrets_path=secrets_path,
+        secrets=generate_secrets(count),
+        envelope_format=envelope_format,
+    )
+    return secrets_path
+
+
+def generate_template_file(template_path: str, count: int) -> str:
+    """
+    Generate template file which references the provided number of secrets.
+    """
+    lines = ['version: "3"', "", "services:", "  app:", "    environment:"]
+
+    for index in range(count):
+        key = get_secret_key(index)
+        lines.append("      - %s={{ secrets.%s }}" % (key, key))
+
+    with open(template_path, "w") as fp:
+        fp.write("\n".join(lines) + "\n")
+
+    return template_path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate benchmark secrets files and templates")
+    parser.add_argument(
+        "--key-path",
+        type=str,
+        default=KEY_PAIRS["rsa"][1],
+        help=("Path to the public key file used to encrypt the secrets."),
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        required=True,
+        help=("Directory where generated files are written to."),
+    )
+    parser.add_argument(
+        "--sizes",
+        type=str,
+        default=",".join([str(size) for size in DEFAULT_BENCHMARK_SIZES]),
+        help=("Comma delimited list with number of secrets in each generated file."),
+    )
+    parser.add_argument(
+        "--envelope",
+        action="store_true",
+        default=False,
+        help=("Encrypt the secrets using envelope format."),
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        secrets_path = os.path.join(args.output_dir, "secrets_%s.yaml" % (size))
+        template_path = os.path.join(args.output_dir, "template_%s.yml.j2" % (size))
+
+        generate_secrets_file(
+            key_path=args.key_path,
+            secrets_path=secrets_path,
+            count=size,
+            envelope_format=args.envelope,
+        )
+        generate_template_file(template_path=template_path, count=size)
+
+        print("Generated %s and %s" % (secrets_path, template_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+from dcsm.decryption import clear_private_key_cache, decrypt_secret
+from dcsm.encryption import encrypt_secret, encrypt_secrets
+from tests.benchmarks.fixtures import (
+    KEY_PAIRS,
+    generate_secrets,
+    get_benchmark_sizes,
+    get_rounds,
+)
+
+# (key type, envelope format) combinations. Secrets for X25519 keys always use envelope format.
+SECRET_FORMATS = [("rsa", False), ("rsa", True), ("x25519", True)]
+
+SECRET_VALUE = "secret value"
+
+
+@pytest.mark.parametrize("key_type,envelope_format", SECRET_FORMATS)
+def test_encrypt_secret(benchmark, key_type, envelope_format):
+    _, public_key_path = KEY_PAIRS[key_type]
+
+    benchmark.extra_info.update({"key_type": key_type, "envelope_format": envelope_format})
+    benchmark(
+        encrypt_secret,
+        key_path=public_key_path,
+        value=SECRET_VALUE,
+        envelope_format=envelope_format,
+    )
+
+
+@pytest.mark.parametrize("key_type,envelope_format", SECRET_FORMATS)
+def test_decrypt_secret(benchmark, key_type, envelope_format):
+    private_key_path, public_key_path = KEY_PAIRS[key_type]
+
+    ciphertext = encrypt_secret(
+        key_path=public_key_path, value=SECRET_VALUE, envelope_format=envelope_format
+    )
+
+    # Loaded private key and unwrapped data key are cached so this measures a warm decryption
+    decrypt_secret(key_path=private_key_path, secret=ciphertext)
+
+    benchmark.extra_info.update({"key_type": key_type, "envelope_format": envelope_format})
+    result = benchmark(decrypt_secret, key_path=private_key_path, secret=ciphertext)
+    assert result == SECRET_VALUE
+
+
+@pytest.mark.parametrize("key_type,envelope_format", SECRET_FORMATS)
+def test_decrypt_secret_cold(benchmark, key_type, envelope_format):
+    private_key_path, public_key_path = KEY_PAIRS[key_type]
+
+    ciphertext = encrypt_secret(
+        key_path=public_key_path, value=SECRET_VALUE, envelope_format=envelope_format
+    )
+
+    benchmark.extra_info.update({"key_type": key_type, "envelope_format": envelope_format})
+    result = benchmark.pedantic(
+        decrypt_secret,
+        kwargs={"key_path": private_key_path, "secret": ciphertext},
+        setup=clear_private_key_cache,
+        rounds=20,
+    )
+    assert result == SECRET_VALUE
+
+
+@pytest.mark.parametrize("count", get_benchmark_sizes())
+@pytest.mark.parametrize("key_type,envelope_format", SECRET_FORMATS)
+def test_encrypt_secrets_bulk(benchmark, key_type, envelope_format, count):
+    _, public_key_path = KEY_PAIRS[key_type]
+    values = list(generate_secrets(count).values())
+
+    benchmark.extra_info.update(
+        {"key_type": key_type, "envelope_format": envelope_format, "secrets_count": count}
+    )
+    result = benchmark.pedantic(
+        encrypt_secrets,
+        kwargs={
+            "key_path": public_key_path,
+            "values": values,
+            "envelope_format": envelope_format,
+        },
+        rounds=get_rounds(count),
+    )
+    assert len(result) == count
+
+
+@pytest.mark.parametrize("count", get_benchmark_sizes())
+@pytest.mark.parametrize("key_type,envelope_format", SECRET_FORMATS)
+def test_decrypt_secrets_bulk(benchmark, key_type, envelope_format, count):
+    private_key_path, public_key_path = KEY_PAIRS[key_type]
+    values = list(generate_secrets(count).values())
+    ciphertexts = encrypt_secrets(
+        key_path=public_key_path, values=values, envelope_format=envelope_format
+    )
+
+    def decrypt_all():
+        return [decrypt_secret(key_path=private_key_path, secret=value) for value in ciphertexts]
+
+    benchmark.extra_info.update(
+        {"key_type": key_type, "envelope_format": envelope_format, "secrets_count": count}
+    )
+    result = benchmark.pedantic(
+        decrypt_all, setup=clear_private_key_cache, rounds=get_rounds(count)
+    )
+    assert result == values
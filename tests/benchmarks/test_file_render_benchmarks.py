@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+
+import pytest
+
+from dcsm.decryption import clear_private_key_cache
+from dcsm.file_render import render_template_file
+from dcsm.secrets_writer import clear_file_content_cache
+from tests.benchmarks.fixtures import KEY_PAIRS, get_benchmark_sizes, get_rounds
+
+# (key type, envelope format) combinations which are used for the secrets file
+SECRET_FORMATS = [("rsa", False), ("rsa", True), ("x25519", True)]
+
+
+def clear_caches():
+    clear_private_key_cache()
+    clear_file_content_cache()
+
+
+@pytest.mark.parametrize("count", get_benchmark_sizes())
+@pytest.mark.parametrize("prefetch", [False, True])
+@pytest.mark.parametrize("key_type,envelope_format", SECRET_FORMATS)
+def test_render_template_file(
+    benchmark,
+    tmp_path,
+    secrets_file_factory,
+    template_file_factory,
+    key_type,
+    envelope_format,
+    prefetch,
+    count,
+):
+    """
+    Measure how long it takes to render a template which references the provided number of
+    secrets. All the caches are cleared before each round so this matches a single CLI run.
+    """
+    private_key_path, _ = KEY_PAIRS[key_type]
+    secrets_path = secrets_file_factory(
+        key_type=key_type, count=count, envelope_format=envelope_format
+    )
+    template_path = template_file_factory(count=count)
+    destination_path = os.path.join(tmp_path, "docker-compose.yml")
+
+    benchmark.extra_info.update(
+        {
+            "key_type": key_type,
+            "envelope_format": envelope_format,
+            "prefetch": prefetch,
+            "secrets_count": count,
+        }
+    )
+    benchmark.pedantic(
+        render_template_file,
+        kwargs={
+            "key_path": private_key_path,
+            "secrets_path": secrets_path,
+            "template_path": template_path,
+            "destination_path": destination_path,
+            "prefetch": prefetch,
+            "skip_unchanged": False,
+        },
+        setup=clear_caches,
+        rounds=get_rounds(count),
+    )
+
+    assert os.path.getsize(destination_path) > 0
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import contextlib
+import io
+
+import pytest
+
+from dcsm.keygen import KEY_TYPE_RSA, KEY_TYPES, generate_key_pair
+
+
+@pytest.mark.parametrize("key_type", KEY_TYPES)
+def test_generate_key_pair(benchmark, tmp_path, key_type):
+    def generate():
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_key_pair(path=str(tmp_path), overwrite=True, key_type=key_type)
+
+    # 8192 bit RSA key generation is very slow so we only run it once
+    rounds = 1 if key_type == KEY_TYPE_RSA else 20
+
+    benchmark.extra_info["key_type"] = key_type
+    benchmark.pedantic(generate, rounds=rounds, iterations=1)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+
+import pytest
+
+from dcsm.journal import get_journal_path, remove_journal
+from dcsm.secrets_writer import clear_file_content_cache, encrypt_and_write_to_file
+from tests.benchmarks.fixtures import KEY_PAIRS, get_benchmark_sizes
+
+SECRETS_FILE_EXTENSIONS = [".yaml", ".sqlite"]
+
+
+@pytest.mark.parametrize("count", get_benchmark_sizes())
+@pytest.mark.parametrize("extension", SECRETS_FILE_EXTENSIONS)
+def test_encrypt_and_write_to_file(benchmark, tmp_path, secrets_file_factory, extension, count):
+    """
+    Measure how long it takes to add a single secret to a secrets file with the provided number of
+    existing secrets.
+    """
+    _, public_key_path = KEY_PAIRS["rsa"]
+    source_path = secrets_file_factory(key_type="rsa", count=count, extension=extension)
+    secrets_path = os.path.join(tmp_path, "secrets%s" % (extension))
+
+    def setup():
+        shutil.copyfile(source_path, secrets_path)
+        clear_file_content_cache()
+
+    benchmark.extra_info.update({"extension": extension, "secrets_count": count})
+    benchmark.pedantic(
+        encrypt_and_write_to_file,
+        kwargs={
+            "key_path": public_key_path,
+            "secrets_path": secrets_path,
+            "key": "NEW_SECRET",
+            "value": "new secret value",
+        },
+        setup=setup,
+        rounds=10,
+    )
+
+
+@pytest.mark.parametrize("count", get_benchmark_sizes())
+def test_encrypt_and_write_to_file_journal(benchmark, tmp_path, secrets_file_factory, count):
+    """
+    Measure how long it takes to append a single secret to the journal of a YAML secrets file with
+    the provided number of existing secrets.
+    """
+    _, public_key_path = KEY_PAIRS["rsa"]
+    source_path = secrets_file_factory(key_type="rsa", count=count, extension=".yaml")
+    secrets_path = os.path.join(tmp_path, "secrets.yaml")
+
+    def setup():
+        shutil.copyfile(source_path, secrets_path)
+        remove_journal(get_journal_path(secrets_path))
+        clear_file_content_cache()
+
+    benchmark.extra_info.update({"extension": ".yaml", "secrets_count": count, "journal": True})
+    benchmark.pedantic(
+        encrypt_and_write_to_file,
+        kwargs={
+            "key_path": public_key_path,
+            "secrets_path": secrets_path,
+            "key": "NEW_SECRET",
+            "value": "new secret value",
+            "journal": True,
+        },
+        setup=setup,
+        rounds=10,
+    )
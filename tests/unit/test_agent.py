@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from dcsm import agent, file_render, profiling
+from dcsm.agent import AGENT_SOCKET_ENV_VARIABLE, AgentClient, KeyAgent
+from dcsm.decryption import clear_private_key_cache, decrypt_secret, decrypt_secrets
+from dcsm.encryption import encrypt_secret
+from dcsm.file_render import DecryptSecretsDict
+from dcsm.secrets_writer import encrypt_and_write_many_to_file
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.abspath(os.path.join(BASE_DIR, "../fixtures"))
+
+PRIVATE_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_1_no_password.pem")
+PUBLIC_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_1_no_password.pem")
+
+PRIVATE_KEY_1_WITH_PASSWORD_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_1_password_foo.pem")
+PUBLIC_KEY_1_WITH_PASSWORD_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_1_password_foo.pem")
+
+__all__ = ["KeyAgentTestCase"]
+
+
+class KeyAgentTestCase(unittest.TestCase):
+    def setUp(self):
+        super(KeyAgentTestCase, self).setUp()
+        clear_private_key_cache()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp_dir, "agent.sock")
+        self.agents = []
+
+    def tearDown(self):
+        super(KeyAgentTestCase, self).tearDown()
+
+        for key_agent, thread in self.agents:
+            key_agent.stop()
+            thread.join(5)
+
+        shutil.rmtree(self.tmp_dir)
+
+    def test_decrypt_secret_uses_agent(self):
+        self._start_agent(key_path=PRIVATE_KEY_1_WITH_PASSWORD_PATH, password="foo")
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o600)
+
+        ciphertexts = [
+            encrypt_secret(key_path=PUBLIC_KEY_1_WITH_PASSWORD_PATH, value="value %s" % (index))
+            for index in range(3)
+        ]
+
+        with mock.patch.dict(os.environ, {AGENT_SOCKET_ENV_VARIABLE: self.socket_path}):
+            with profiling.profile() as profiler:
+                # Password is not needed since agent holds an unlocked key
+                plaintext = decrypt_secret(
+                    key_path=PRIVATE_KEY_1_WITH_PASSWORD_PATH, secret=ciphertexts[0]
+                )
+                self.assertEqual(plaintext, "value 0")
+
+                # Batch request
+                plaintexts = decrypt_secrets(
+                    key_path=PRIVATE_KEY_1_WITH_PASSWORD_PATH, secrets=ciphertexts
+                )
+                self.assertEqual(plaintexts, ["value 0", "value 1", "value 2"])
+
+            self.assertEqual(profiler.to_dict()["counters"]["agent_requests"], 2)
+
+            # Decryption errors are propagated
+            self.assertRaisesRegex(
+                ValueError,
+                "Decryption failed",
+                decrypt_secret,
+                key_path=PRIVATE_KEY_1_WITH_PASSWORD_PATH,
+                secret=encrypt_secret(key_path=PUBLIC_KEY_1_PATH, value="foo"),
+            )
+
+    def test_decrypt_secret_falls_back_to_local_decryption(self):
+        self._start_agent(key_path=PRIVATE_KEY_1_WITH_PASSWORD_PATH, password="foo")
+
+        ciphertext = encrypt_secret(key_path=PUBLIC_KEY_1_PATH, value="value 1")
+
+        # Agent holds a different key
+        with mock.patch.dict(os.environ, {AGENT_SOCKET_ENV_VARIABLE: self.socket_path}):
+            with profiling.profile() as profiler:
+                plaintext = decrypt_secret(key_path=PRIVATE_KEY_1_PATH, secret=ciphertext)
+
+            self.assertEqual(plaintext, "value 1")
+            self.assertEqual(profiler.to_dict()["counters"]["agent_fallbacks"], 1)
+
+        # Agent is not running
+        socket_path = os.path.join(self.tmp_dir, "doesnt-exist.sock")
+
+        with mock.patch.dict(os.environ, {AGENT_SOCKET_ENV_VARIABLE: socket_path}):
+            plaintext = decrypt_secret(key_path=PRIVATE_KEY_1_PATH, secret=ciphertext)
+            self.assertEqual(plaintext, "value 1")
+
+    def test_prefetch_falls_back_to_pool_when_agent_cant_serve_request(self):
+        secrets_path = os.path.join(self.tmp_dir, "secrets.yaml")
+        encrypt_and_write_many_to_file(
+            key_path=PUBLIC_KEY_1_PATH,
+            secrets_path=secrets_path,
+            secrets={"KEY_ONE": "value 1", "KEY_TWO": "value 2", "KEY_THREE": "value 3"},
+        )
+
+        # Agent holds the same key, all the secrets are decrypted using a single agent request
+        self._start_agent(key_path=PRIVATE_KEY_1_PATH)
+
+        with mock.patch.dict(os.environ, {AGENT_SOCKET_ENV_VARIABLE: self.socket_path}):
+            secrets_dict = DecryptSecretsDict(
+                key_path=PRIVATE_KEY_1_PATH, secrets_path=secrets_path
+            )
+
+            with mock.patch.object(file_render, "ThreadPoolExecutor") as mock_pool:
+                with profiling.profile() as profiler:
+                    secrets_dict.prefetch(keys=["KEY_ONE", "KEY_TWO", "KEY_THREE"])
+
+            self.assertEqual(mock_pool.call_count, 0)
+            self.assertEqual(profiler.to_dict()["counters"]["agent_requests"], 1)
+            self.assertEqual(secrets_dict.KEY_TWO, "value 2")
+
+        # Agent holds a different key, secrets are decrypted locally using the pool
+        socket_path = os.path.join(self.tmp_dir, "agent-2.sock")
+        self._start_agent(
+            key_path=PRIVATE_KEY_1_WITH_PASSWORD_PATH, password="foo", socket_path=socket_path
+        )
+
+        with mock.patch.dict(os.environ, {AGENT_SOCKET_ENV_VARIABLE: socket_path}):
+            secrets_dict = DecryptSecretsDict(
+                key_path=PRIVATE_KEY_1_PATH, secrets_path=secrets_path
+            )
+
+            with mock.patch.object(
+                file_render, "ThreadPoolExecutor", wraps=file_render.ThreadPoolExecutor
+            ) as mock_pool:
+                with profiling.profile() as profiler:
+                    secrets_dict.prefetch(keys=["KEY_ONE", "KEY_TWO", "KEY_THREE"], max_workers=2)
+
+            mock_pool.assert_called_once_with(max_workers=2)
+            self.assertEqual(profiler.to_dict()["counters"]["agent_fallbacks"], 1)
+            self.assertEqual(secrets_dict.KEY_THREE, "value 3")
+
+    def test_agent_ttl_is_enforced(self):
+        key_agent, thread = self._start_agent(key_path=PRIVATE_KEY_1_PATH, ttl=1)
+
+        client = AgentClient(socket_path=self.socket_path)
+        self.assertEqual(client.status()["key_path"], os.path.realpath(PRIVATE_KEY_1_PATH))
+
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(self.socket_path))
+
+        # Agent discards the unlocked key when it exits
+        self.assertEqual(len(agent.decryption._PRIVATE_KEY_CACHE), 0)
+
+    def test_decrypt_secret_falls_back_to_local_decryption_after_ttl_expires(self):
+        key_agent, _ = self._start_agent(key_path=PRIVATE_KEY_1_PATH)
+        ciphertext = encrypt_secret(key_path=PUBLIC_KEY_1_PATH, value="value 1")
+
+        # Request arrives after the TTL has expired, but before the server has been shut down
+        key_agent._expires_at = time.monotonic() - 1
+
+        client = AgentClient(socket_path=self.socket_path)
+        self.assertIsNone(client.decrypt(key_path=PRIVATE_KEY_1_PATH, secrets=[ciphertext]))
+
+        with mock.patch.dict(os.environ, {AGENT_SOCKET_ENV_VARIABLE: self.socket_path}):
+            with profiling.profile() as profiler:
+                plaintext = decrypt_secret(key_path=PRIVATE_KEY_1_PATH, secret=ciphertext)
+
+            self.assertEqual(plaintext, "value 1")
+            self.assertEqual(profiler.to_dict()["counters"]["agent_fallbacks"], 1)
+
+    def test_agent_invalid_ttl(self):
+        self.assertRaisesRegex(
+            ValueError,
+            "TTL needs to be greater than 0",
+            KeyAgent,
+            key_path=PRIVATE_KEY_1_PATH,
+            socket_path=self.socket_path,
+            ttl=0,
+        )
+
+    def _start_agent(self, key_path, password=None, ttl=60, socket_path=None):
+        key_agent = KeyAgent(
+            key_path=key_path,
+            socket_path=socket_path or self.socket_path,
+            password=password,
+            ttl=ttl,
+        )
+        key_agent.start()
+
+        thread = threading.Thread(target=key_agent.serve_forever, daemon=True)
+        thread.start()
+
+        # Wait for the server loop to start
+        time.sleep(0.1)
+
+        self.agents.append((key_agent, thread))
+        return key_agent, thread
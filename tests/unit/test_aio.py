@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+from filelock import FileLock, Timeout
+
+from dcsm import aio, file_render
+from dcsm.decryption import clear_private_key_cache
+from dcsm.encryption import encrypt_secret
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.abspath(os.path.join(BASE_DIR, "../fixtures"))
+
+PRIVATE_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_1_no_password.pem")
+PUBLIC_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_1_no_password.pem")
+SECRETS_1_PATH = os.path.join(FIXTURES_DIR, "secrets/secrets1.yaml")
+TEMPLATE_1_PATH = os.path.join(FIXTURES_DIR, "templates/docker-compose.yml.j2")
+
+__all__ = ["AsyncioTestCase"]
+
+
+class AsyncioTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        super(AsyncioTestCase, self).setUp()
+        clear_private_key_cache()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    async def test_decrypt_secret(self):
+        ciphertexts = [
+            encrypt_secret(key_path=PUBLIC_KEY_1_PATH, value="value %s" % (index))
+            for index in range(3)
+        ]
+
+        plaintext = await aio.decrypt_secret(key_path=PRIVATE_KEY_1_PATH, secret=ciphertexts[0])
+        self.assertEqual(plaintext, "value 0")
+
+        plaintexts = await aio.decrypt_secrets(key_path=PRIVATE_KEY_1_PATH, secrets=ciphertexts)
+        self.assertEqual(plaintexts, ["value 0", "value 1", "value 2"])
+
+        plaintext = await aio.decrypt_secret_from_file(
+            key_path=PRIVATE_KEY_1_PATH, secrets_path=SECRETS_1_PATH, key="KEY_ONE"
+        )
+        self.assertEqual(plaintext, "value 1")
+
+    async def test_render_template_files_concurrency_is_bounded(self):
+        templates = [
+            (TEMPLATE_1_PATH, os.path.join(self.tmp_dir, "docker-compose.%s.yml" % (index)))
+            for index in range(6)
+        ]
+
+        lock = threading.Lock()
+        state = {"running": 0, "max_running": 0}
+        original_render_template_file_locked = file_render.render_template_file_locked
+
+        def mock_render_template_file_locked(*args, **kwargs):
+            with lock:
+                state["running"] += 1
+                state["max_running"] = max(state["max_running"], state["running"])
+
+            time.sleep(0.05)
+
+            try:
+                return original_render_template_file_locked(*args, **kwargs)
+            finally:
+                with lock:
+                    state["running"] -= 1
+
+        with mock.patch.object(
+            file_render, "render_template_file_locked", mock_render_template_file_locked
+        ):
+            result = await aio.render_template_files(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                templates=templates,
+                max_concurrency=2,
+            )
+
+        self.assertEqual(result, [destination_path for _, destination_path in templates])
+        self.assertEqual(state["max_running"], 2)
+
+        with open(templates[0][1], "r") as fp:
+            self.assertIn("value 1", fp.read())
+
+        result = await aio.render_template_file(
+            key_path=PRIVATE_KEY_1_PATH,
+            secrets_path=SECRETS_1_PATH,
+            template_path=TEMPLATE_1_PATH,
+            destination_path=templates[0][1],
+        )
+        self.assertEqual(result, templates[0][1])
+
+    async def test_render_template_file_process_pool_executor(self):
+        destination_path = os.path.join(self.tmp_dir, "docker-compose.yml")
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            result = await aio.render_template_file(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                template_path=TEMPLATE_1_PATH,
+                destination_path=destination_path,
+                executor=executor,
+            )
+
+            # Pool should still be usable
+            plaintext = await aio.decrypt_secret_from_file(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                key="KEY_ONE",
+                executor=executor,
+            )
+
+        self.assertEqual(result, destination_path)
+        self.assertEqual(plaintext, "value 1")
+
+        with open(destination_path, "r") as fp:
+            content = fp.read()
+
+        self.assertIn("- SECRET1=value 1", content)
+        self.assertIn("- SECRET3=value 3", content)
+
+        # Missing secrets are reported at once when prefetch is used
+        template_path = os.path.join(self.tmp_dir, "missing.yml.j2")
+        with open(template_path, "w") as fp:
+            fp.write("{{ secrets.KEY_ONE }} {{ secrets.MISSING_1 }} {{ secrets.MISSING_2 }}\n")
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            with self.assertRaisesRegex(ValueError, '"MISSING_1", "MISSING_2"'):
+                await aio.render_template_file(
+                    key_path=PRIVATE_KEY_1_PATH,
+                    secrets_path=SECRETS_1_PATH,
+                    template_path=template_path,
+                    destination_path=os.path.join(self.tmp_dir, "missing.yml"),
+                    prefetch=True,
+                    executor=executor,
+                )
+
+    def test_secrets_dict_can_be_pickled(self):
+        secrets_dict = file_render.get_secrets_dict(
+            key_path=PRIVATE_KEY_1_PATH, secrets_path=SECRETS_1_PATH
+        )
+        self.assertEqual(pickle.loads(pickle.dumps(secrets_dict)).KEY_ONE, "value 1")
+
+        dummy_secrets_dict = file_render.get_secrets_dict(
+            key_path=PRIVATE_KEY_1_PATH, secrets_path=SECRETS_1_PATH, dummy=True
+        )
+        self.assertEqual(pickle.loads(pickle.dumps(dummy_secrets_dict)).KEY_ONE, "dummy")
+
+    async def test_acquire_file_lock_doesnt_block_event_loop(self):
+        lock_path = os.path.join(self.tmp_dir, "test.lock")
+        ticks = []
+
+        async def tick():
+            for _ in range(5):
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.02)
+
+        # Lock is held by somebody else
+        with FileLock(lock_path):
+            ticker = asyncio.ensure_future(tick())
+
+            with self.assertRaises(Timeout):
+                async with aio.acquire_file_lock(lock_path, timeout=0.2):
+                    pass
+
+            await ticker
+
+        self.assertEqual(len(ticks), 5)
+
+        # Lock is available
+        async with aio.acquire_file_lock(lock_path, timeout=0.2) as lock:
+            self.assertTrue(lock.is_locked)
+
+        self.assertFalse(lock.is_locked)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from dcsm.analyzer import analyze_template, analyze_templates
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.abspath(os.path.join(BASE_DIR, "../fixtures"))
+
+SECRETS_1_PATH = os.path.join(FIXTURES_DIR, "secrets/secrets1.yaml")
+TEMPLATES_DIR = os.path.join(FIXTURES_DIR, "templates")
+TEMPLATE_1_PATH = os.path.join(TEMPLATES_DIR, "docker-compose.yml.j2")
+TEMPLATE_2_PATH = os.path.join(TEMPLATES_DIR, "docker-compose.yml.2.j2")
+TEMPLATE_3_PATH = os.path.join(TEMPLATES_DIR, "docker-compose.yml.3.j2")
+
+__all__ = ["AnalyzerTestCase"]
+
+
+class AnalyzerTestCase(unittest.TestCase):
+    def setUp(self):
+        super(AnalyzerTestCase, self).setUp()
+
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir)
+
+    def test_analyze_template(self):
+        result = analyze_template(TEMPLATE_2_PATH)
+
+        self.assertEqual(result.template_path, TEMPLATE_2_PATH)
+        self.assertEqual(result.secrets, ["INVALID", "KEY_ONE", "KEY_THREE", "KEY_TWO"])
+        self.assertFalse(result.dynamic_references)
+        self.assertIsNone(result.error)
+
+    def test_analyze_templates_missing_and_unused_secrets(self):
+        report = analyze_templates(
+            template_paths=[TEMPLATE_2_PATH, TEMPLATE_3_PATH],
+            secrets_path=SECRETS_1_PATH,
+            max_workers=1,
+        )
+
+        self.assertEqual(report.secret_keys, ["KEY_ONE", "KEY_THREE", "KEY_TWO"])
+        self.assertEqual(report.missing_secrets, {"INVALID": [TEMPLATE_2_PATH]})
+        self.assertEqual(report.unused_secrets, [])
+        self.assertFalse(report.success)
+
+        report = analyze_templates(
+            template_paths=[TEMPLATE_3_PATH], secrets_path=SECRETS_1_PATH, max_workers=1
+        )
+
+        self.assertEqual(report.referenced_secrets, ["KEY_ONE", "KEY_TWO"])
+        self.assertEqual(report.missing_secrets, {})
+        self.assertEqual(report.unused_secrets, ["KEY_THREE"])
+        self.assertTrue(report.success)
+
+    def test_analyze_templates_directory_in_parallel(self):
+        for executor in ["thread", "process"]:
+            report = analyze_templates(
+                template_paths=[TEMPLATES_DIR],
+                secrets_path=SECRETS_1_PATH,
+                max_workers=2,
+                executor=executor,
+            )
+
+            self.assertEqual(
+                [template.template_path for template in report.templates],
+                [TEMPLATE_2_PATH, TEMPLATE_3_PATH, TEMPLATE_1_PATH],
+            )
+            self.assertEqual(report.missing_secrets, {"INVALID": [TEMPLATE_2_PATH]})
+            self.assertEqual(report.unused_secrets, [])
+
+    def test_analyze_templates_dynamic_references_and_syntax_errors(self):
+        dynamic_template_path = os.path.join(self._tmp_dir, "dynamic.j2")
+        invalid_template_path = os.path.join(self._tmp_dir, "invalid.j2")
+
+        with open(dynamic_template_path, "w") as fp:
+            fp.write("{{ secrets.KEY_ONE }}\n{% for key in keys %}{{ secrets[key] }}{% endfor %}\n")
+
+        with open(invalid_template_path, "w") as fp:
+            fp.write("{{ secrets.KEY_ONE }\n")
+
+        report = analyze_templates(
+            template_paths=[self._tmp_dir], secrets_path=SECRETS_1_PATH, max_workers=1
+        )
+
+        self.assertEqual(report.dynamic_references, [dynamic_template_path])
+        self.assertEqual(list(report.errors.keys()), [invalid_template_path])
+        self.assertEqual(report.referenced_secrets, ["KEY_ONE"])
+        self.assertEqual(report.unused_secrets, ["KEY_THREE", "KEY_TWO"])
+        self.assertFalse(report.success)
+
+        result = json.loads(report.to_json())
+        self.assertEqual(result["dynamic_references"], [dynamic_template_path])
+        self.assertEqual(result["templates"][dynamic_template_path]["secrets"], ["KEY_ONE"])
+
+    def test_analyze_templates_doesnt_need_private_key(self):
+        with mock.patch(
+            "dcsm.decryption._load_private_key", side_effect=AssertionError("unexpected call")
+        ):
+            report = analyze_templates(
+                template_paths=[TEMPLATE_1_PATH], secrets_path=SECRETS_1_PATH, max_workers=1
+            )
+
+        self.assertTrue(report.success)
+
+    def test_analyze_templates_secrets_file_doesnt_exist(self):
+        self.assertRaisesRegex(
+            ValueError,
+            "doesn't exist",
+            analyze_templates,
+            template_paths=[TEMPLATE_1_PATH],
+            secrets_path=os.path.join(self._tmp_dir, "doesnt-exist.yaml"),
+        )
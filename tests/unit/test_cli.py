@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+from dcsm import cli
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.abspath(os.path.join(BASE_DIR, "../../"))
+FIXTURES_DIR = os.path.abspath(os.path.join(BASE_DIR, "../fixtures"))
+
+PRIVATE_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_1_no_password.pem")
+PUBLIC_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_1_no_password.pem")
+PRIVATE_KEY_1_PASSWORD_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_1_password_foo.pem")
+PUBLIC_KEY_1_PASSWORD_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_1_password_foo.pem")
+PRIVATE_KEY_3_X25519_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_3_x25519_no_password.pem")
+PUBLIC_KEY_3_X25519_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_3_x25519_no_password.pem")
+SECRETS_1_PATH = os.path.join(FIXTURES_DIR, "secrets/secrets1.yaml")
+
+# Modules which should only be imported by the commands which need them
+HEAVY_MODULES = ["cryptography", "jinja2", "yaml", "filelock"]
+
+# Maximum cumulative import time for the CLI module (in microseconds). This budget is generous on
+# purpose, it's mostly here to catch heavy dependencies being imported at module level again.
+CLI_IMPORT_TIME_BUDGET = 250000
+
+__all__ = ["CLITestCase"]
+
+
+class CLITestCase(unittest.TestCase):
+    def test_cli_import_doesnt_import_heavy_dependencies(self):
+        code = "import sys; import dcsm.cli; print(','.join(sorted(sys.modules.keys())))"
+        stdout, stderr = self._run_python(["-X", "importtime", "-c", code])
+
+        imported_modules = stdout.strip().split(",")
+
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, imported_modules)
+
+        import_times = {}
+        for line in stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+
+            _, cumulative, name = line.split("|")
+
+            if cumulative.strip().isdigit():
+                import_times[name.strip()] = int(cumulative.strip())
+
+        self.assertLess(import_times["dcsm.cli"], CLI_IMPORT_TIME_BUDGET)
+
+    def test_remove_secret_from_file_doesnt_import_cryptography(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        secrets_path = os.path.join(tmp_dir, "secrets.yaml")
+        shutil.copyfile(SECRETS_1_PATH, secrets_path)
+
+        code = (
+            "import sys; from dcsm import cli; "
+            "cli.main(['remove-secret-from-file', '--secrets-path', %r, 'KEY_ONE']); "
+            "print('cryptography' in sys.modules)" % (secrets_path)
+        )
+        stdout, _ = self._run_python(["-c", code])
+
+        self.assertEqual(stdout.strip().split("\n")[-1], "False")
+
+        with open(secrets_path, "r") as fp:
+            self.assertNotIn("KEY_ONE", yaml.safe_load(fp))
+
+    def test_encrypt_and_decrypt_secret(self):
+        ciphertext = self._run_command(
+            ["encrypt-secret", "--key-path", PUBLIC_KEY_1_PATH, "--envelope", "value 1"]
+        ).strip()
+        self.assertTrue(ciphertext.startswith("dcsm:v2:"))
+
+        plaintext = self._run_command(
+            ["decrypt-secret", "--key-path", PRIVATE_KEY_1_PATH, ciphertext]
+        ).strip()
+        self.assertEqual(plaintext, "value 1")
+
+    def test_decrypt_secret_password_protected_key(self):
+        ciphertext = self._run_command(
+            ["encrypt-secret", "--key-path", PUBLIC_KEY_1_PASSWORD_PATH, "--envelope", "value 1"]
+        ).strip()
+
+        plaintext = self._run_command(
+            [
+                "decrypt-secret",
+                "--key-path",
+                PRIVATE_KEY_1_PASSWORD_PATH,
+                "--password",
+                "foo",
+                ciphertext,
+            ]
+        ).strip()
+        self.assertEqual(plaintext, "value 1")
+
+    def test_encrypt_secret_multiple_key_paths(self):
+        ciphertext = self._run_command(
+            [
+                "encrypt-secret",
+                "--key-path",
+                PUBLIC_KEY_1_PATH,
+                "--key-path",
+                PUBLIC_KEY_3_X25519_PATH,
+                "value 1",
+            ]
+        ).strip()
+        self.assertTrue(ciphertext.startswith("dcsm:v3:"))
+
+        for private_key_path in [PRIVATE_KEY_1_PATH, PRIVATE_KEY_3_X25519_PATH]:
+            plaintext = self._run_command(
+                ["decrypt-secret", "--key-path", private_key_path, ciphertext]
+            ).strip()
+            self.assertEqual(plaintext, "value 1")
+
+    def test_rotate_secrets_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        secrets_path = os.path.join(tmp_dir, "secrets.yaml")
+        shutil.copyfile(SECRETS_1_PATH, secrets_path)
+
+        stdout = self._run_command(
+            [
+                "rotate-secrets-file",
+                "--old-key-path",
+                PRIVATE_KEY_1_PATH,
+                "--new-key-path",
+                PUBLIC_KEY_3_X25519_PATH,
+                "--secrets-path",
+                secrets_path,
+                "--updated-since",
+                "2020-12-26T21:38:50",
+            ]
+        )
+        self.assertIn("2 secrets in %s re-encrypted" % (secrets_path), stdout)
+
+        plaintext = self._run_command(
+            [
+                "decrypt-secret-from-file",
+                "--key-path",
+                PRIVATE_KEY_3_X25519_PATH,
+                "--secrets-path",
+                secrets_path,
+                "KEY_THREE",
+            ]
+        ).strip()
+        self.assertEqual(plaintext, "value 3")
+
+    def test_analyze_templates(self):
+        template_path = os.path.join(FIXTURES_DIR, "templates/docker-compose.yml.3.j2")
+        stdout = self._run_command(
+            ["analyze-templates", "--secrets-path", SECRETS_1_PATH, "--workers", "1", template_path]
+        )
+        self.assertIn("Unused secret KEY_THREE", stdout)
+
+        stdout = io.StringIO()
+
+        with contextlib.redirect_stdout(stdout):
+            exit_code = cli.main(
+                [
+                    "analyze-templates",
+                    "--secrets-path",
+                    SECRETS_1_PATH,
+                    "--fail-on-unused",
+                    "--workers",
+                    "1",
+                    template_path,
+                ]
+            )
+
+        self.assertEqual(exit_code, 1)
+
+    def test_agent_start_failure_removes_socket_directory(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        with mock.patch("tempfile.tempdir", tmp_dir):
+            self.assertRaises(
+                ValueError,
+                cli.main,
+                ["agent", "--key-path", PRIVATE_KEY_1_PASSWORD_PATH, "--password", "invalid"],
+            )
+
+        self.assertEqual(os.listdir(tmp_dir), [])
+
+    def test_run_command(self):
+        stdout = io.StringIO()
+
+        with contextlib.redirect_stdout(stdout):
+            exit_code = cli.run_command(
+                "decrypt-secret-from-file",
+                ["--key-path", PRIVATE_KEY_1_PATH, "--secrets-path", SECRETS_1_PATH, "KEY_ONE"],
+            )
+
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(stdout.getvalue().strip(), "value 1")
+
+    def test_invalid_arguments(self):
+        stderr = io.StringIO()
+
+        with contextlib.redirect_stderr(stderr):
+            self.assertRaises(SystemExit, cli.main, ["does-not-exist"])
+            self.assertRaises(
+                SystemExit,
+                cli.main,
+                ["encrypt-secret-to-file", "--key-path", "a", "--secrets-path", "b", "key"],
+            )
+
+        self.assertIn("key and value arguments are required", stderr.getvalue())
+
+    def _run_command(self, argv):
+        stdout = io.StringIO()
+
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(cli.main(argv), 0)
+
+        return stdout.getvalue()
+
+    def _run_python(self, args):
+        env = os.environ.copy()
+        env["PYTHONPATH"] = ROOT_DIR
+
+        process = subprocess.run(
+            [sys.executable] + args,
+            cwd=ROOT_DIR,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+        return process.stdout.decode("utf-8"), process.stderr.decode("utf-8")
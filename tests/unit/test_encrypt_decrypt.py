@@ -15,10 +15,18 @@
 
 import base64
 import os
+import shutil
+import tempfile
 import unittest
 
-from dcsm.decryption import decrypt_secret
-from dcsm.encryption import encrypt_secret
+from dcsm import decryption, envelope
+from dcsm.decryption import clear_private_key_cache, decrypt_secret, load_private_key
+from dcsm.encryption import (
+    encrypt_secret,
+    encrypt_secrets,
+    generate_data_key,
+    get_legacy_secret_max_size,
+)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FIXTURES_DIR = os.path.abspath(os.path.join(BASE_DIR, "../fixtures"))
@@ -32,10 +40,24 @@ PUBLIC_KEY_2_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_2_no_password.pe
 PRIVATE_KEY_1_WITH_PASSWORD_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_1_password_foo.pem")
 PUBLIC_KEY_1_WITH_PASSWORD_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_1_password_foo.pem")
 
+PRIVATE_KEY_3_X25519_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_3_x25519_no_password.pem")
+PUBLIC_KEY_3_X25519_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_3_x25519_no_password.pem")
+
+PRIVATE_KEY_4_X25519_WITH_PASSWORD_PATH = os.path.join(
+    FIXTURES_DIR, "keys/private_key_4_x25519_password_foo.pem"
+)
+PUBLIC_KEY_4_X25519_WITH_PASSWORD_PATH = os.path.join(
+    FIXTURES_DIR, "keys/public_key_4_x25519_password_foo.pem"
+)
+
 __all__ = ["EncryptDecryptTestCase"]
 
 
 class EncryptDecryptTestCase(unittest.TestCase):
+    def setUp(self):
+        super(EncryptDecryptTestCase, self).setUp()
+        clear_private_key_cache()
+
     def test_encrypt_decrypt_key_without_password(self):
         plaintext = "test hello world 1"
 
@@ -94,3 +116,314 @@ class EncryptDecryptTestCase(unittest.TestCase):
         self.assertRaisesRegex(
             ValueError, expected_msg, decrypt_secret, key_path=PRIVATE_KEY_2_PATH, secret=ciphertext
         )
+
+    def test_load_private_key_is_cached(self):
+        private_key_1 = load_private_key(key_path=PRIVATE_KEY_1_PATH)
+        private_key_2 = load_private_key(key_path=PRIVATE_KEY_1_PATH)
+        self.assertTrue(private_key_1 is private_key_2)
+
+        # Different password should result in a different cache entry
+        private_key_3 = load_private_key(key_path=PRIVATE_KEY_1_WITH_PASSWORD_PATH, password="foo")
+        private_key_4 = load_private_key(key_path=PRIVATE_KEY_1_WITH_PASSWORD_PATH, password="foo")
+        self.assertTrue(private_key_3 is private_key_4)
+
+        expected_msg = "Incorrect password|Could not deserialize key data"
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            load_private_key,
+            key_path=PRIVATE_KEY_1_WITH_PASSWORD_PATH,
+            password="invalid",
+        )
+
+        # Explicit invalidation
+        clear_private_key_cache(key_path=PRIVATE_KEY_1_PATH)
+        private_key_5 = load_private_key(key_path=PRIVATE_KEY_1_PATH)
+        self.assertFalse(private_key_1 is private_key_5)
+
+        private_key_6 = load_private_key(key_path=PRIVATE_KEY_1_WITH_PASSWORD_PATH, password="foo")
+        self.assertTrue(private_key_3 is private_key_6)
+
+    def test_load_private_key_cache_is_invalidated_on_file_change(self):
+        tmp_dir = tempfile.mkdtemp()
+        key_path = os.path.join(tmp_dir, "private_key.pem")
+        shutil.copyfile(PRIVATE_KEY_1_PATH, key_path)
+
+        private_key_1 = load_private_key(key_path=key_path)
+        self.assertTrue(private_key_1 is load_private_key(key_path=key_path))
+
+        # Key file is replaced with a different key
+        shutil.copyfile(PRIVATE_KEY_2_PATH, key_path + ".new")
+        os.rename(key_path + ".new", key_path)
+
+        private_key_2 = load_private_key(key_path=key_path)
+        self.assertFalse(private_key_1 is private_key_2)
+        self.assertEqual(len(decryption._PRIVATE_KEY_CACHE), 1)
+
+    def test_load_private_key_cache_size_is_bounded(self):
+        tmp_dir = tempfile.mkdtemp()
+
+        for index in range(decryption.PRIVATE_KEY_CACHE_MAX_SIZE + 3):
+            key_path = os.path.join(tmp_dir, "private_key_%s.pem" % (index))
+            shutil.copyfile(PRIVATE_KEY_1_PATH, key_path)
+            load_private_key(key_path=key_path)
+
+        self.assertEqual(len(decryption._PRIVATE_KEY_CACHE), decryption.PRIVATE_KEY_CACHE_MAX_SIZE)
+
+    def test_decrypt_secret_inexistent_key_file(self):
+        expected_msg = "Key file /does/not/exist.pem doesn't exist"
+        self.assertRaisesRegex(
+            ValueError, expected_msg, decrypt_secret, key_path="/does/not/exist.pem", secret="a"
+        )
+
+    def test_encrypt_decrypt_envelope_format(self):
+        # Value which is larger than what can be encrypted directly with RSA-OAEP
+        plaintext = "test hello world 3 " * 1000
+
+        expected_msg = "Encryption failed|too large|Data too long"
+        self.assertRaisesRegex(
+            ValueError, expected_msg, encrypt_secret, key_path=PUBLIC_KEY_1_PATH, value=plaintext
+        )
+
+        ciphertext = encrypt_secret(
+            key_path=PUBLIC_KEY_1_PATH, value=plaintext, envelope_format=True
+        )
+        self.assertTrue(ciphertext.startswith("dcsm:v2:rsa-oaep-sha256:"))
+
+        decrypted_plaintext = decrypt_secret(key_path=PRIVATE_KEY_1_PATH, secret=ciphertext)
+        self.assertEqual(decrypted_plaintext, plaintext)
+
+        # Invalid key should not work
+        expected_msg = "Decryption failed"
+        self.assertRaisesRegex(
+            ValueError, expected_msg, decrypt_secret, key_path=PRIVATE_KEY_2_PATH, secret=ciphertext
+        )
+
+        # Payload which has been tampered with should not work
+        split = ciphertext.split(":")
+        payload = bytearray(base64.b64decode(split[-1]))
+        payload[-1] ^= 1
+        split[-1] = base64.b64encode(bytes(payload)).decode("utf-8")
+
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            decrypt_secret,
+            key_path=PRIVATE_KEY_1_PATH,
+            secret=":".join(split),
+        )
+
+    def test_encrypt_decrypt_envelope_format_shared_data_key(self):
+        data_key = generate_data_key(key_path=PUBLIC_KEY_1_PATH)
+
+        ciphertext_1 = encrypt_secret(
+            key_path=PUBLIC_KEY_1_PATH, value="value 1", data_key=data_key
+        )
+        ciphertext_2 = encrypt_secret(
+            key_path=PUBLIC_KEY_1_PATH, value="value 2", data_key=data_key
+        )
+        self.assertNotEqual(ciphertext_1, ciphertext_2)
+
+        self.assertEqual(
+            decrypt_secret(key_path=PRIVATE_KEY_1_PATH, secret=ciphertext_1), "value 1"
+        )
+        self.assertEqual(
+            decrypt_secret(key_path=PRIVATE_KEY_1_PATH, secret=ciphertext_2), "value 2"
+        )
+
+        # Data key should only be unwrapped once
+        self.assertEqual(len(decryption._DATA_KEY_CACHE), 1)
+
+        # Legacy format should still work
+        ciphertext_3 = encrypt_secret(key_path=PUBLIC_KEY_1_PATH, value="value 3")
+        self.assertEqual(
+            decrypt_secret(key_path=PRIVATE_KEY_1_PATH, secret=ciphertext_3), "value 3"
+        )
+
+    def test_encrypt_decrypt_x25519_key(self):
+        plaintext = "test hello world 4 " * 1000
+
+        # X25519 keys always use envelope format
+        ciphertext = encrypt_secret(key_path=PUBLIC_KEY_3_X25519_PATH, value=plaintext)
+        self.assertTrue(ciphertext.startswith("dcsm:v2:x25519-hkdf-sha256:"))
+
+        decrypted_plaintext = decrypt_secret(key_path=PRIVATE_KEY_3_X25519_PATH, secret=ciphertext)
+        self.assertEqual(decrypted_plaintext, plaintext)
+
+        # Each secret uses a new ephemeral key
+        self.assertNotEqual(
+            encrypt_secret(key_path=PUBLIC_KEY_3_X25519_PATH, value="a").split(":")[3],
+            encrypt_secret(key_path=PUBLIC_KEY_3_X25519_PATH, value="a").split(":")[3],
+        )
+
+        # Key with password
+        ciphertext = encrypt_secret(key_path=PUBLIC_KEY_4_X25519_WITH_PASSWORD_PATH, value="foo")
+        decrypted_plaintext = decrypt_secret(
+            key_path=PRIVATE_KEY_4_X25519_WITH_PASSWORD_PATH, secret=ciphertext, password="foo"
+        )
+        self.assertEqual(decrypted_plaintext, "foo")
+
+        # Invalid key should not work
+        expected_msg = "Decryption failed"
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            decrypt_secret,
+            key_path=PRIVATE_KEY_4_X25519_WITH_PASSWORD_PATH,
+            secret=encrypt_secret(key_path=PUBLIC_KEY_3_X25519_PATH, value="foo"),
+            password="foo",
+        )
+
+        # Key type and wrap algorithm mismatch should not work
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            decrypt_secret,
+            key_path=PRIVATE_KEY_1_PATH,
+            secret=encrypt_secret(key_path=PUBLIC_KEY_3_X25519_PATH, value="foo"),
+        )
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            decrypt_secret,
+            key_path=PRIVATE_KEY_3_X25519_PATH,
+            secret=encrypt_secret(key_path=PUBLIC_KEY_1_PATH, value="foo", envelope_format=True),
+        )
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            decrypt_secret,
+            key_path=PRIVATE_KEY_3_X25519_PATH,
+            secret=encrypt_secret(key_path=PUBLIC_KEY_1_PATH, value="foo"),
+        )
+
+    def test_encrypt_secrets_x25519_key_shares_data_key(self):
+        ciphertexts = encrypt_secrets(
+            key_path=PUBLIC_KEY_3_X25519_PATH, values=["value 1", "value 2", "value 3"]
+        )
+        self.assertEqual(len(set([ciphertext.split(":")[3] for ciphertext in ciphertexts])), 1)
+
+        for index, ciphertext in enumerate(ciphertexts):
+            self.assertEqual(
+                decrypt_secret(key_path=PRIVATE_KEY_3_X25519_PATH, secret=ciphertext),
+                "value %s" % (index + 1),
+            )
+
+        # Data key should only be derived once
+        self.assertEqual(len(decryption._DATA_KEY_CACHE), 1)
+
+    def test_encrypt_decrypt_multi_recipient(self):
+        plaintext = "multi recipient value"
+        key_paths = [
+            PUBLIC_KEY_1_PATH,
+            PUBLIC_KEY_3_X25519_PATH,
+            PUBLIC_KEY_4_X25519_WITH_PASSWORD_PATH,
+        ]
+
+        ciphertext = encrypt_secret(key_path=key_paths, value=plaintext)
+        self.assertTrue(ciphertext.startswith("dcsm:v3:"))
+
+        secret = envelope.parse_envelope_secret(ciphertext)
+        self.assertEqual(len(secret.recipients), 3)
+        self.assertEqual(
+            [recipient.algorithm for recipient in secret.recipients],
+            ["rsa-oaep-sha256", "x25519-hkdf-sha256-aeskw", "x25519-hkdf-sha256-aeskw"],
+        )
+
+        self.assertEqual(decrypt_secret(key_path=PRIVATE_KEY_1_PATH, secret=ciphertext), plaintext)
+        self.assertEqual(
+            decrypt_secret(key_path=PRIVATE_KEY_3_X25519_PATH, secret=ciphertext), plaintext
+        )
+        self.assertEqual(
+            decrypt_secret(
+                key_path=PRIVATE_KEY_4_X25519_WITH_PASSWORD_PATH, secret=ciphertext, password="foo"
+            ),
+            plaintext,
+        )
+
+        # Key which is not one of the recipients should fail without attempting to unwrap any of
+        # the data keys
+        expected_msg = "Decryption failed: secret is not encrypted for key"
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            decrypt_secret,
+            key_path=PRIVATE_KEY_2_PATH,
+            secret=ciphertext,
+        )
+
+        # Recipients are part of the authenticated data
+        recipients = ciphertext.split(":")[2].split(",")
+        tampered_ciphertext = ciphertext.replace(",".join(recipients), ",".join(recipients[:2]))
+        self.assertRaisesRegex(
+            ValueError,
+            "Decryption failed",
+            decrypt_secret,
+            key_path=PRIVATE_KEY_1_PATH,
+            secret=tampered_ciphertext,
+        )
+
+    def test_get_legacy_secret_max_size(self):
+        max_size = get_legacy_secret_max_size(PUBLIC_KEY_1_PATH)
+
+        ciphertext = encrypt_secret(key_path=PUBLIC_KEY_1_PATH, value="x" * max_size)
+        self.assertFalse(ciphertext.startswith("dcsm:"))
+        self.assertRaises(
+            ValueError, encrypt_secret, key_path=PUBLIC_KEY_1_PATH, value="x" * (max_size + 1)
+        )
+
+        self.assertIsNone(get_legacy_secret_max_size(PUBLIC_KEY_3_X25519_PATH))
+        self.assertIsNone(get_legacy_secret_max_size([PUBLIC_KEY_1_PATH, PUBLIC_KEY_2_PATH]))
+
+    def test_private_key_fingerprint_is_evicted_together_with_key(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        key_path = os.path.join(tmp_dir, "private_key.pem")
+        ciphertext = encrypt_secret(
+            key_path=[PUBLIC_KEY_1_PATH, PUBLIC_KEY_3_X25519_PATH], value="value 1"
+        )
+
+        # Key file is replaced many times (e.g. key rotation in a long running process)
+        for index in range(decryption.PRIVATE_KEY_CACHE_MAX_SIZE + 3):
+            shutil.copyfile(PRIVATE_KEY_3_X25519_PATH, key_path + ".new")
+            os.rename(key_path + ".new", key_path)
+
+            self.assertEqual(decrypt_secret(key_path=key_path, secret=ciphertext), "value 1")
+
+            self.assertEqual(len(decryption._PRIVATE_KEY_CACHE), 1)
+            self.assertIsNotNone(list(decryption._PRIVATE_KEY_CACHE.values())[0].fingerprint)
+
+    def test_encrypt_secrets_multi_recipient_shares_data_key(self):
+        key_paths = [PUBLIC_KEY_1_PATH, PUBLIC_KEY_2_PATH]
+        values = ["value %s" % (index) for index in range(5)]
+
+        ciphertexts = encrypt_secrets(key_path=key_paths, values=values)
+        self.assertEqual(len(set([ciphertext.split(":")[2] for ciphertext in ciphertexts])), 1)
+
+        for private_key_path in [PRIVATE_KEY_1_PATH, PRIVATE_KEY_2_PATH]:
+            clear_private_key_cache()
+
+            for ciphertext, value in zip(ciphertexts, values):
+                self.assertEqual(
+                    decrypt_secret(key_path=private_key_path, secret=ciphertext), value
+                )
+
+            # Data key is only unwrapped once per private key
+            self.assertEqual(len(decryption._DATA_KEY_CACHE), 1)
+
+        # Single key path in a list uses the regular format
+        ciphertext = encrypt_secret(
+            key_path=[PUBLIC_KEY_1_PATH], value="value", envelope_format=True
+        )
+        self.assertTrue(ciphertext.startswith("dcsm:v2:"))
+
+    def test_key_fingerprint(self):
+        private_key = load_private_key(PRIVATE_KEY_3_X25519_PATH)
+        fingerprint = envelope.get_key_fingerprint(private_key)
+
+        self.assertEqual(len(fingerprint), 32)
+        self.assertEqual(envelope.get_key_fingerprint(private_key.public_key()), fingerprint)
+        self.assertNotEqual(
+            envelope.get_key_fingerprint(load_private_key(PRIVATE_KEY_1_PATH)), fingerprint
+        )
@@ -14,11 +14,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import os
+import shutil
 import tempfile
+import tracemalloc
 import unittest
+from unittest import mock
 
-from dcsm.file_render import render_template_file
+import yaml
+from jinja2 import Environment
+
+from dcsm import file_render, secrets_writer
+from dcsm.file_render import (
+    DecryptSecretsDict,
+    TemplateWatcher,
+    find_referenced_secrets,
+    get_environment,
+    get_referenced_secrets,
+    load_render_manifest,
+    precompile_templates,
+    read_template,
+    render_template_file,
+    render_template_files,
+)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FIXTURES_DIR = os.path.abspath(os.path.join(BASE_DIR, "../fixtures"))
@@ -27,6 +46,7 @@ PRIVATE_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_1_no_password.
 SECRETS_1_PATH = os.path.join(FIXTURES_DIR, "secrets/secrets1.yaml")
 TEMPLATE_1_PATH = os.path.join(FIXTURES_DIR, "templates/docker-compose.yml.j2")
 TEMPLATE_2_PATH = os.path.join(FIXTURES_DIR, "templates/docker-compose.yml.2.j2")
+TEMPLATE_3_PATH = os.path.join(FIXTURES_DIR, "templates/docker-compose.yml.3.j2")
 
 __all__ = ["FileRenderTestCase"]
 
@@ -85,6 +105,513 @@ class FileRenderTestCase(unittest.TestCase):
             destination_path=tmp_path,
         )
 
+    def test_render_template_file_secrets_file_is_parsed_once(self):
+        _, tmp_path = tempfile.mkstemp()
+        secrets_writer.clear_file_content_cache()
+
+        with mock.patch.object(
+            secrets_writer, "get_file_content", wraps=secrets_writer.get_file_content
+        ) as mock_get_file_content:
+            render_template_file(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                template_path=TEMPLATE_1_PATH,
+                destination_path=tmp_path,
+            )
+
+        self.assertEqual(mock_get_file_content.call_count, 1)
+
+        rendered_template = self._get_file_content(tmp_path)
+        self.assertTrue("- SECRET1=value 1" in rendered_template)
+        self.assertTrue("- SECRET3=value 3" in rendered_template)
+
+    def test_render_template_file_decrypted_values_are_memoized(self):
+        _, tmp_path = tempfile.mkstemp()
+
+        with mock.patch.object(
+            file_render, "decrypt_secret", wraps=file_render.decrypt_secret
+        ) as mock_decrypt_secret:
+            render_template_file(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                template_path=TEMPLATE_3_PATH,
+                destination_path=tmp_path,
+            )
+
+        # KEY_ONE is referenced three times and KEY_TWO twice
+        self.assertEqual(mock_decrypt_secret.call_count, 2)
+
+        rendered_template = self._get_file_content(tmp_path)
+        self.assertEqual(rendered_template.count("value 1"), 3)
+        self.assertEqual(rendered_template.count("value 2"), 2)
+
+    def test_decrypt_secrets_dict_clear(self):
+        secrets_dict = DecryptSecretsDict(key_path=PRIVATE_KEY_1_PATH, secrets_path=SECRETS_1_PATH)
+        self.assertEqual(secrets_dict.KEY_ONE, "value 1")
+        self.assertEqual(secrets_dict._decrypted, {"KEY_ONE": "value 1"})
+
+        secrets_dict.clear()
+        self.assertEqual(secrets_dict._decrypted, {})
+        self.assertEqual(secrets_dict.KEY_ONE, "value 1")
+
+    def test_get_referenced_secrets(self):
+        with open(TEMPLATE_1_PATH, "r") as fp:
+            template_content = fp.read()
+
+        self.assertEqual(
+            get_referenced_secrets(template_content=template_content),
+            set(["KEY_ONE", "KEY_TWO", "KEY_THREE"]),
+        )
+
+        template_content = (
+            '{{ secrets.KEY_ONE }} {{ secrets["KEY_TWO"] }} {{ secrets[name] }} {{ other.KEY }}\n'
+            "{% if true %}{{ secrets.KEY_ONE | upper }}{% endif %}"
+        )
+        self.assertEqual(
+            get_referenced_secrets(template_content=template_content),
+            set(["KEY_ONE", "KEY_TWO"]),
+        )
+        self.assertEqual(
+            find_referenced_secrets(template_content=template_content),
+            (set(["KEY_ONE", "KEY_TWO"]), False),
+        )
+        self.assertEqual(
+            find_referenced_secrets(template_content=read_template(TEMPLATE_1_PATH)),
+            (set(["KEY_ONE", "KEY_TWO", "KEY_THREE"]), True),
+        )
+
+    def test_render_template_file_prefetch_success(self):
+        for executor in ["thread", "process"]:
+            _, tmp_path = tempfile.mkstemp()
+
+            render_template_file(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                template_path=TEMPLATE_3_PATH,
+                destination_path=tmp_path,
+                prefetch=True,
+                prefetch_workers=2,
+                prefetch_executor=executor,
+            )
+
+            rendered_template = self._get_file_content(tmp_path)
+            self.assertEqual(rendered_template.count("value 1"), 3)
+            self.assertEqual(rendered_template.count("value 2"), 2)
+
+    def test_render_template_file_prefetch_reports_all_missing_keys(self):
+        _, template_path = tempfile.mkstemp()
+        _, tmp_path = tempfile.mkstemp()
+
+        with open(template_path, "w") as fp:
+            fp.write("{{ secrets.KEY_ONE }} {{ secrets.INVALID2 }} {{ secrets.INVALID1 }}")
+
+        with mock.patch.object(file_render, "decrypt_secret") as mock_decrypt_secret:
+            expected_msg = 'doesn\'t contain assignment for secrets: "INVALID1", "INVALID2"'
+            self.assertRaisesRegex(
+                ValueError,
+                expected_msg,
+                render_template_file,
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                template_path=template_path,
+                destination_path=tmp_path,
+                prefetch=True,
+            )
+
+        # Should fail fast before any decryption
+        self.assertEqual(mock_decrypt_secret.call_count, 0)
+
+    def test_render_template_files_success(self):
+        tmp_dir = tempfile.mkdtemp()
+
+        templates = [
+            (TEMPLATE_1_PATH, os.path.join(tmp_dir, "docker-compose.1.yml")),
+            (TEMPLATE_3_PATH, os.path.join(tmp_dir, "docker-compose.3.yml")),
+        ]
+
+        for max_workers, prefetch in [(None, False), (2, True)]:
+            secrets_writer.clear_file_content_cache()
+
+            with (
+                mock.patch.object(
+                    secrets_writer, "get_file_content", wraps=secrets_writer.get_file_content
+                ) as mock_get_file_content,
+                mock.patch.object(
+                    file_render, "decrypt_secret", wraps=file_render.decrypt_secret
+                ) as mock_decrypt_secret,
+            ):
+                result = render_template_files(
+                    key_path=PRIVATE_KEY_1_PATH,
+                    secrets_path=SECRETS_1_PATH,
+                    templates=templates,
+                    max_workers=max_workers,
+                    prefetch=prefetch,
+                )
+
+            self.assertEqual(result, [templates[0][1], templates[1][1]])
+
+            # Secrets file should be parsed once and each secret decrypted once for all the
+            # templates
+            self.assertEqual(mock_get_file_content.call_count, 1)
+            self.assertEqual(mock_decrypt_secret.call_count, 3)
+
+            rendered_template = self._get_file_content(templates[0][1])
+            self.assertTrue("- SECRET1=value 1" in rendered_template)
+            self.assertTrue("- SECRET3=value 3" in rendered_template)
+
+            rendered_template = self._get_file_content(templates[1][1])
+            self.assertEqual(rendered_template.count("value 1"), 3)
+
+    def test_load_render_manifest(self):
+        tmp_dir = tempfile.mkdtemp()
+        manifest_path = os.path.join(tmp_dir, "manifest.yaml")
+
+        with open(manifest_path, "w") as fp:
+            fp.write(
+                "- template: %s\n  destination: docker-compose.yml\n"
+                "- template: app.conf.j2\n  destination: /etc/app.conf\n" % (TEMPLATE_1_PATH)
+            )
+
+        self.assertEqual(
+            load_render_manifest(manifest_path),
+            [
+                (TEMPLATE_1_PATH, os.path.join(tmp_dir, "docker-compose.yml")),
+                (os.path.join(tmp_dir, "app.conf.j2"), "/etc/app.conf"),
+            ],
+        )
+
+        with open(manifest_path, "w") as fp:
+            fp.write("- template: app.conf.j2\n")
+
+        expected_msg = 'needs to contain "template" and "destination" attribute'
+        self.assertRaisesRegex(ValueError, expected_msg, load_render_manifest, manifest_path)
+
+    def test_render_template_file_unchanged_content_is_not_rewritten(self):
+        tmp_dir = tempfile.mkdtemp()
+        destination_path = os.path.join(tmp_dir, "docker-compose.yml")
+
+        render_template_file(
+            key_path=PRIVATE_KEY_1_PATH,
+            secrets_path=SECRETS_1_PATH,
+            template_path=TEMPLATE_1_PATH,
+            destination_path=destination_path,
+        )
+        stat_1 = os.stat(destination_path)
+
+        render_template_file(
+            key_path=PRIVATE_KEY_1_PATH,
+            secrets_path=SECRETS_1_PATH,
+            template_path=TEMPLATE_1_PATH,
+            destination_path=destination_path,
+        )
+        stat_2 = os.stat(destination_path)
+
+        self.assertEqual(stat_1.st_ino, stat_2.st_ino)
+        self.assertEqual(stat_1.st_mtime_ns, stat_2.st_mtime_ns)
+
+        # Permissions should still be ensured
+        render_template_file(
+            key_path=PRIVATE_KEY_1_PATH,
+            secrets_path=SECRETS_1_PATH,
+            template_path=TEMPLATE_1_PATH,
+            destination_path=destination_path,
+            ensure_permissions="640",
+        )
+        stat_3 = os.stat(destination_path)
+
+        self.assertEqual(stat_1.st_ino, stat_3.st_ino)
+        self.assertEqual(oct(stat_3.st_mode)[-3:], "640")
+
+        # skip_unchanged=False should always write the file
+        render_template_file(
+            key_path=PRIVATE_KEY_1_PATH,
+            secrets_path=SECRETS_1_PATH,
+            template_path=TEMPLATE_1_PATH,
+            destination_path=destination_path,
+            skip_unchanged=False,
+        )
+        stat_4 = os.stat(destination_path)
+        self.assertNotEqual(stat_1.st_ino, stat_4.st_ino)
+
+    def test_render_template_file_unchanged_content_doesnt_touch_directory(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        destination_path = os.path.join(tmp_dir, "docker-compose.yml")
+
+        render_template_file(
+            key_path=PRIVATE_KEY_1_PATH,
+            secrets_path=SECRETS_1_PATH,
+            template_path=TEMPLATE_1_PATH,
+            destination_path=destination_path,
+        )
+        listing_1 = sorted(os.listdir(tmp_dir))
+        directory_stat_1 = os.stat(tmp_dir)
+        stat_1 = os.stat(destination_path)
+
+        with mock.patch("dcsm.utils.tempfile.mkstemp") as mock_mkstemp:
+            render_template_file(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                template_path=TEMPLATE_1_PATH,
+                destination_path=destination_path,
+            )
+
+        self.assertEqual(mock_mkstemp.call_count, 0)
+        self.assertEqual(sorted(os.listdir(tmp_dir)), listing_1)
+        self.assertEqual(os.stat(tmp_dir).st_mtime_ns, directory_stat_1.st_mtime_ns)
+        self.assertEqual(os.stat(destination_path).st_ino, stat_1.st_ino)
+
+    def test_render_template_file_changed_content_is_rewritten(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        destination_path = os.path.join(tmp_dir, "docker-compose.yml")
+
+        render_template_file(
+            key_path=PRIVATE_KEY_1_PATH,
+            secrets_path=SECRETS_1_PATH,
+            template_path=TEMPLATE_1_PATH,
+            destination_path=destination_path,
+        )
+
+        with open(destination_path, "rb") as fp:
+            expected_content = fp.read()
+
+        # Existing file which is a prefix of, which is longer than and which differs from the
+        # rendered output
+        for existing_content in [
+            expected_content[:100],
+            expected_content + b"extra",
+            expected_content[:100] + b"x" + expected_content[101:],
+        ]:
+            with open(destination_path, "wb") as fp:
+                fp.write(existing_content)
+
+            render_template_file(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                template_path=TEMPLATE_1_PATH,
+                destination_path=destination_path,
+            )
+
+            with open(destination_path, "rb") as fp:
+                self.assertEqual(fp.read(), expected_content)
+
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["docker-compose.yml"])
+
+    def test_render_template_file_streams_output(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        template_path = os.path.join(tmp_dir, "large.yml.j2")
+        destination_path = os.path.join(tmp_dir, "large.yml")
+
+        # ~4 MB of output
+        with open(template_path, "w") as fp:
+            fp.write(
+                "{% for index in range(50000) %}"
+                "line {{ index }}: {{ secrets.KEY_ONE }} {{ 'x' * 64 }}\n"
+                "{% endfor %}"
+            )
+
+        tracemalloc.start()
+
+        try:
+            render_template_file(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                template_path=template_path,
+                destination_path=destination_path,
+            )
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertGreater(os.stat(destination_path).st_size, 4 * 1024 * 1024)
+        self.assertLess(peak_memory, 2 * 1024 * 1024)
+        self.assertEqual(sorted(os.listdir(tmp_dir)), ["large.yml", "large.yml.j2"])
+
+        with open(destination_path, "r") as fp:
+            self.assertEqual(fp.readline(), "line 0: value 1 %s\n" % ("x" * 64))
+
+    def test_get_file_digest_reads_file_in_chunks(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        file_path = os.path.join(tmp_dir, "large.yml")
+        content = b"x" * (4 * 1024 * 1024)
+
+        with open(file_path, "wb") as fp:
+            fp.write(content)
+
+        tracemalloc.start()
+
+        try:
+            digest = file_render._get_file_digest(file_path)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(digest, hashlib.sha256(content).hexdigest())
+        self.assertLess(peak_memory, 1024 * 1024)
+        self.assertIsNone(file_render._get_file_digest(os.path.join(tmp_dir, "doesnt-exist")))
+
+    def test_render_template_file_state_path_skips_render(self):
+        tmp_dir = tempfile.mkdtemp()
+        secrets_path = os.path.join(tmp_dir, "secrets.yaml")
+        destination_path = os.path.join(tmp_dir, "docker-compose.yml")
+        state_path = os.path.join(tmp_dir, "state.json")
+        shutil.copyfile(SECRETS_1_PATH, secrets_path)
+
+        def render():
+            with mock.patch.object(
+                file_render, "decrypt_secret", wraps=file_render.decrypt_secret
+            ) as mock_decrypt_secret:
+                render_template_file(
+                    key_path=PRIVATE_KEY_1_PATH,
+                    secrets_path=secrets_path,
+                    template_path=TEMPLATE_1_PATH,
+                    destination_path=destination_path,
+                    state_path=state_path,
+                )
+
+            return mock_decrypt_secret.call_count
+
+        self.assertEqual(render(), 3)
+        self.assertEqual(oct(os.stat(state_path).st_mode)[-3:], "600")
+
+        # Inputs haven't changed
+        self.assertEqual(render(), 0)
+
+        # Secrets file has changed
+        with open(secrets_path, "a") as fp:
+            fp.write("KEY_FOUR: foo\n")
+
+        self.assertEqual(render(), 3)
+        self.assertEqual(render(), 0)
+
+        # Destination file has been modified
+        with open(destination_path, "a") as fp:
+            fp.write("foo")
+
+        self.assertEqual(render(), 3)
+        self.assertTrue("foo" not in self._get_file_content(destination_path))
+
+    def test_compiled_templates_are_cached_in_memory(self):
+        tmp_dir = tempfile.mkdtemp()
+        file_render._ENVIRONMENTS.clear()
+
+        env = get_environment()
+        self.assertTrue(env is get_environment())
+
+        original_parse = Environment._parse
+        parse_calls = []
+
+        def mock_parse(self, *args, **kwargs):
+            parse_calls.append(args)
+            return original_parse(self, *args, **kwargs)
+
+        with mock.patch.object(Environment, "_parse", mock_parse):
+            for index in range(3):
+                render_template_file(
+                    key_path=PRIVATE_KEY_1_PATH,
+                    secrets_path=SECRETS_1_PATH,
+                    template_path=TEMPLATE_3_PATH,
+                    destination_path=os.path.join(tmp_dir, "rendered_%s" % (index)),
+                )
+
+        self.assertEqual(len(parse_calls), 1)
+
+    def test_precompile_templates_and_bytecode_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        bytecode_cache_dir = os.path.join(tmp_dir, "cache")
+        templates_dir = os.path.join(tmp_dir, "templates")
+        shutil.copytree(os.path.join(FIXTURES_DIR, "templates"), templates_dir)
+
+        result = precompile_templates(paths=[templates_dir], bytecode_cache_dir=bytecode_cache_dir)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(len(os.listdir(bytecode_cache_dir)), 3)
+
+        # New environment (e.g. new process) should re-use compiled templates from the bytecode
+        # cache, even if the template is located in a different directory
+        file_render._ENVIRONMENTS.clear()
+
+        with mock.patch.object(Environment, "_parse") as mock_parse:
+            render_template_file(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                template_path=TEMPLATE_1_PATH,
+                destination_path=os.path.join(tmp_dir, "rendered"),
+                bytecode_cache_dir=bytecode_cache_dir,
+            )
+
+        self.assertEqual(mock_parse.call_count, 0)
+
+        rendered_template = self._get_file_content(os.path.join(tmp_dir, "rendered"))
+        self.assertTrue("- SECRET1=value 1" in rendered_template)
+
+    def test_template_watcher_only_rerenders_changed_templates(self):
+        tmp_dir = tempfile.mkdtemp()
+        secrets_path = os.path.join(tmp_dir, "secrets.yaml")
+        shutil.copyfile(SECRETS_1_PATH, secrets_path)
+
+        templates = []
+        for index, template_content in enumerate(
+            [
+                "SECRET1={{ secrets.KEY_ONE }}",
+                "SECRET2={{ secrets.KEY_TWO }}",
+                '{% set name = "KEY_ONE" %}SECRET1={{ secrets[name] }}',
+            ]
+        ):
+            template_path = os.path.join(tmp_dir, "template_%s.j2" % (index))
+            destination_path = os.path.join(tmp_dir, "rendered_%s" % (index))
+
+            with open(template_path, "w") as fp:
+                fp.write(template_content)
+
+            templates.append((template_path, destination_path))
+
+        watcher = TemplateWatcher(
+            key_path=PRIVATE_KEY_1_PATH, secrets_path=secrets_path, templates=templates
+        )
+
+        destination_paths = [destination_path for _, destination_path in templates]
+
+        # Initial render
+        self.assertEqual(watcher.poll(), destination_paths)
+        self.assertEqual(self._get_file_content(destination_paths[0]), "SECRET1=value 1")
+        self.assertEqual(self._get_file_content(destination_paths[1]), "SECRET2=value 2")
+        self.assertEqual(self._get_file_content(destination_paths[2]), "SECRET1=value 1")
+
+        # Nothing has changed
+        self.assertEqual(watcher.poll(), [])
+
+        # Template file changed
+        with open(templates[0][0], "w") as fp:
+            fp.write("SECRET1 = {{ secrets.KEY_ONE }}")
+
+        self.assertEqual(watcher.poll(), [destination_paths[0]])
+        self.assertEqual(self._get_file_content(destination_paths[0]), "SECRET1 = value 1")
+
+        # Value of a secret referenced by the second template changed. Third template uses dynamic
+        # references so it needs to be re-rendered on every secrets file change.
+        with open(secrets_path, "r") as fp:
+            content = yaml.safe_load(fp)
+
+        content["KEY_TWO"] = content["KEY_THREE"]
+
+        with open(secrets_path, "w") as fp:
+            yaml.safe_dump(content, fp)
+
+        self.assertEqual(watcher.poll(), [destination_paths[1], destination_paths[2]])
+        self.assertEqual(self._get_file_content(destination_paths[1]), "SECRET2=value 3")
+
+        # Destination file has been removed
+        os.unlink(destination_paths[0])
+        self.assertEqual(watcher.poll(), [destination_paths[0]])
+        self.assertEqual(watcher.poll(), [])
+
     def _get_file_content(self, file_path: str) -> str:
         with open(file_path, "r") as fp:
             return fp.read()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from filelock import Timeout
+
+from dcsm import profiling, secrets_writer
+from dcsm.locking import (
+    DEFAULT_LOCK_TIMEOUT,
+    LOCK_TIMEOUT_ENV_VARIABLE,
+    LockTimeout,
+    ReadWriteFileLock,
+    get_lock_timeout,
+    get_secrets_file_lock,
+)
+
+__all__ = ["ReadWriteFileLockTestCase"]
+
+
+class ReadWriteFileLockTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ReadWriteFileLockTestCase, self).setUp()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.tmp_dir, "secrets.lock")
+
+    def tearDown(self):
+        super(ReadWriteFileLockTestCase, self).tearDown()
+
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shared_locks_dont_block_each_other(self):
+        lock1 = ReadWriteFileLock(self.lock_path)
+        lock2 = ReadWriteFileLock(self.lock_path)
+
+        with lock1.shared(), lock2.shared(timeout=0):
+            pass
+
+        self.assertEqual(os.stat(self.lock_path).st_mode & 0o777, 0o600)
+
+    def test_exclusive_lock_times_out_while_shared_lock_is_held(self):
+        lock = ReadWriteFileLock(self.lock_path)
+
+        with lock.shared():
+            with self.assertRaises(LockTimeout) as cm:
+                with ReadWriteFileLock(self.lock_path).exclusive(timeout=0.05):
+                    pass
+
+        # Existing code which catches filelock.Timeout should keep working
+        self.assertIsInstance(cm.exception, Timeout)
+        self.assertIn("exclusive lock on %s" % (self.lock_path), str(cm.exception))
+
+        with lock.exclusive(timeout=0):
+            pass
+
+    def test_shared_lock_times_out_while_exclusive_lock_is_held(self):
+        with ReadWriteFileLock(self.lock_path).exclusive():
+            self.assertRaises(
+                LockTimeout, ReadWriteFileLock(self.lock_path, timeout=0.05).shared().__enter__
+            )
+
+    def test_lock_wait_time_is_reported(self):
+        lock = ReadWriteFileLock(self.lock_path)
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold_exclusive_lock():
+            with ReadWriteFileLock(self.lock_path).exclusive():
+                acquired.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold_exclusive_lock)
+        thread.start()
+        acquired.wait(5)
+        threading.Timer(0.1, release.set).start()
+
+        with profiling.profile() as profiler:
+            with lock.shared():
+                pass
+
+        thread.join(5)
+
+        self.assertGreaterEqual(lock.last_wait_time, 0.05)
+
+        result = profiler.to_dict()
+        self.assertEqual(result["phases"]["shared_lock_wait"]["count"], 1)
+        self.assertGreaterEqual(result["phases"]["shared_lock_wait"]["total_seconds"], 0.05)
+        self.assertEqual(result["counters"]["shared_lock_contentions"], 1)
+
+    def test_get_lock_timeout(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertEqual(get_lock_timeout(), DEFAULT_LOCK_TIMEOUT)
+            self.assertEqual(get_lock_timeout(2.5), 2.5)
+
+        with mock.patch.dict(os.environ, {LOCK_TIMEOUT_ENV_VARIABLE: "0.5"}):
+            self.assertEqual(get_lock_timeout(), 0.5)
+            self.assertEqual(get_lock_timeout(-1), -1)
+
+    def test_secrets_file_writer_waits_for_readers(self):
+        secrets_path = os.path.join(self.tmp_dir, "secrets.yaml")
+
+        with get_secrets_file_lock(secrets_path).shared():
+            self.assertRaises(
+                Timeout,
+                secrets_writer.remove_secret_from_file,
+                secrets_path=secrets_path,
+                key="KEY_ONE",
+                lock_timeout=0.05,
+            )
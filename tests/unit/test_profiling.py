@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from dcsm import profiling
+from dcsm.decryption import clear_private_key_cache
+from dcsm.file_render import render_template_file
+from dcsm.secrets_writer import clear_file_content_cache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.abspath(os.path.join(BASE_DIR, "../fixtures"))
+
+PRIVATE_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_1_no_password.pem")
+SECRETS_1_PATH = os.path.join(FIXTURES_DIR, "secrets/secrets1.yaml")
+TEMPLATE_3_PATH = os.path.join(FIXTURES_DIR, "templates/docker-compose.yml.3.j2")
+
+__all__ = ["ProfilingTestCase"]
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ProfilingTestCase, self).setUp()
+        clear_private_key_cache()
+        clear_file_content_cache()
+
+    def test_render_template_file_is_profiled(self):
+        _, tmp_path = tempfile.mkstemp()
+        events = []
+
+        with profiling.profile(callback=lambda *args: events.append(args)) as profiler:
+            render_template_file(
+                key_path=PRIVATE_KEY_1_PATH,
+                secrets_path=SECRETS_1_PATH,
+                template_path=TEMPLATE_3_PATH,
+                destination_path=tmp_path,
+            )
+
+        report = profiler.to_dict()
+
+        for name in [
+            "read_template",
+            "compile_template",
+            "render_template",
+            "parse_secrets_file",
+            "load_private_key",
+            "decrypt",
+            "write_destination_file",
+        ]:
+            self.assertIn(name, report["phases"])
+
+        # Template references two secrets, one three times and the other one twice
+        self.assertEqual(report["phases"]["decrypt"]["count"], 2)
+        self.assertEqual(report["phases"]["load_private_key"]["count"], 1)
+        self.assertEqual(report["counters"]["decryptions"], 2)
+        self.assertEqual(report["counters"]["decrypted_secret_cache_hits"], 3)
+        self.assertEqual(report["counters"]["private_key_cache_misses"], 1)
+        self.assertEqual(report["counters"]["private_key_cache_hits"], 1)
+        self.assertEqual(report["counters"]["rendered_templates"], 1)
+        self.assertGreater(report["total_seconds"], 0)
+
+        self.assertIn(("counter", "decryptions", 1), events)
+        self.assertIn("render_template", [event[1] for event in events if event[0] == "phase"])
+
+        # Profiler is inactive outside of the block
+        render_template_file(
+            key_path=PRIVATE_KEY_1_PATH,
+            secrets_path=SECRETS_1_PATH,
+            template_path=TEMPLATE_3_PATH,
+            destination_path=tmp_path,
+        )
+        self.assertEqual(profiler.to_dict()["counters"], report["counters"])
+        self.assertIs(profiling.phase("decrypt"), profiling._NULL_CONTEXT)
+
+    def test_profile_report(self):
+        stream = io.StringIO()
+
+        with profiling.profile_report(enabled=True, stream=stream):
+            with profiling.phase("test"):
+                pass
+
+            profiling.increment("counter", 5)
+
+        report = json.loads(stream.getvalue())
+        self.assertEqual(report["phases"]["test"]["count"], 1)
+        self.assertEqual(report["counters"], {"counter": 5})
+
+        stream = io.StringIO()
+
+        with profiling.profile_report(enabled=False, stream=stream) as profiler:
+            profiling.increment("counter")
+
+        self.assertIsNone(profiler)
+        self.assertEqual(stream.getvalue(), "")
@@ -15,16 +15,27 @@
 # limitations under the License.
 
 import os
+import shutil
 import tempfile
 import unittest
+from unittest import mock
 
 import yaml
 
+from dcsm import secrets_writer
 from dcsm.decryption import decrypt_secret
+from dcsm.journal import get_journal_path
 from dcsm.secrets_writer import (
+    clear_file_content_cache,
+    compact_secrets_file,
     decrypt_secret_from_file,
+    dump_yaml,
+    encrypt_and_write_many_to_file,
     encrypt_and_write_to_file,
+    get_cached_file_content,
+    get_secret_keys,
     remove_secret_from_file,
+    rotate_secrets_file,
 )
 from dcsm.utils import get_template_file_lock_path
 
@@ -33,6 +44,10 @@ FIXTURES_DIR = os.path.abspath(os.path.join(BASE_DIR, "../fixtures"))
 
 PRIVATE_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_1_no_password.pem")
 PUBLIC_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_1_no_password.pem")
+PRIVATE_KEY_2_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_2_no_password.pem")
+PUBLIC_KEY_2_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_2_no_password.pem")
+PRIVATE_KEY_3_X25519_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_3_x25519_no_password.pem")
+PUBLIC_KEY_3_X25519_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_3_x25519_no_password.pem")
 SECRETS_1_PATH = os.path.join(FIXTURES_DIR, "secrets/secrets1.yaml")
 
 __all__ = ["SecretsWriterTestCase"]
@@ -112,6 +127,420 @@ class SecretsWriterTestCase(unittest.TestCase):
         )
         self.assertEqual(decrypted_key, "value 3")
 
+    def test_encrypt_and_write_to_file_envelope_format(self):
+        _, tmp_path = tempfile.mkstemp()
+
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH,
+            secrets_path=tmp_path,
+            key="key1",
+            value="value 1",
+            envelope_format=True,
+        )
+
+        content = yaml.safe_load(self._get_file_content(tmp_path))
+        self.assertTrue(content["key1"].startswith("dcsm:v2:"))
+
+        decrypted_key = decrypt_secret_from_file(
+            key_path=PRIVATE_KEY_1_PATH, secrets_path=tmp_path, key="key1"
+        )
+        self.assertEqual(decrypted_key, "value 1")
+
+    def test_encrypt_and_write_many_to_file(self):
+        _, tmp_path = tempfile.mkstemp()
+
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH, secrets_path=tmp_path, key="key1", value="value 1"
+        )
+
+        secrets = dict([("key%s" % (index), "value %s" % (index)) for index in range(2, 12)])
+        secrets["key1"] = "value new!"
+
+        for envelope_format, max_workers in [(False, None), (True, 4)]:
+            with mock.patch.object(
+                secrets_writer, "write_to_file", wraps=secrets_writer.write_to_file
+            ) as mock_write_to_file:
+                encrypt_and_write_many_to_file(
+                    key_path=PUBLIC_KEY_1_PATH,
+                    secrets_path=tmp_path,
+                    secrets=secrets,
+                    envelope_format=envelope_format,
+                    max_workers=max_workers,
+                )
+
+            # All the secrets should be written at once
+            self.assertEqual(mock_write_to_file.call_count, 1)
+
+            content = yaml.safe_load(self._get_file_content(tmp_path))
+
+            for key, value in secrets.items():
+                self.assertTrue("%s_updated_at" % (key) in content)
+                self.assertTrue("%s_updated_by" % (key) in content)
+                self.assertEqual(content[key].startswith("dcsm:v2:"), envelope_format)
+
+                decrypted_value = decrypt_secret_from_file(
+                    key_path=PRIVATE_KEY_1_PATH, secrets_path=tmp_path, key=key
+                )
+                self.assertEqual(decrypted_value, value)
+
+        # All the secrets should share the same wrapped data key
+        wrapped_keys = set([content[key].split(":")[3] for key in secrets.keys()])
+        self.assertEqual(len(wrapped_keys), 1)
+
+    def test_get_cached_file_content(self):
+        _, tmp_path = tempfile.mkstemp()
+        clear_file_content_cache()
+
+        self.assertEqual(get_cached_file_content(tmp_path), {})
+
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH, secrets_path=tmp_path, key="key1", value="value 1"
+        )
+
+        content_1 = get_cached_file_content(tmp_path)
+        content_2 = get_cached_file_content(tmp_path)
+        self.assertTrue("key1" in content_1)
+        self.assertTrue(content_1 is content_2)
+
+        # Cache should be invalidated when the file is updated
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH, secrets_path=tmp_path, key="key2", value="value 2"
+        )
+
+        content_3 = get_cached_file_content(tmp_path)
+        self.assertFalse(content_1 is content_3)
+        self.assertTrue("key2" in content_3)
+
+        # Explicit invalidation
+        clear_file_content_cache(tmp_path)
+        content_4 = get_cached_file_content(tmp_path)
+        self.assertFalse(content_3 is content_4)
+        self.assertEqual(content_3, content_4)
+
+    @unittest.skipIf(not yaml.__with_libyaml__, "libyaml is not available")
+    def test_dump_yaml_libyaml_and_pure_python_output_parity(self):
+        self.assertTrue(secrets_writer.YAMLDumper is yaml.CSafeDumper)
+        self.assertTrue(secrets_writer.YAMLLoader is yaml.CSafeLoader)
+
+        content = secrets_writer.get_file_content(SECRETS_1_PATH)
+        content.update(
+            {
+                "KEY_UNICODE": "čšž ünïcode ☃",
+                "KEY_MULTILINE": "line 1\nline 2\n",
+                "KEY_LONG": "word " * 60,
+                "KEY_NUMBER_LIKE": "0123",
+                "KEY_BOOL_LIKE": "yes",
+                "KEY_EMPTY": "",
+                "KEY_COLON": "a: b",
+                "KEY_FOUR_updated_at": "2020-12-26 21:38:49 UTC # 1609018729",
+            }
+        )
+        content = dict(sorted(content.items()))
+
+        ascii_content = dict(
+            [(key, value) for key, value in content.items() if key != "KEY_UNICODE"]
+        )
+        libyaml_result = dump_yaml(ascii_content, dumper=yaml.CSafeDumper)
+        pure_python_result = dump_yaml(ascii_content, dumper=yaml.SafeDumper)
+        self.assertEqual(libyaml_result.encode("utf-8"), pure_python_result.encode("utf-8"))
+        self.assertEqual(dump_yaml(ascii_content), libyaml_result)
+
+        # libyaml and pure Python dumper fold long escaped non-ASCII strings differently so pure
+        # Python dumper is used for such content
+        content["KEY_UNICODE_LONG"] = "ünïcode " * 30
+
+        with mock.patch.object(yaml, "dump", wraps=yaml.dump) as mock_dump:
+            result = dump_yaml(content)
+
+        self.assertTrue(mock_dump.call_args[1]["Dumper"] is yaml.SafeDumper)
+        self.assertEqual(result, dump_yaml(content, dumper=yaml.SafeDumper))
+
+        self.assertEqual(yaml.load(libyaml_result, Loader=yaml.CSafeLoader), ascii_content)
+        self.assertEqual(yaml.load(libyaml_result, Loader=yaml.SafeLoader), ascii_content)
+        self.assertEqual(yaml.load(result, Loader=yaml.CSafeLoader), content)
+        self.assertEqual(yaml.load(result, Loader=yaml.SafeLoader), content)
+
     def _get_file_content(self, file_path: str) -> str:
         with open(file_path, "r") as fp:
             return fp.read()
+
+    def test_journal_mode(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        secrets_path = os.path.join(tmp_dir, "secrets.yaml")
+        journal_path = get_journal_path(secrets_path)
+        shutil.copyfile(SECRETS_1_PATH, secrets_path)
+
+        with open(secrets_path, "rb") as fp:
+            snapshot = fp.read()
+
+        with mock.patch.object(
+            secrets_writer, "write_to_file", wraps=secrets_writer.write_to_file
+        ) as mock_write_to_file:
+            encrypt_and_write_to_file(
+                key_path=PUBLIC_KEY_1_PATH,
+                secrets_path=secrets_path,
+                key="key1",
+                value="value 1",
+                journal=True,
+            )
+            encrypt_and_write_many_to_file(
+                key_path=PUBLIC_KEY_1_PATH,
+                secrets_path=secrets_path,
+                secrets={"key2": "value 2", "key3": "value 3"},
+                journal=True,
+            )
+            remove_secret_from_file(secrets_path=secrets_path, key="key2", journal=True)
+
+        # Secrets file itself should not have been touched, changes are in the journal
+        self.assertEqual(mock_write_to_file.call_count, 0)
+
+        with open(secrets_path, "rb") as fp:
+            self.assertEqual(fp.read(), snapshot)
+
+        with open(journal_path, "r") as fp:
+            self.assertEqual(len(fp.read().splitlines()), 3)
+
+        content = get_cached_file_content(secrets_path)
+        self.assertIn("KEY_ONE", content)
+        self.assertIn("key1", content)
+        self.assertIn("key3_updated_by", content)
+        self.assertNotIn("key2", content)
+        self.assertNotIn("key2_updated_at", content)
+
+        self.assertEqual(
+            decrypt_secret_from_file(
+                key_path=PRIVATE_KEY_1_PATH, secrets_path=secrets_path, key="key3"
+            ),
+            "value 3",
+        )
+
+        # Incomplete trailing record (e.g. crash in the middle of the append) should be ignored
+        with open(journal_path, "a") as fp:
+            fp.write('{"set": {"key4": ')
+
+        self.assertNotIn("key4", get_cached_file_content(secrets_path))
+
+        # Compaction should fold the journal into a sorted snapshot
+        self.assertTrue(compact_secrets_file(secrets_path))
+        self.assertFalse(os.path.exists(journal_path))
+        self.assertFalse(compact_secrets_file(secrets_path))
+
+        with open(secrets_path, "r") as fp:
+            compacted_content = yaml.safe_load(fp)
+
+        self.assertEqual(compacted_content, dict(content))
+        self.assertEqual(list(compacted_content.keys()), sorted(compacted_content.keys()))
+
+    def test_journal_mode_compaction_threshold(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        secrets_path = os.path.join(tmp_dir, "secrets.yaml")
+        journal_path = get_journal_path(secrets_path)
+
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH,
+            secrets_path=secrets_path,
+            key="key1",
+            value="value 1",
+            journal=True,
+        )
+        self.assertFalse(os.path.exists(secrets_path))
+        self.assertTrue(os.path.exists(journal_path))
+        self.assertIn("key1", get_cached_file_content(secrets_path))
+
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH,
+            secrets_path=secrets_path,
+            key="key2",
+            value="value 2",
+            journal=True,
+            compaction_threshold=1,
+        )
+        self.assertFalse(os.path.exists(journal_path))
+
+        content = get_cached_file_content(secrets_path)
+        self.assertIn("key1", content)
+        self.assertIn("key2", content)
+
+        # Regular (non journal) write should also fold the journal in
+        remove_secret_from_file(secrets_path=secrets_path, key="key1", journal=True)
+        self.assertTrue(os.path.exists(journal_path))
+
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH, secrets_path=secrets_path, key="key3", value="value 3"
+        )
+        self.assertFalse(os.path.exists(journal_path))
+
+        content = get_cached_file_content(secrets_path)
+        self.assertEqual(
+            sorted([key for key in content.keys() if key.startswith("key")]),
+            [
+                "key2",
+                "key2_updated_at",
+                "key2_updated_by",
+                "key3",
+                "key3_updated_at",
+                "key3_updated_by",
+            ],
+        )
+
+    def test_encrypt_and_write_to_file_multiple_recipients(self):
+        _, tmp_path = tempfile.mkstemp()
+
+        with mock.patch.object(
+            secrets_writer, "write_to_file", wraps=secrets_writer.write_to_file
+        ) as mock_write_to_file:
+            encrypt_and_write_to_file(
+                key_path=[PUBLIC_KEY_1_PATH, PUBLIC_KEY_2_PATH],
+                secrets_path=tmp_path,
+                key="key1",
+                value="value 1",
+            )
+
+        self.assertEqual(mock_write_to_file.call_count, 1)
+
+        for private_key_path in [PRIVATE_KEY_1_PATH, PRIVATE_KEY_2_PATH]:
+            decrypted_value = decrypt_secret_from_file(
+                key_path=private_key_path, secrets_path=tmp_path, key="key1"
+            )
+            self.assertEqual(decrypted_value, "value 1")
+
+    def test_get_secret_keys(self):
+        content = {
+            "KEY_ONE": "a",
+            "KEY_ONE_updated_at": "2020-05-01 00:00:00 UTC # 1588291200",
+            "KEY_ONE_updated_by": "user@host",
+            "KEY_TWO": "b",
+            "KEY_TWO_updated": 1588291200,
+            "KEY_THREE_updated_by": "c",
+            "updated_at": 1588291200,
+        }
+        self.assertEqual(get_secret_keys(content), ["KEY_ONE", "KEY_THREE_updated_by", "KEY_TWO"])
+
+    def test_rotate_secrets_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        secrets_path = os.path.join(tmp_dir, "secrets.yaml")
+        shutil.copyfile(SECRETS_1_PATH, secrets_path)
+
+        # Only KEY_TWO and KEY_THREE have been updated after this timestamp
+        with mock.patch.object(
+            secrets_writer, "write_to_file", wraps=secrets_writer.write_to_file
+        ) as mock_write_to_file:
+            rotated_keys = rotate_secrets_file(
+                old_key_path=PRIVATE_KEY_1_PATH,
+                new_key_path=PUBLIC_KEY_3_X25519_PATH,
+                secrets_path=secrets_path,
+                updated_since=1609018730,
+                max_workers=1,
+            )
+
+        self.assertEqual(rotated_keys, ["KEY_THREE", "KEY_TWO"])
+        self.assertEqual(mock_write_to_file.call_count, 1)
+
+        decrypted_value = decrypt_secret_from_file(
+            key_path=PRIVATE_KEY_3_X25519_PATH, secrets_path=secrets_path, key="KEY_TWO"
+        )
+        self.assertEqual(decrypted_value, "value 2")
+        decrypted_value = decrypt_secret_from_file(
+            key_path=PRIVATE_KEY_1_PATH, secrets_path=secrets_path, key="KEY_ONE"
+        )
+        self.assertEqual(decrypted_value, "value 1")
+
+        # Rotate the remaining secret using a process pool
+        shutil.copyfile(SECRETS_1_PATH, secrets_path)
+
+        rotated_keys = rotate_secrets_file(
+            old_key_path=PRIVATE_KEY_1_PATH,
+            new_key_path=[PUBLIC_KEY_2_PATH, PUBLIC_KEY_3_X25519_PATH],
+            secrets_path=secrets_path,
+            max_workers=2,
+        )
+        self.assertEqual(rotated_keys, ["KEY_ONE", "KEY_THREE", "KEY_TWO"])
+
+        with open(secrets_path, "r") as fp:
+            content = yaml.safe_load(fp)
+
+        self.assertEqual(content["KEY_ONE_updated_by"], "kami@kami-desktop")
+
+        for private_key_path in [PRIVATE_KEY_2_PATH, PRIVATE_KEY_3_X25519_PATH]:
+            for key, value in [("KEY_ONE", "value 1"), ("KEY_THREE", "value 3")]:
+                decrypted_value = decrypt_secret_from_file(
+                    key_path=private_key_path, secrets_path=secrets_path, key=key
+                )
+                self.assertEqual(decrypted_value, value)
+
+    def test_rotate_secrets_file_preserves_envelope_format(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        secrets_path = os.path.join(tmp_dir, "secrets.yaml")
+        large_value = "x" * 2000
+
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH,
+            secrets_path=secrets_path,
+            key="LARGE",
+            value=large_value,
+            envelope_format=True,
+        )
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH,
+            secrets_path=secrets_path,
+            key="SMALL_ENVELOPE",
+            value="value 1",
+            envelope_format=True,
+        )
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH, secrets_path=secrets_path, key="SMALL", value="value 2"
+        )
+
+        rotated_keys = rotate_secrets_file(
+            old_key_path=PRIVATE_KEY_1_PATH,
+            new_key_path=PUBLIC_KEY_2_PATH,
+            secrets_path=secrets_path,
+            max_workers=1,
+        )
+        self.assertEqual(rotated_keys, ["LARGE", "SMALL", "SMALL_ENVELOPE"])
+
+        with open(secrets_path, "r") as fp:
+            content = yaml.safe_load(fp)
+
+        # Envelope secrets are not downgraded to legacy format
+        self.assertTrue(content["LARGE"].startswith("dcsm:v2:"))
+        self.assertTrue(content["SMALL_ENVELOPE"].startswith("dcsm:v2:"))
+        self.assertFalse(content["SMALL"].startswith("dcsm:"))
+
+        for key, value in [
+            ("LARGE", large_value),
+            ("SMALL_ENVELOPE", "value 1"),
+            ("SMALL", "value 2"),
+        ]:
+            decrypted_value = decrypt_secret_from_file(
+                key_path=PRIVATE_KEY_2_PATH, secrets_path=secrets_path, key=key
+            )
+            self.assertEqual(decrypted_value, value)
+
+        # Legacy secrets which don't fit the new key are upgraded to envelope format
+        with mock.patch("dcsm.encryption.get_legacy_secret_max_size", return_value=5):
+            rotate_secrets_file(
+                old_key_path=PRIVATE_KEY_2_PATH,
+                new_key_path=PUBLIC_KEY_1_PATH,
+                secrets_path=secrets_path,
+                max_workers=1,
+            )
+
+        with open(secrets_path, "r") as fp:
+            content = yaml.safe_load(fp)
+
+        self.assertTrue(content["SMALL"].startswith("dcsm:v2:"))
+        self.assertEqual(
+            decrypt_secret_from_file(
+                key_path=PRIVATE_KEY_1_PATH, secrets_path=secrets_path, key="SMALL"
+            ),
+            "value 2",
+        )
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import yaml
+
+from dcsm.file_render import render_template_file
+from dcsm.secrets_writer import (
+    convert_secrets_file,
+    decrypt_secret_from_file,
+    encrypt_and_write_many_to_file,
+    encrypt_and_write_to_file,
+    get_file_content,
+    get_secret_keys,
+    remove_secret_from_file,
+)
+from dcsm.sqlite_store import is_sqlite_path
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.abspath(os.path.join(BASE_DIR, "../fixtures"))
+
+PRIVATE_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/private_key_1_no_password.pem")
+PUBLIC_KEY_1_PATH = os.path.join(FIXTURES_DIR, "keys/public_key_1_no_password.pem")
+SECRETS_1_PATH = os.path.join(FIXTURES_DIR, "secrets/secrets1.yaml")
+TEMPLATE_1_PATH = os.path.join(FIXTURES_DIR, "templates/docker-compose.yml.j2")
+
+__all__ = ["SQLiteStoreTestCase"]
+
+
+class SQLiteStoreTestCase(unittest.TestCase):
+    def test_is_sqlite_path(self):
+        self.assertTrue(is_sqlite_path("/tmp/secrets.db"))
+        self.assertTrue(is_sqlite_path("/tmp/secrets.SQLITE"))
+        self.assertTrue(is_sqlite_path("secrets.sqlite3"))
+        self.assertFalse(is_sqlite_path("/tmp/secrets.yaml"))
+        self.assertFalse(is_sqlite_path("/tmp/secrets"))
+
+    def test_encrypt_decrypt_and_remove_secret(self):
+        tmp_dir = tempfile.mkdtemp()
+        secrets_path = os.path.join(tmp_dir, "secrets.db")
+
+        encrypt_and_write_to_file(
+            key_path=PUBLIC_KEY_1_PATH, secrets_path=secrets_path, key="key1", value="value 1"
+        )
+        encrypt_and_write_many_to_file(
+            key_path=PUBLIC_KEY_1_PATH,
+            secrets_path=secrets_path,
+            secrets={"key1": "value new!", "key2": "value 2"},
+        )
+
+        file_permissions = oct(os.stat(secrets_path).st_mode)[-3:]
+        self.assertEqual(file_permissions, "600")
+
+        # Metadata is stored in separate columns
+        connection = sqlite3.connect(secrets_path)
+        rows = connection.execute("SELECT key, updated_at, updated_by FROM secrets").fetchall()
+        connection.close()
+
+        self.assertEqual(sorted([row[0] for row in rows]), ["key1", "key2"])
+        for _, updated_at, updated_by in rows:
+            self.assertTrue(" UTC # " in updated_at)
+            self.assertTrue("@" in updated_by)
+
+        decrypted_value = decrypt_secret_from_file(
+            key_path=PRIVATE_KEY_1_PATH, secrets_path=secrets_path, key="key1"
+        )
+        self.assertEqual(decrypted_value, "value new!")
+
+        self.assertTrue(remove_secret_from_file(secrets_path=secrets_path, key="key1"))
+
+        expected_msg = 'doesn\'t contain assignment for secret "key1"'
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            decrypt_secret_from_file,
+            key_path=PRIVATE_KEY_1_PATH,
+            secrets_path=secrets_path,
+            key="key1",
+        )
+
+        expected_msg = 'doesn\'t contain secret "key1"'
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            remove_secret_from_file,
+            secrets_path=secrets_path,
+            key="key1",
+        )
+
+        content = get_file_content(secrets_path)
+        self.assertEqual(
+            sorted(content.keys()), ["key2", "key2_updated_at", "key2_updated_by", "updated_at"]
+        )
+
+    def test_convert_legacy_secrets_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        db_path = os.path.join(tmp_dir, "secrets.db")
+
+        # secrets1.yaml uses legacy "<key>_updated" timestamp keys
+        convert_secrets_file(source_path=SECRETS_1_PATH, destination_path=db_path)
+
+        connection = sqlite3.connect(db_path)
+        self.addCleanup(connection.close)
+
+        rows = connection.execute(
+            "SELECT key, updated_at, updated_by FROM secrets ORDER BY key"
+        ).fetchall()
+
+        self.assertEqual(
+            rows,
+            [
+                ("KEY_ONE", "2020-12-26 21:38:49 UTC # 1609018729", "kami@kami-desktop"),
+                ("KEY_THREE", "2020-12-26 21:39:01 UTC # 1609018741", "kami@kami-desktop"),
+                ("KEY_TWO", "2020-12-26 21:38:55 UTC # 1609018735", "kami@kami-desktop"),
+            ],
+        )
+
+        content = get_file_content(db_path)
+        self.assertEqual(get_secret_keys(content), ["KEY_ONE", "KEY_THREE", "KEY_TWO"])
+        self.assertEqual(content["updated_at"], 1609018741)
+
+    def test_convert_secrets_file_import_and_export(self):
+        tmp_dir = tempfile.mkdtemp()
+        db_path = os.path.join(tmp_dir, "secrets.sqlite")
+        yaml_path = os.path.join(tmp_dir, "secrets.yaml")
+
+        convert_secrets_file(source_path=SECRETS_1_PATH, destination_path=db_path)
+
+        decrypted_value = decrypt_secret_from_file(
+            key_path=PRIVATE_KEY_1_PATH, secrets_path=db_path, key="KEY_TWO"
+        )
+        self.assertEqual(decrypted_value, "value 2")
+
+        # Templates can be rendered directly from the SQLite store
+        destination_path = os.path.join(tmp_dir, "docker-compose.yml")
+        render_template_file(
+            key_path=PRIVATE_KEY_1_PATH,
+            secrets_path=db_path,
+            template_path=TEMPLATE_1_PATH,
+            destination_path=destination_path,
+        )
+
+        with open(destination_path, "r") as fp:
+            self.assertTrue("- SECRET3=value 3" in fp.read())
+
+        # Round trip back to YAML
+        convert_secrets_file(source_path=db_path, destination_path=yaml_path)
+
+        with open(SECRETS_1_PATH, "r") as fp:
+            expected_content = yaml.safe_load(fp)
+
+        with open(yaml_path, "r") as fp:
+            content = yaml.safe_load(fp)
+
+        for key in ["KEY_ONE", "KEY_TWO", "KEY_THREE", "updated_at"]:
+            self.assertEqual(content[key], expected_content[key])
+
+        expected_msg = "Source and destination paths cannot be the same"
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            convert_secrets_file,
+            source_path=db_path,
+            destination_path=db_path,
+        )
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from dcsm import utils
+from dcsm.utils import (
+    FSYNC_POLICY_ENV_VARIABLE,
+    AtomicFileWriter,
+    get_fsync_policy,
+    parse_key_value_pairs,
+    write_to_file,
+)
+
+__all__ = ["UtilsTestCase"]
+
+
+class UtilsTestCase(unittest.TestCase):
+    def test_parse_key_value_pairs_dotenv(self):
+        content = """
+# Comment
+KEY_ONE=value 1
+export KEY_TWO = value=2
+KEY_THREE="line 1\\nline 2 \\"quoted\\" \\\\n"
+KEY_FOUR='single \\n quoted'
+KEY_FIVE=
+"""
+        result = parse_key_value_pairs(content=content, input_format="dotenv")
+        self.assertEqual(
+            result,
+            {
+                "KEY_ONE": "value 1",
+                "KEY_TWO": "value=2",
+                "KEY_THREE": 'line 1\nline 2 "quoted" \\n',
+                "KEY_FOUR": "single \\n quoted",
+                "KEY_FIVE": "",
+            },
+        )
+
+        expected_msg = "Line 1 is not in KEY=VALUE format"
+        self.assertRaisesRegex(
+            ValueError, expected_msg, parse_key_value_pairs, content="foo", input_format="dotenv"
+        )
+
+    def test_parse_key_value_pairs_json(self):
+        result = parse_key_value_pairs(content='{"KEY_ONE": "value 1"}', input_format="json")
+        self.assertEqual(result, {"KEY_ONE": "value 1"})
+
+        expected_msg = 'Value for key "KEY_ONE" needs to be a string'
+        self.assertRaisesRegex(
+            ValueError,
+            expected_msg,
+            parse_key_value_pairs,
+            content='{"KEY_ONE": 1}',
+            input_format="json",
+        )
+
+        expected_msg = "Invalid format: yaml"
+        self.assertRaisesRegex(
+            ValueError, expected_msg, parse_key_value_pairs, content="", input_format="yaml"
+        )
+
+    def test_write_to_file_uses_temporary_file_in_destination_directory(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        file_path = os.path.join(tmp_dir, "docker-compose.yml")
+
+        with open(file_path, "w") as fp:
+            fp.write("old content")
+
+        os.chmod(file_path, 0o644)
+
+        with mock.patch.object(utils.tempfile, "mkstemp", wraps=tempfile.mkstemp) as mock_mkstemp:
+            write_to_file(file_path=file_path, permissions=0o600, content=b"new content")
+
+        self.assertEqual(mock_mkstemp.call_args[1]["dir"], tmp_dir)
+        self.assertEqual(os.listdir(tmp_dir), ["docker-compose.yml"])
+        self.assertEqual(stat.S_IMODE(os.stat(file_path).st_mode), 0o600)
+
+        with open(file_path, "r") as fp:
+            self.assertEqual(fp.read(), "new content")
+
+    def test_atomic_file_writer_error_leaves_destination_untouched(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        file_path = os.path.join(tmp_dir, "secrets.yaml")
+
+        with open(file_path, "w") as fp:
+            fp.write("old content")
+
+        with self.assertRaises(RuntimeError):
+            with AtomicFileWriter(file_path=file_path, permissions=0o600) as writer:
+                writer.write(b"partial")
+                raise RuntimeError("failure")
+
+        self.assertEqual(os.listdir(tmp_dir), ["secrets.yaml"])
+
+        with open(file_path, "r") as fp:
+            self.assertEqual(fp.read(), "old content")
+
+    def test_fsync_policy(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        file_path = os.path.join(tmp_dir, "file.txt")
+
+        for fsync_policy, expected_call_count in [("none", 0), ("file", 1), ("full", 2)]:
+            with mock.patch.object(utils.os, "fsync", wraps=os.fsync) as mock_fsync:
+                write_to_file(
+                    file_path=file_path,
+                    permissions=0o600,
+                    content=b"content",
+                    fsync_policy=fsync_policy,
+                )
+
+            self.assertEqual(mock_fsync.call_count, expected_call_count, fsync_policy)
+
+        with mock.patch.dict(os.environ, {FSYNC_POLICY_ENV_VARIABLE: "full"}):
+            self.assertEqual(get_fsync_policy(), "full")
+            self.assertEqual(get_fsync_policy("none"), "none")
+
+        expected_msg = "Invalid fsync policy: always"
+        self.assertRaisesRegex(ValueError, expected_msg, get_fsync_policy, "always")